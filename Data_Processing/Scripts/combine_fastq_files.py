@@ -3,7 +3,12 @@ Combine all fastq files with the same barcode into a single file
 """
 import os
 import gzip
+import shutil
 import argparse
+from multiprocessing import Pool
+
+# Size of the chunks copied from the input files to the output file
+CHUNK_SIZE = 1024 * 1024
 
 def get_files():
     """
@@ -12,6 +17,10 @@ def get_files():
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('-i', '--input', help="Directory containing fastq files",
                         required=True, nargs="+")
+    parser.add_argument('-z', '--gzip', action='store_true',
+                        help="Write gzip compressed output files (<barcode>.fastq.gz)")
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help="Number of barcode directories processed in parallel")
     args = parser.parse_args()
     arguments = args.__dict__
     return arguments
@@ -26,37 +35,85 @@ def get_input_directory():
     return input_dir
 
 
-def combine_fastq_files(input_dir):
+def copy_chunks(source, target, chunk_size=CHUNK_SIZE):
     """
-    Combine all fastq files with the same barcode into a single file
+    Copy a binary file object in fixed-size chunks and count its lines.
+    A missing newline at the end is added, so records of the next file stay intact.
+    """
+    lines = 0
+    last = b"\n"
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        target.write(chunk)
+        lines += chunk.count(b"\n")
+        last = chunk[-1:]
+    if last != b"\n":
+        target.write(b"\n")
+        lines += 1
+    return lines
+
+
+def combine_barcode(root, filenames, gzip_output=False, chunk_size=CHUNK_SIZE):
     """
-    for root, dirs, files in os.walk(input_dir):
-        barcode_to_sequences = {}
-        for filename in files:
-            if filename.endswith('.fastq') or filename.endswith('.fastq.gz'):
-                barcode = os.path.basename(root)  # Use directory name as barcode
-                file_path = os.path.join(root, filename)
+    Stream all fastq files of one barcode directory into a single file.
+
+    Files are copied in chunks, so the memory use does not depend on the size
+    of the run. Gzipped files are decompressed on the fly, or, for gzipped
+    output, their gzip members are copied as they are.
+    """
+    barcode = os.path.basename(root)  # Use directory name as barcode
+    output_file = os.path.join(root, f"{barcode}.fastq.gz" if gzip_output else f"{barcode}.fastq")
+    lines = 0
+    with open(output_file, 'wb') as out:
+        for filename in filenames:
+            file_path = os.path.join(root, filename)
+            print("Processing file: " + filename)
+            if filename.endswith('.gz'):
+                if gzip_output:
+                    # concatenated gzip members are a valid gzip file
+                    with open(file_path, 'rb') as f:
+                        shutil.copyfileobj(f, out, chunk_size)
+                    lines = None
+                    continue
+                with gzip.open(file_path, 'rb') as f:
+                    file_lines = copy_chunks(f, out, chunk_size)
+            elif gzip_output:
+                with open(file_path, 'rb') as f, \
+                     gzip.GzipFile(fileobj=out, mode='wb') as compressed:
+                    file_lines = copy_chunks(f, compressed, chunk_size)
+            else:
+                with open(file_path, 'rb') as f:
+                    file_lines = copy_chunks(f, out, chunk_size)
+            if lines is not None:
+                lines += file_lines
+    if lines is None:
+        print(f"Combined {len(filenames)} files for barcode {barcode} to {output_file}")
+    else:
+        print(f"Combined {lines//4} sequences for barcode {barcode} to {output_file}")
+    return output_file
 
-                # Check if file is gzipped and open accordingly
-                if filename.endswith('.gz'):
-                    print("Processing file: " + filename)
-                    open_func = gzip.open
-                    mode = 'rt'  # Text mode for reading gzipped files
-                else:
-                    open_func = open
-                    mode = 'r'
 
-                with open_func(file_path, mode) as f:
-                    lines = f.readlines()
-                    if barcode not in barcode_to_sequences:
-                        barcode_to_sequences[barcode] = []
-                    barcode_to_sequences[barcode].extend(lines)
+def combine_fastq_files(input_dir, gzip_output=False, threads=1):
+    """
+    Combine all fastq files with the same barcode into a single file
+    """
+    jobs = []
+    for root, _, files in os.walk(input_dir):
+        barcode = os.path.basename(root)
+        # Skip previously combined files of this barcode
+        combined = {f"{barcode}.fastq", f"{barcode}.fastq.gz"}
+        filenames = sorted(filename for filename in files
+                           if (filename.endswith('.fastq') or filename.endswith('.fastq.gz'))
+                           and filename not in combined)
+        if filenames:
+            jobs.append((root, filenames, gzip_output))
 
-        for barcode, sequences in barcode_to_sequences.items():
-            output_file = os.path.join(root, f"{barcode}.fastq")
-            with open(output_file, 'w', encoding='utf-8') as f:
-                f.writelines(sequences)
-            print(f"Combined {len(sequences)//4} sequences for barcode {barcode} to {output_file}")
+    if threads > 1:
+        with Pool(threads) as pool:
+            return pool.starmap(combine_barcode, jobs)
+    return [combine_barcode(*job) for job in jobs]
 
 def main():
     """
@@ -65,7 +122,8 @@ def main():
     input_files = get_files()
     input_dir = input_files["input"][0]
     #unzip_fastq_files(input_dir)
-    combine_fastq_files(input_dir)
+    combine_fastq_files(input_dir, gzip_output=input_files["gzip"],
+                        threads=input_files["threads"])
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,28 @@
-from collections import defaultdict
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from multiprocessing import Pool
 import argparse
+import gzip
+import io
+import json
+import operator
 import os
+import shutil
+import subprocess
+import sys
+import time
+
+# Length of the k-mers used to look up candidate references in a read and the
+# maximum distance between two looked up read positions.
+KMER_SIZE = 24
+MAX_STRIDE = 24
+# Number of FASTQ records sent to a worker process at once.
+BATCH_SIZE = 20000
+# Minimum number of seconds between two progress updates.
+PROGRESS_INTERVAL = 1.0
+
+# Reference index of a worker process, set once by init_worker.
+_worker_index = None
 
 def parse_fasta(fasta_file):
     ref_dict = {}
@@ -28,48 +50,446 @@ def parse_fasta(fasta_file):
     return ref_dict
 
 
-def count_reference_matches_from_fasta(fastq_file, reference_fasta, out_file, matched_fastq=None):
+def build_reference_index(ref_seqs, kmer_size=KMER_SIZE, max_stride=MAX_STRIDE):
+    """
+    Build a k-mer hash index over the reference sequences.
+
+    Every reference is indexed by its k-mers starting at offsets 0 to stride - 1.
+    Any occurrence of a reference in a read therefore contains one indexed k-mer
+    at a read position that is a multiple of the stride, so a read only needs
+    len(read) / stride dictionary lookups instead of one scan per reference.
+
+    Parameters:
+    - ref_seqs (dict): reference name -> reference sequence (see parse_fasta).
+    - kmer_size (int): maximum k-mer length, shortened to the shortest reference.
+    - max_stride (int): maximum distance between looked up read positions.
+
+    Returns:
+    - index (dict): k-mer size, stride, k-mer table, the references and the
+      references of length 0 (which match every read, as with the substring test).
+    """
+    lengths = [len(ref_seq) for ref_seq in ref_seqs.values() if ref_seq]
+    index = {
+        "references": ref_seqs,
+        "kmer_size": 0,
+        "stride": 1,
+        "kmers": {},
+        "always": [ref_name for ref_name, ref_seq in ref_seqs.items() if not ref_seq],
+    }
+    if not lengths:
+        return index
+
+    min_length = min(lengths)
+    kmer_size = min(kmer_size, min_length)
+    stride = min(max_stride, min_length - kmer_size + 1)
+    kmers = defaultdict(list)
+    for ref_name, ref_seq in ref_seqs.items():
+        if not ref_seq:
+            continue
+        for offset in range(stride):
+            kmers[ref_seq[offset:offset + kmer_size]].append((ref_name, ref_seq, offset))
+
+    index["kmer_size"] = kmer_size
+    index["stride"] = stride
+    index["kmers"] = dict(kmers)
+    return index
+
+
+def find_reference_hits(seq, index):
+    """
+    Return the names of all references contained in a read sequence.
+    Gives the same result as testing `ref_seq in seq` for every reference.
+    """
+    hits = set(index["always"])
+    kmers = index["kmers"]
+    if not kmers:
+        return hits
+    kmer_size = index["kmer_size"]
+    for pos in range(0, len(seq) - kmer_size + 1, index["stride"]):
+        candidates = kmers.get(seq[pos:pos + kmer_size])
+        if candidates is None:
+            continue
+        for ref_name, ref_seq, offset in candidates:
+            start = pos - offset
+            if start >= 0 and seq.startswith(ref_seq, start):
+                hits.add(ref_name)
+    return hits
+
+
+def build_seed_index(ref_seqs, max_mismatches):
+    """
+    Build a pigeonhole seed index for mismatch-tolerant read assignment.
+
+    Every reference is split into max_mismatches + 1 non-overlapping seeds of
+    equal length. A read containing a reference with at most max_mismatches
+    substitutions contains at least one of its seeds without error, so the
+    seeds give all candidate alignments.
+
+    Returns:
+    - seed_index (dict): seed length, maximum mismatches and seed table
+      (seed -> list of (reference name, reference sequence, seed offset)).
+    """
+    lengths = [len(ref_seq) for ref_seq in ref_seqs.values()]
+    seed_size = min(lengths) // (max_mismatches + 1) if lengths else 0
+    if seed_size == 0:
+        raise ValueError(f"References are too short for {max_mismatches} mismatches")
+    seeds = defaultdict(list)
+    for ref_name, ref_seq in ref_seqs.items():
+        for offset in range(0, (max_mismatches + 1) * seed_size, seed_size):
+            seeds[ref_seq[offset:offset + seed_size]].append((ref_name, ref_seq, offset))
+    return {"seed_size": seed_size, "max_mismatches": max_mismatches, "seeds": dict(seeds)}
+
+
+def assign_nearest_reference(seq, seed_index):
+    """
+    Assign a read to the reference with the fewest mismatches (Hamming distance),
+    considering every alignment of a reference inside the read.
+
+    Returns:
+    - (reference name, mismatches) if exactly one reference has the lowest number
+      of mismatches, (None, mismatches) if several references are tied and
+      (None, None) if no reference is within the allowed mismatches.
+    """
+    seq = seq.rstrip()
+    seed_size = seed_index["seed_size"]
+    max_mismatches = seed_index["max_mismatches"]
+    seeds = seed_index["seeds"]
+    best = {}
+    checked = set()
+    for pos in range(len(seq) - seed_size + 1):
+        candidates = seeds.get(seq[pos:pos + seed_size])
+        if candidates is None:
+            continue
+        for ref_name, ref_seq, offset in candidates:
+            start = pos - offset
+            end = start + len(ref_seq)
+            if start < 0 or end > len(seq) or (ref_name, start) in checked:
+                continue
+            checked.add((ref_name, start))
+            mismatches = sum(map(operator.ne, seq[start:end], ref_seq))
+            if mismatches <= max_mismatches and mismatches < best.get(ref_name, max_mismatches + 1):
+                best[ref_name] = mismatches
+
+    if not best:
+        return None, None
+    lowest = min(best.values())
+    nearest = [ref_name for ref_name, mismatches in best.items() if mismatches == lowest]
+    if len(nearest) > 1:
+        return None, lowest
+    return nearest[0], lowest
+
+
+def is_gzipped(fileobj):
+    """
+    Check the gzip magic number of a binary stream without consuming it.
+    Works for plain gzip and for bgzip, which writes a series of gzip members.
+    """
+    return fileobj.peek(2)[:2] == b"\x1f\x8b"
+
+
+@contextmanager
+def open_fastq(fastq_file, decompress_threads=0):
+    """
+    Open a FASTQ file for reading as text.
+
+    Gzip and bgzip files are recognised by their magic number and decompressed
+    on the fly. "-" reads from stdin, so the output of e.g. cutadapt can be piped
+    into the script. With decompress_threads > 0 a gzipped file is decompressed
+    by a helper process (pigz with that many threads, otherwise gzip), which runs
+    in parallel to the counting.
+
+    Yields:
+    - fq: the FASTQ file in text mode.
+    - raw: the file on disk, whose tell() gives the number of (compressed) bytes
+      read so far. None for stdin and helper processes.
+    """
+    if fastq_file in (None, "-"):
+        stream = sys.stdin.buffer
+        if is_gzipped(stream):
+            with gzip.open(stream, "rt", encoding="utf-8") as fq:
+                yield fq, None
+        else:
+            yield io.TextIOWrapper(stream, encoding="utf-8"), None
+        return
+
+    command = None
+    with open(fastq_file, "rb") as raw:
+        if not is_gzipped(raw):
+            with io.TextIOWrapper(raw, encoding="utf-8") as fq:
+                yield fq, raw
+            return
+        if decompress_threads > 0:
+            if shutil.which("pigz"):
+                command = ["pigz", "-dc", "-p", str(decompress_threads), fastq_file]
+            elif shutil.which("gzip"):
+                command = ["gzip", "-dc", fastq_file]
+        if command is None:
+            with gzip.open(raw, "rt", encoding="utf-8") as fq:
+                yield fq, raw
+            return
+
+    with subprocess.Popen(command, stdout=subprocess.PIPE) as process:
+        with io.TextIOWrapper(process.stdout, encoding="utf-8") as fq:
+            yield fq, None
+        if process.wait() != 0:
+            raise RuntimeError(f"Decompression of {fastq_file} failed: {' '.join(command)}")
+
+
+def open_output(path):
+    """
+    Open an output file for writing as text, gzip compressed if it ends with .gz.
+    Without a path the output is discarded.
+    """
+    if not path:
+        return open(os.devnull, 'w', encoding="utf-8")
+    if path.endswith(".gz"):
+        return gzip.open(path, 'wt', encoding="utf-8")
+    return open(path, 'w', encoding="utf-8")
+
+
+class ProgressReporter:
+    """
+    Throttled progress line on stderr with reads/sec, match rate and ETA.
+    The ETA is estimated from the bytes read of the input file, if known.
+    """
+
+    def __init__(self, raw=None, total_bytes=None, interval=PROGRESS_INTERVAL, stream=sys.stderr):
+        self.raw = raw
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.stream = stream
+        self.start = time.perf_counter()
+        self.last_update = 0.0
+
+    def update(self, reads, matched, force=False):
+        """
+        Print the progress line, at most once per interval unless forced.
+        """
+        if self.interval is None:
+            return
+        now = time.perf_counter()
+        if not force and now - self.last_update < self.interval:
+            return
+        self.last_update = now
+        elapsed = max(now - self.start, 1e-9)
+        line = (f"{reads:,} reads | {reads / elapsed:,.0f} reads/s | "
+                f"{100 * matched / max(reads, 1):.1f}% matched")
+        if self.raw is not None and self.total_bytes:
+            fraction = min(self.raw.tell() / self.total_bytes, 1.0)
+            if fraction > 0:
+                line += f" | {100 * fraction:.1f}% | ETA {elapsed * (1 - fraction) / fraction:,.0f}s"
+        self.stream.write(f"\r{line}  ")
+        self.stream.flush()
+
+    def close(self, reads, matched):
+        """
+        Print the final progress line.
+        """
+        if self.interval is None:
+            return
+        self.update(reads, matched, force=True)
+        self.stream.write("\n")
+        self.stream.flush()
+
+
+def read_fastq_batches(fq, batch_size=BATCH_SIZE):
+    """
+    Read a FASTQ file in batches of (header, seq, plus, qual) records.
+    """
+    batch = []
+    while True:
+        header = fq.readline()
+        if not header:
+            break
+        seq = fq.readline()
+        plus = fq.readline()
+        qual = fq.readline()
+        batch.append((header, seq, plus, qual))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def count_batch(batch, index):
+    """
+    Count reference matches in a batch of FASTQ records.
+
+    If the index contains a seed index (see build_seed_index), reads without an
+    exact match are assigned to their nearest reference within the allowed
+    mismatches. Reads tied between several references are not assigned.
+
+    Returns:
+    - match_counts (dict): reference name -> number of reads containing it.
+    - approximate_counts (dict): reference name -> number of reads assigned with mismatches.
+    - matched (str): the matched records in FASTQ format, in input order.
+    - stats (dict): number of reads, matched reads, ambiguous reads (reads
+      containing more than one reference), approximately assigned reads and
+      ambiguous approximate reads.
+    """
+    match_counts = defaultdict(int)
+    approximate_counts = defaultdict(int)
+    seed_index = index.get("seed_index")
+    matched = []
+    stats = {"reads": len(batch), "matched_reads": 0, "ambiguous_reads": 0,
+             "approximate_reads": 0, "ambiguous_approximate_reads": 0}
+    for header, seq, plus, qual in batch:
+        hits = find_reference_hits(seq, index)
+        for ref_name in hits:
+            match_counts[ref_name] += 1
+
+        if hits:
+            matched.append(f"{header}{seq}{plus}{qual}")
+            if len(hits) > 1:
+                stats["ambiguous_reads"] += 1
+        elif seed_index is not None:
+            ref_name, mismatches = assign_nearest_reference(seq, seed_index)
+            if ref_name is not None:
+                approximate_counts[ref_name] += 1
+                stats["approximate_reads"] += 1
+                matched.append(f"{header}{seq}{plus}{qual}")
+            elif mismatches is not None:
+                stats["ambiguous_approximate_reads"] += 1
+    stats["matched_reads"] = len(matched)
+    return match_counts, approximate_counts, "".join(matched), stats
+
+
+def init_worker(index):
+    """
+    Store the reference index in a worker process, so it is sent only once.
+    """
+    global _worker_index
+    _worker_index = index
+
+
+def count_batch_in_worker(batch):
+    """
+    Count a batch against the index of the worker process.
+    """
+    return count_batch(batch, _worker_index)
+
+
+def imap_bounded(pool, func, iterable, max_pending):
+    """
+    Ordered pool.imap that keeps at most max_pending tasks in flight, so the
+    input is not read into memory faster than the workers can count it.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def count_reference_matches_from_fasta(fastq_file, reference_fasta, out_file, matched_fastq=None,
+                                       processes=1, batch_size=BATCH_SIZE, decompress_threads=0,
+                                       metrics_file=None, progress_interval=PROGRESS_INTERVAL,
+                                       max_mismatches=0):
+    """
+    Count the reads containing each reference and write a reference,count table.
+    The FASTQ can be plain, gzip/bgzip compressed or "-" for stdin (see open_fastq).
+    With processes > 1 the FASTQ records are counted in batches by a pool of
+    worker processes and the per-batch counts are summed up.
+    Progress is reported on stderr every progress_interval seconds (None to
+    disable) and run metrics are written to metrics_file as JSON, if given.
+    With max_mismatches > 0 reads without an exact match are assigned to their
+    nearest reference and the table gets the columns exact and approximate,
+    count being their sum.
+    """
+    stage_times = {}
+    stage_start = time.perf_counter()
     # Load references from FASTA
     ref_seqs = parse_fasta(reference_fasta)
+    index = build_reference_index(ref_seqs)
+    if max_mismatches > 0:
+        index["seed_index"] = build_seed_index(ref_seqs, max_mismatches)
+    stage_times["load_references"] = time.perf_counter() - stage_start
 
     # Init match counts
     match_counts = defaultdict(int)
-    matched_reads = []
+    approximate_counts = defaultdict(int)
+    totals = defaultdict(int)
 
-    with open(fastq_file, encoding="utf-8") as fq, \
-         open(matched_fastq, 'w', encoding="utf-8") if matched_fastq else open(os.devnull, 'w', encoding="utf-8") as matched_out:
+    stage_start = time.perf_counter()
+    with open_fastq(fastq_file, decompress_threads) as (fq, raw), \
+         open_output(matched_fastq) as matched_out:
 
-        while True:
-            header = fq.readline()
-            if not header:
-                break
-            seq = fq.readline()
-            plus = fq.readline()
-            qual = fq.readline()
-
-            matched = False
-            for ref_name, ref_seq in ref_seqs.items():
-                if ref_seq in seq:
-                    match_counts[ref_name] += 1
-                    matched = True
-                    print(f"Matched {ref_seq} in read: {header.strip()}")
-
-            if matched:
-                matched_out.write(f"{header}{seq}{plus}{qual}")
+        total_bytes = os.path.getsize(fastq_file) if raw is not None else None
+        progress = ProgressReporter(raw, total_bytes, interval=progress_interval)
+        batches = read_fastq_batches(fq, batch_size)
+        if processes > 1:
+            pool = Pool(processes, initializer=init_worker, initargs=(index,))
+            # results come back in batch order, so the matched FASTQ stays in input order
+            results = imap_bounded(pool, count_batch_in_worker, batches, 2 * processes)
+        else:
+            pool = None
+            results = (count_batch(batch, index) for batch in batches)
+        try:
+            for batch_counts, batch_approximate_counts, matched, stats in results:
+                for ref_name, count in batch_counts.items():
+                    match_counts[ref_name] += count
+                for ref_name, count in batch_approximate_counts.items():
+                    approximate_counts[ref_name] += count
+                matched_out.write(matched)
+                for key, value in stats.items():
+                    totals[key] += value
+                progress.update(totals["reads"], totals["matched_reads"])
+        finally:
+            if pool is not None:
+                pool.terminate()
+        progress.close(totals["reads"], totals["matched_reads"])
+    stage_times["counting"] = time.perf_counter() - stage_start
 
     # Write counts to CSV
+    stage_start = time.perf_counter()
     with open(out_file, 'w', encoding="utf-8") as out:
-        out.write("reference,count\n")
-        for ref_name in sorted(ref_seqs):
-            out.write(f"{ref_name},{match_counts.get(ref_name, 0)}\n")
+        if max_mismatches > 0:
+            out.write("reference,count,exact,approximate\n")
+            for ref_name in sorted(ref_seqs):
+                exact = match_counts.get(ref_name, 0)
+                approximate = approximate_counts.get(ref_name, 0)
+                out.write(f"{ref_name},{exact + approximate},{exact},{approximate}\n")
+        else:
+            out.write("reference,count\n")
+            for ref_name in sorted(ref_seqs):
+                out.write(f"{ref_name},{match_counts.get(ref_name, 0)}\n")
+    stage_times["write_counts"] = time.perf_counter() - stage_start
+
+    if metrics_file:
+        metrics = dict(totals)
+        metrics["references"] = len(ref_seqs)
+        metrics["references_with_reads"] = len(set(match_counts) | set(approximate_counts))
+        metrics["processes"] = processes
+        metrics["max_mismatches"] = max_mismatches
+        metrics["stage_seconds"] = stage_times
+        metrics["total_seconds"] = sum(stage_times.values())
+        with open(metrics_file, 'w', encoding="utf-8") as out:
+            json.dump(metrics, out, indent=2)
 
 
 def get_files():
     parser = argparse.ArgumentParser(description='Count reference matches in a FASTQ file.')
-    parser.add_argument('-f', '--fastq_file', help='Input FASTQ file')
+    parser.add_argument('-f', '--fastq_file', default='-',
+                        help='Input FASTQ file, plain or gzip/bgzip compressed (default: - for stdin)')
     parser.add_argument('-s','--sgRNAs_fasta_file', help='fasta file with sgRNA-insert sequences')
     parser.add_argument('-o', '--output', help='Output CSV file for match counts')
-    parser.add_argument('-mf', '--matched_fastq', help='Optional: output FASTQ file of matched reads', default=None)
+    parser.add_argument('-mf', '--matched_fastq', help='Optional: output FASTQ file of matched reads (.gz for compressed output)', default=None)
+    parser.add_argument('-t', '--threads', '--processes', dest='processes', type=int, default=1,
+                        help='Number of worker processes used for counting (default: 1)')
+    parser.add_argument('-b', '--batch_size', type=int, default=BATCH_SIZE,
+                        help=f'Number of reads per worker batch (default: {BATCH_SIZE})')
+    parser.add_argument('-dt', '--decompress_threads', type=int, default=0,
+                        help='Decompress gzipped input in a helper process (pigz with this many threads)')
+    parser.add_argument('-m', '--metrics', default=None,
+                        help='Optional: JSON file with read and timing metrics of the run')
+    parser.add_argument('-mm', '--max_mismatches', type=int, default=0,
+                        help='Assign reads without a perfect match to the nearest reference '
+                             'with up to this many mismatches (default: 0, perfect matches only)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='Do not report the progress on stderr')
     return parser.parse_args()
 
 def main():
@@ -78,7 +498,13 @@ def main():
         fastq_file=infiles.fastq_file,
         reference_fasta=infiles.sgRNAs_fasta_file,
         out_file=infiles.output,
-        matched_fastq=infiles.matched_fastq
+        matched_fastq=infiles.matched_fastq,
+        processes=infiles.processes,
+        batch_size=infiles.batch_size,
+        decompress_threads=infiles.decompress_threads,
+        metrics_file=infiles.metrics,
+        progress_interval=None if infiles.quiet else PROGRESS_INTERVAL,
+        max_mismatches=infiles.max_mismatches
     )
 
 if __name__ == "__main__":
@@ -3,6 +3,7 @@ This script merges a primary table with multiple count tables and saves the outp
 """
 import os
 import argparse
+import sqlite3
 import pandas as pd
 
 
@@ -14,62 +15,104 @@ def parse_arguments():
     parser.add_argument("-r", "--reference", required=True,
                         help="Path to the reference sgRNA - insert file")
     parser.add_argument("-i", "--input", required=True, help="Path to read count files", nargs="+")
-    parser.add_argument("-o", "--output", required=True, help= "Path to output file")
+    parser.add_argument("-o", "--output", required=True,
+                        help="Path to output file (.parquet, .feather, .sqlite/.db, .csv or .xlsx)")
+    parser.add_argument("-x", "--excel", default=None,
+                        help="Optional: additional export of the merged table to an Excel file")
     return parser.parse_args()
 
 
-def merge_with_multiple_files(table1_path, count_files, output_path):
+def read_table(path):
+    """
+    Read a table from an Excel, CSV, Parquet or Feather file.
+    Returns None for unsupported file formats.
+    """
+    if path.endswith(".xlsx") or path.endswith(".xls"):
+        return pd.read_excel(path, engine="openpyxl")
+    if path.endswith(".csv"):
+        return pd.read_csv(path, engine="python")
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    if path.endswith(".feather"):
+        return pd.read_feather(path)
+    return None
+
+
+def write_table(table, output_path):
+    """
+    Write the merged table, the format is chosen by the file extension.
+    SQLite databases get the table "read_counts".
+    """
+    if output_path.endswith(".parquet"):
+        table.to_parquet(output_path, index=False)
+    elif output_path.endswith(".feather"):
+        table.to_feather(output_path)
+    elif output_path.endswith(".sqlite") or output_path.endswith(".db"):
+        with sqlite3.connect(output_path) as connection:
+            table.to_sql("read_counts", connection, if_exists="replace", index=False)
+    elif output_path.endswith(".csv"):
+        table.to_csv(output_path, index=False)
+    else:
+        table.to_excel(output_path, index=False)
+
+
+def merge_with_multiple_files(table1_path, count_files, output_path, excel_path=None):
     """
     Merge a primary table with multiple count tables and save the output.
-    
+    All count columns are collected first and joined to the primary table in one step.
+
     Parameters:
     - table1_path: str, path to the main table (Table 1).
     - count_files: list, paths to the count files (Table 2, etc.).
     - output_path: str, path to save the merged output.
+    - excel_path: str, optional path for an additional Excel export.
     """
     # Load Table 1
-    table1 = pd.read_excel(table1_path,  engine="openpyxl")
+    table1 = read_table(table1_path)
     print(table1.head())
-    # Add "Reference" column to Table 1 based on "oligo no." and "gene"
-    #table1["Reference"] = table1["oligo no."].astype(str) + "_" + table1["gene"]
-
-    # Reorder columns to place "Reference" at the beginning
-    #reordered_columns = ["Reference"] + [col for col in table1.columns if col != "Reference"]
-    #table1 = table1[reordered_columns]
 
-    # Initialize merged table with Table 1
-    merged_table = table1.copy()
-
-    # Process each count file
+    # Collect the count column of each file, indexed by reference
+    count_columns = []
+    column_files = {}
     for count_file in count_files:
         # Extract file name (without extension) to use as column name
         file_name = os.path.splitext(os.path.basename(count_file))[0]
 
-        # Load the count file check if it is a csv or excel file
-        if count_file.endswith(".xlsx") or count_file.endswith(".xls"):
-            count_table = pd.read_excel(count_file, engine="openpyxl")
-        elif count_file.endswith(".csv"):
-            count_table = pd.read_csv(count_file, engine="python")
-        else:
+        count_table = read_table(count_file)
+        if count_table is None:
             print(f"Unsupported file format for {count_file}. Skipping.")
             continue
 
-        # Rename the "Count" column to only include the file name
-        count_table.rename(columns={"count": file_name}, inplace=True)
-
-        # Merge with the primary table using the "Reference" column
-        merged_table = pd.merge(merged_table,
-                                count_table[["reference", file_name]], on="reference", how="left")
-
- 
-    # fill NaN values with 1
-    merged_table.fillna(1, inplace=True)
-    # Replace all 0s with 1s
-    merged_table.replace(0, 1, inplace=True)
-    # Save the merged table to an Excel file
-    merged_table.to_excel(output_path, index=False)
-
+        # every column name and every reference of a file must be unique for the join
+        if file_name in column_files:
+            raise ValueError(f"The count files {column_files[file_name]} and {count_file} "
+                             f"have the same name {file_name}, rename one of them")
+        if file_name in table1.columns:
+            raise ValueError(f"The name of the count file {count_file} is already a column "
+                             f"of {table1_path}, rename the file")
+        column_files[file_name] = count_file
+        repeated = count_table["reference"][count_table["reference"].duplicated()].unique()
+        if len(repeated) > 0:
+            raise ValueError(f"{count_file} has more than one count for the references "
+                             f"{', '.join(map(str, repeated[:10]))}"
+                             f"{' ...' if len(repeated) > 10 else ''}")
+
+        count_columns.append(count_table.set_index("reference")["count"].rename(file_name))
+
+    # Join all count columns to the primary table using the "reference" column
+    merged_table = table1.copy()
+    if count_columns:
+        counts = pd.concat(count_columns, axis=1)
+        merged_table = merged_table.join(counts, on="reference", how="left")
+        count_names = list(counts.columns)
+        # fill NaN values and 0s with 1
+        merged_table[count_names] = merged_table[count_names].fillna(1).replace(0, 1)
+
+    write_table(merged_table, output_path)
     print(f"Merged table saved to {output_path}")
+    if excel_path:
+        merged_table.to_excel(excel_path, index=False)
+        print(f"Merged table exported to {excel_path}")
 
 
 def abspath(path):
@@ -92,7 +135,9 @@ def main():
 
     count_files = input_files  # List of count files
 
-    merge_with_multiple_files(oligo_file, count_files, output)
+    excel = abspath(args.excel) if args.excel else None
+
+    merge_with_multiple_files(oligo_file, count_files, output, excel)
 
 
 if __name__ == "__main__":
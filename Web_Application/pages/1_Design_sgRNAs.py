@@ -3,6 +3,7 @@ File to design sgRNAs and inserts based on a list of mutations and a genome file
 """
 import zipfile
 import os
+import tempfile
 import base64
 import sys
 import io
@@ -12,11 +13,13 @@ import pandas as pd
 from Bio import SeqIO
 sys.path.insert(1, os.path.realpath(os.path.pardir))
 from src.oligos import *
+from src.design_output import DesignWriter, write_oligos
 from src.filter_by_pam import *
 from src.filter_by_codon import *
 from src.generate_reference_files import *
 
-
+# Rows of the designed table shown on the page, the whole table is only read for the filters
+PREVIEW_ROWS = 1000
 
 
 # Function to read Excel file
@@ -34,6 +37,20 @@ def read_excel_file(uploaded_file):
         return None
 
 
+def design_table():
+    """Reads the whole table of the last design from its output folder."""
+    return pd.read_csv(st.session_state.design_csv)
+
+
+def remove_design_output():
+    """Deletes the output folder of the last design."""
+    if st.session_state.get('design_dir') is not None:
+        st.session_state.design_dir.cleanup()
+    st.session_state.design_dir = None
+    st.session_state.design_csv = None
+    st.session_state.design_zip = None
+
+
 EXAMPLE_TABLE = """
 | gene | mutation | aa position |
 |:---------:|:--------:|:--------:|
@@ -127,11 +144,51 @@ if st.session_state.get('df') is not None:
     st.write("### First 5 rows of the uploaded file:")
     st.write(st.session_state.df.head(5))
 
+    with st.expander("Off-target check during the design"):
+        check_off_targets = st.checkbox("Count the off-targets of every base pairing region",
+                                        value=False,
+                                        help="Adds the number of sites in the genome with up \
+                                        to the given number of mismatches, on both strands \
+                                        and without the target site.")
+        off_target_mismatches = st.number_input("Maximum number of mismatches:",
+                                                min_value=0, max_value=4, value=4)
+        drop_off_targets = st.checkbox("Drop sgRNA-insert pairs with too many off-targets",
+                                       value=False)
+        max_off_targets = st.number_input("Maximum number of off-targets:",
+                                          min_value=0, value=0)
+
     # Generate oligos if the button is clicked
     if st.button('Generate oligos'):
         st.write('Processing...')
-        st.session_state.oligos_df, st.session_state.missing_genes = generate_oligos(
-            st.session_state.df, genome_file)
+        # the genes are written to files in a folder of this session as they are designed,
+        # the folder of the previous design is deleted first
+        remove_design_output()
+        st.session_state.design_dir = tempfile.TemporaryDirectory(prefix="linkgenvarphen_design_")
+        output_dir = st.session_state.design_dir.name
+        csv_path = os.path.join(output_dir, "sgRNA_insert_list.csv")
+        fasta_path = os.path.join(output_dir, "reference_file.fasta")
+        bpregion_path = os.path.join(output_dir, "bpregion_file.csv")
+        writer = DesignWriter(csv_file=csv_path, fasta_file=fasta_path,
+                              bpregion_file=bpregion_path)
+        progress_bar = st.progress(0.0)
+        n_genes = st.session_state.df["gene"].nunique()
+        designed = []
+
+        def show_progress(gene):
+            """Update the progress bar after every gene."""
+            designed.append(gene)
+            progress_bar.progress(len(designed) / n_genes,
+                                  text=f"{len(designed)} of {n_genes} genes ({gene})")
+
+        _, st.session_state.missing_genes = write_oligos(
+            st.session_state.df, genome_file, writer, check_off_targets=check_off_targets,
+            max_off_targets=max_off_targets if drop_off_targets else None,
+            off_target_mismatches=off_target_mismatches, progress=show_progress)
+        st.session_state.design_csv = csv_path
+        st.session_state.oligos_df = (pd.read_csv(csv_path, nrows=PREVIEW_ROWS)
+                                      if os.path.getsize(csv_path) > 0 else None)
+        st.session_state.filtered_df = None
+        st.session_state.filtered_df_codon = None
         st.write("Done")
         if len(st.session_state.missing_genes) > 0 :
             st.write("These genes could not be found in the genome file:")
@@ -139,53 +196,32 @@ if st.session_state.get('df') is not None:
                 st.write(value)
             #st.write(st.session_state.missing_genes)
         st.write("### Results:")
+        if writer.rows > PREVIEW_ROWS:
+            st.write(f"First {PREVIEW_ROWS} of {writer.rows} sgRNA-insert pairs, "
+                     "download the ZIP file for the whole table:")
         st.write(st.session_state.oligos_df)
         st.write("Please double check the resulting table for any errors before ordering the DNA oligomers. If you encounter any issues please contact us.")
 
-        #set up fasta file and protospacer list
-        fasta_output_path = "reference_file.fasta"
-
-        # Create the FASTA file and protospacer DataFrame
-        (st.session_state.reference_file,
-         st.session_state.proto_file) = create_fasta_and_protospacer_file(
-            st.session_state.oligos_df,fasta_output_path)
-
-        # Write DataFrame to temporary Excel file
-        temp_file_path = "sgRNA_insert_list.csv"
-        st.session_state.oligos_df.to_csv(temp_file_path, index=False)
-
-        # Create an in-memory ZIP file
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w") as zip_file:
-        # Save DataFrame to Excel in memory
-            csv_buffer = io.BytesIO()
-            st.session_state.oligos_df.to_csv(csv_buffer, index=False)
-            csv_buffer.seek(0)
-            zip_file.writestr("sgRNA_insert_list.csv", csv_buffer.read())
-       # Add reference file to the ZIP
-            with open(st.session_state.reference_file, "rb") as ref_file:
-                zip_file.writestr("reference_file.fasta", ref_file.read())
-        # Add protospacer DataFrame to the ZIP
-            proto_buffer = io.BytesIO()
-            st.session_state.proto_file.to_csv(proto_buffer, index=False)
-            proto_buffer.seek(0)
-            zip_file.writestr("bpregion_file.csv", proto_buffer.read())
-        # Reset buffer position to the beginning
-        zip_buffer.seek(0)
-
-        # Encode ZIP file for download
-        zip_file_content = zip_buffer.read()
-        zip_file_encoded = base64.b64encode(zip_file_content).decode('utf-8')
-        download_button = f'<a href="data:application/zip;base64,{zip_file_encoded}" download="results.zip">Download Results as ZIP</a>'
-        st.markdown(download_button, unsafe_allow_html=True)
+        # Create the ZIP file from the written files
+        st.session_state.design_zip = os.path.join(output_dir, "results.zip")
+        with zipfile.ZipFile(st.session_state.design_zip, "w") as zip_file:
+            zip_file.write(csv_path, "sgRNA_insert_list.csv")
+            zip_file.write(fasta_path, "reference_file.fasta")
+            zip_file.write(bpregion_path, "bpregion_file.csv")
+
+    if st.session_state.get('design_zip') is not None:
+        with open(st.session_state.design_zip, "rb") as zip_file:
+            st.download_button("Download Results as ZIP", zip_file, file_name="results.zip",
+                               mime="application/zip")
 
 # Show filtering options only after oligos are generated
     if st.session_state.get('oligos_df') is not None:
     # Initialize session state for filtered data and thresholds
+        # None stands for the whole, unfiltered table
         if 'filtered_df' not in st.session_state:
-            st.session_state.filtered_df = st.session_state.oligos_df
+            st.session_state.filtered_df = None
         if 'filtered_df_codon' not in st.session_state:
-            st.session_state.filtered_df_codon = st.session_state.oligos_df
+            st.session_state.filtered_df_codon = None
         if 'filter_threshold_pam' not in st.session_state:
             st.session_state.filter_threshold_pam = 1
         if 'filter_threshold_codon' not in st.session_state:
@@ -212,17 +248,20 @@ if st.session_state.get('df') is not None:
             if st.button('Filter by PAM'):
                 if filter_threshold_pam != st.session_state.filter_threshold_pam:
                     st.session_state.filter_threshold_pam = filter_threshold_pam
-                    st.session_state.filtered_df = filter_pam(st.session_state.oligos_df,
+                    st.session_state.filtered_df = filter_pam(design_table(),
                                                               filter_threshold_pam)
+                filtered_df = st.session_state.filtered_df
+                if filtered_df is None:
+                    filtered_df = design_table()
 
         # Display filtered data
-                if st.session_state.filtered_df.empty:
+                if filtered_df.empty:
                     st.write("No rows match the filter criteria.")
                 else:
                     st.write("First five rows of the filtered table:")
-                    st.write(st.session_state.filtered_df.head(5))
+                    st.write(filtered_df.head(5))
                     temp_file_path = "output_filtered_by_pam.csv"
-                    st.session_state.filtered_df.to_csv(temp_file_path, index=False)
+                    filtered_df.to_csv(temp_file_path, index=False)
             # Set up download button
                     with open(temp_file_path, "rb") as file:
                         file_content = file.read()
@@ -248,17 +287,20 @@ if st.session_state.get('df') is not None:
             if st.button('Filter by Codon'):
                 if filter_threshold_codon != st.session_state.filter_threshold_codon:
                     st.session_state.filter_threshold_codon = filter_threshold_codon
-                    st.session_state.filtered_df_codon = filter_codon(st.session_state.oligos_df,
+                    st.session_state.filtered_df_codon = filter_codon(design_table(),
                                                                       filter_threshold_codon)
+                filtered_df_codon = st.session_state.filtered_df_codon
+                if filtered_df_codon is None:
+                    filtered_df_codon = design_table()
 
         # Display filtered data
-                if st.session_state.filtered_df_codon.empty:
+                if filtered_df_codon.empty:
                     st.write("No rows match the filter criteria.")
                 else:
                     st.write("First five rows of the filtered table:")
-                    st.write(st.session_state.filtered_df_codon.head(5))
+                    st.write(filtered_df_codon.head(5))
                     temp_file_path = "output_filtered_by_codon.csv"
-                    st.session_state.filtered_df_codon.to_csv(temp_file_path, index=False)
+                    filtered_df_codon.to_csv(temp_file_path, index=False)
                 # Set up download button
                     with open(temp_file_path, "rb") as file:
                         file_content = file.read()
@@ -269,9 +311,10 @@ if st.session_state.get('df') is not None:
     if st.button('Clear Tables'):
         st.session_state.df = None
         st.session_state.oligos_df = None
+        remove_design_output()
         st.write("Tables cleared.")
 # Add button to clear the filtered tables
     if st.button('Clear Filtered Tables'):
-        st.session_state.filtered_df = st.session_state.oligos_df
-        st.session_state.filtered_df_codon = st.session_state.oligos_df
+        st.session_state.filtered_df = None
+        st.session_state.filtered_df_codon = None
         st.write("Filtered tables cleared.")
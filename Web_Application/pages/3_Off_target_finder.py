@@ -7,12 +7,25 @@ import os
 import sys
 import base64
 import io
+import time
 from io import BytesIO
 from Bio import SeqIO
 import pandas as pd
 import streamlit as st
 
-from src.off_target_finder import off_target
+from src.off_target_finder import (iter_off_targets, off_target_rows, highlight_protospacers,
+                                   off_target_summary_rows, summary_columns, write_hits,
+                                   off_target_genomes, OFF_TARGET_COLUMNS)
+
+# Seconds between updates of the partial results download
+PARTIAL_DOWNLOAD_INTERVAL = 5
+
+# Genomes provided with the application
+PROVIDED_GENOMES = {"E. coli BW25113": "Web_Application/data/BW25113.gb",
+                    "E. coli K-12 substr. MG1655": "Web_Application/data/MG1655.gb",
+                    "S. aureus USA 300": "Web_Application/data/saureus_USA300_FPR3757.gb",
+                    "P. aeruginosa PA01": "Web_Application/data/pa01.gb",
+                    "P. aeruginosa PA14": "Web_Application/data/pa14.gb"}
 
 def read_file(input_file):
     """
@@ -46,7 +59,9 @@ with st.expander(" 🔍 Detailed Description"):
         "This function can be used to find potential off targets for designed base \
         pairing regions. \
         They are checked against the whole genome of your target organism and all\
-        sequences with upto 4 mismatches are reported back. As each base pairing region is \
+        sequences with upto 4 mismatches on both strands are reported back, together with \
+        the strand and the PAM next to the binding site. Optionally only binding sites next \
+        to a PAM are reported. As each base pairing region is \
         checked against the whole genome, this function can take a while to run. We recommend \
         to run this function with a small number of base pairing regions at a time."
     )
@@ -59,6 +74,7 @@ genome_choice = st.radio("Choose an option:",
 
 if genome_choice == "Upload your own genome file":
     GENOME_FILE = st.file_uploader("Upload genome", type=["gb"])
+    GENOME_FILES = {"genome": GENOME_FILE} if GENOME_FILE is not None else {}
     if GENOME_FILE is not None:
         st.write("Genome file uploaded successfully!")
 
@@ -71,36 +87,22 @@ if genome_choice == "Upload your own genome file":
         except (ValueError, IOError) as e:
             st.error(f"An error occurred while parsing the genome file: {e}")
 else:
-    selected_genome = st.selectbox("Select a provided genome:",
-                                   ["E. coli BW25113", "E. coli K-12 substr. MG1655",
-                                    "S. aureus USA 300", "P. aeruginosa PA01",
-                                    "P. aeruginosa PA14"])
-    # Load the selected provided genome
-    if selected_genome == "E. coli BW25113":
-        GENOME_FILE = "Web_Application/data/BW25113.gb"
-
-    elif selected_genome == "E. coli K-12 substr. MG1655":
-        GENOME_FILE = "Web_Application/data/MG1655.gb"
-
-    elif selected_genome == "S. aureus USA 300":
-        GENOME_FILE= "Web_Application/data/saureus_USA300_FPR3757.gb"
-
-    elif selected_genome == "P. aeruginosa PA01":
-        GENOME_FILE= "Web_Application/data/pa01.gb"
-
-    elif selected_genome == "P. aeruginosa PA14":
-        GENOME_FILE= "Web_Application/data/pa14.gb"
-
-
-    # Parse the uploaded genome file
-    try:
-        record = SeqIO.read(GENOME_FILE, "genbank")
-        st.write("Genome information:")
-        st.write(f"Name: {record.name}")
-        st.write(f"Description: {record.description}")
+    selected_genomes = st.multiselect("Select one or more provided genomes:",
+                                      list(PROVIDED_GENOMES), default=["E. coli BW25113"])
+    # Load the selected provided genomes
+    GENOME_FILES = {name: PROVIDED_GENOMES[name] for name in selected_genomes}
+    GENOME_FILE = GENOME_FILES[selected_genomes[0]] if selected_genomes else None
+
+    # Parse the selected genome files
+    for GENOME_PATH in GENOME_FILES.values():
+        try:
+            record = SeqIO.read(GENOME_PATH, "genbank")
+            st.write("Genome information:")
+            st.write(f"Name: {record.name}")
+            st.write(f"Description: {record.description}")
 
-    except (ValueError, IOError) as e:
-        st.error(f"An error occurred while parsing the genome file: {e}")
+        except (ValueError, IOError) as e:
+            st.error(f"An error occurred while parsing the genome file: {e}")
 
     st.subheader("Please upload your list of base pairing regions:")
     st.write("Upload your file containing the base pairing regions file below:")
@@ -114,22 +116,135 @@ else:
     else:
         st.write("Please upload a file to get started.")
 
-    if st.button('Find off targets:'):
+    with st.expander("Search settings"):
+        engine = st.selectbox("Search engine:", ["seed", "scan", "regex"],
+                              help="All engines report the same off-targets. The seed engine \
+                              indexes the genome once, the scan engine compares each base \
+                              pairing region to the whole genome with NumPy.")
+        memory_budget = st.number_input("Memory budget of the scan engine (MB):",
+                                        min_value=16, max_value=4096, value=256, step=16)
+        strands = st.radio("Strands:", ["both", "forward"],
+                           help="Search the base pairing regions on both strands of the genome \
+                           or only on the forward strand.")
+        pam = st.text_input("Required PAM (IUPAC, e.g. NGG, empty for none):", value="")
+        seed_weight = st.number_input("Weight of mismatches in the 12 nt next to the PAM:",
+                                      min_value=1, max_value=10, value=1)
+        summary = st.checkbox("Summary per base pairing region", value=False,
+                              help="Number of hits per number of mismatches, specificity score \
+                              and the closest off-targets instead of one row per hit.")
+        keep_hits = False
+        if summary:
+            keep_hits = st.checkbox("Also provide the full list of off-targets (Parquet)",
+                                    value=False)
+
+    find_off_targets = st.button('Find off targets:')
+    if find_off_targets and not GENOME_FILES:
+        st.warning("Please select at least one genome.")
+    elif find_off_targets and len(GENOME_FILES) > 1:
+        # Several genomes: one summary row per reference with columns per genome
         if st.session_state.df is not None:
             st.write('Processing...')
-
-         # Generate oligos
-            st.session_state.offtargets_df = off_target(st.session_state.df, GENOME_FILE)
+            n_searches = st.session_state.df['base pairing region'].nunique() * len(GENOME_FILES)
+            progress_bar = st.progress(0.0, text="Starting the search...")
+            start_time = time.time()
+
+            def show_progress(done):
+                """
+                Update the progress bar with the number of searches per second.
+                """
+                speed = done / max(time.time() - start_time, 1e-6)
+                progress_bar.progress(done / n_searches,
+                                      text=f"{done} of {n_searches} base pairing regions and "
+                                      f"genomes searched ({speed:.1f} per second)")
+
+            st.session_state.offtargets_df = off_target_genomes(
+                st.session_state.df, GENOME_FILES, engine=engine,
+                memory_budget=memory_budget * 1024 * 1024, strands=strands,
+                pam=pam.strip() or None, seed_weight=seed_weight, progress=show_progress)
+            st.write("Done")
+            st.write("### Results:")
+            st.dataframe(st.session_state.offtargets_df)
+            csv_encoded = base64.b64encode(st.session_state.offtargets_df.to_csv(
+                index=False).encode("utf-8")).decode('utf-8')
+            st.markdown(f'<a href="data:text/csv;base64,{csv_encoded}" '
+                        f'download="offtarget_summary.csv">Download summary</a>',
+                        unsafe_allow_html=True)
+    elif find_off_targets:
+        if st.session_state.df is not None:
+            st.write('Processing...')
+            n_protospacers = st.session_state.df['base pairing region'].nunique()
+            progress_bar = st.progress(0.0, text="Starting the search...")
+            partial_download = st.empty()
+            st.session_state.offtarget_results = {}
+            columns = summary_columns() if summary else OFF_TARGET_COLUMNS
+            hits = {}
+            start_time = time.time()
+            last_download = start_time
+
+            # Show the results of every base pairing region as soon as it is searched
+            for protospacer, references, targets in iter_off_targets(
+                    st.session_state.df, GENOME_FILE, engine=engine,
+                    memory_budget=memory_budget * 1024 * 1024, strands=strands,
+                    pam=pam.strip() or None, seed_weight=seed_weight):
+                results = st.session_state.offtarget_results
+                if not summary or keep_hits:
+                    hits[protospacer] = off_target_rows(protospacer, references, targets)
+                if summary:
+                    results[protospacer] = off_target_summary_rows(protospacer, references,
+                                                                   targets)
+                else:
+                    results[protospacer] = hits[protospacer]
+                speed = len(results) / max(time.time() - start_time, 1e-6)
+                progress_bar.progress(len(results) / n_protospacers,
+                                      text=f"{len(results)} of {n_protospacers} base pairing "
+                                      f"regions searched ({speed:.1f} per second)")
+                if time.time() - last_download > PARTIAL_DOWNLOAD_INTERVAL:
+                    partial_df = pd.DataFrame([row for rows in results.values() for row in rows],
+                                              columns=columns)
+                    csv_encoded = base64.b64encode(
+                        partial_df.to_csv(index=False).encode("utf-8")).decode('utf-8')
+                    partial_download.markdown(
+                        f'<a href="data:text/csv;base64,{csv_encoded}" '
+                        f'download="partial_offtargets.csv">Download partial results '
+                        f'({len(results)} base pairing regions)</a>', unsafe_allow_html=True)
+                    last_download = time.time()
+            partial_download.empty()
+
+            order = dict.fromkeys(st.session_state.df['base pairing region'])
+            data = []
+            for protospacer in order:
+                data.extend(st.session_state.offtarget_results[protospacer])
             st.write("Done")
             st.write("### Results:")
-            st.write(st.session_state.offtargets_df)
-            # Write DataFrame to temporary Excel file
-            TEMP_FILE_PATH = "output_offtargets.xlsx"
-            st.session_state.offtargets_df.to_excel(TEMP_FILE_PATH, index=False)
-         # Set up download button
-            with open(TEMP_FILE_PATH, "rb") as file:
-                file_content = file.read()
-                file_encoded = base64.b64encode(file_content).decode('utf-8')
-                download_button = f'<a href="data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,\
-                {file_encoded}" download="output_offtargets.xlsx">Download data</a>'
-                st.markdown(download_button, unsafe_allow_html=True)
+            if summary:
+                st.session_state.offtargets_df = pd.DataFrame(data, columns=columns)
+                st.dataframe(st.session_state.offtargets_df)
+                csv_encoded = base64.b64encode(st.session_state.offtargets_df.to_csv(
+                    index=False).encode("utf-8")).decode('utf-8')
+                st.markdown(f'<a href="data:text/csv;base64,{csv_encoded}" '
+                            f'download="offtarget_summary.csv">Download summary</a>',
+                            unsafe_allow_html=True)
+                if keep_hits:
+                    TEMP_FILE_PATH = "output_offtargets.parquet"
+                    write_hits(pd.DataFrame([row for protospacer in order
+                                             for row in hits[protospacer]],
+                                            columns=OFF_TARGET_COLUMNS), TEMP_FILE_PATH)
+                    with open(TEMP_FILE_PATH, "rb") as file:
+                        file_encoded = base64.b64encode(file.read()).decode('utf-8')
+                    st.markdown(f'<a href="data:application/octet-stream;base64,{file_encoded}" '
+                                f'download="output_offtargets.parquet">Download all off-targets'
+                                f'</a>', unsafe_allow_html=True)
+            else:
+                st.session_state.offtargets_df = highlight_protospacers(
+                    pd.DataFrame(data, columns=OFF_TARGET_COLUMNS))
+                st.write(st.session_state.offtargets_df)
+                # Write DataFrame to temporary Excel file
+                TEMP_FILE_PATH = "output_offtargets.xlsx"
+                st.session_state.offtargets_df.to_excel(TEMP_FILE_PATH, index=False)
+             # Set up download button
+                with open(TEMP_FILE_PATH, "rb") as file:
+                    file_content = file.read()
+                    file_encoded = base64.b64encode(file_content).decode('utf-8')
+                    download_button = f'<a href="data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,\
+                    {file_encoded}" download="output_offtargets.xlsx">Download data</a>'
+                    st.markdown(download_button, unsafe_allow_html=True)
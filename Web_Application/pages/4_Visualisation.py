@@ -27,8 +27,8 @@ with st.expander(" :bar_chart: Detailed Description"):
 # File uploader for the merged data file
 st.subheader(" Upload your merged read count file")
 uploaded_file = st.file_uploader(
-    "Upload a merged file (Excel, CSV, or TSV format).",
-    type=["xlsx", "xls", "csv", "tsv"],
+    "Upload a merged file (Excel, CSV, TSV, Parquet or Feather format).",
+    type=["xlsx", "xls", "csv", "tsv", "parquet", "feather"],
 )
 
 # Proceed if a file is uploaded
@@ -40,8 +40,12 @@ if uploaded_file:
         df = pd.read_csv(uploaded_file)
     elif uploaded_file.name.endswith(".tsv"):
         df = pd.read_csv(uploaded_file, sep="\t")
+    elif uploaded_file.name.endswith(".parquet"):
+        df = pd.read_parquet(uploaded_file)
+    elif uploaded_file.name.endswith(".feather"):
+        df = pd.read_feather(uploaded_file)
     else:
-        st.error("Unsupported file format! Please upload an Excel, CSV, or TSV file.")
+        st.error("Unsupported file format! Please upload an Excel, CSV, TSV, Parquet or Feather file.")
         st.stop()
 
     # Display the uploaded dataframe
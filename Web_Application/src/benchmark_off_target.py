@@ -0,0 +1,262 @@
+"""
+Benchmark of the off-target finder on synthetic genomes.
+A random or repeat-rich genome and a set of base pairing regions are generated, every engine of
+off_target is timed in its own process (so that the peak memory of each run can be measured),
+a subset of the base pairing regions is also searched with process_protospacer, and all results
+are compared. The report is written as JSON: base pairing regions per second, peak RSS,
+seed index and pool start-up times, and whether the engines agree.
+
+Run from the Web_Application folder:
+python -m src.benchmark_off_target -s 1000000 -n 10000 -o benchmark.json
+"""
+import argparse
+import hashlib
+import io
+import contextlib
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+from multiprocessing import Pipe, Process
+import pandas as pd
+from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from src.genome_index import reverse_complement
+from src.off_target_finder import (off_target, process_protospacer, worker_state,
+                                   prepare_seed_indexes, start_workers)
+
+
+def get_args():
+    """
+    Parse command-line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the off-target finder on '
+                                                 'synthetic genomes')
+    parser.add_argument('-s', '--genome_size', type=int, default=1000000,
+                        help='length of the synthetic genome in nt (default: 1000000)')
+    parser.add_argument('-r', '--repeat_fraction', type=float, default=0.0,
+                        help='fraction of the genome made of repeats (default: 0, random genome)')
+    parser.add_argument('-n', '--guides', type=int, default=10000,
+                        help='number of base pairing regions (default: 10000)')
+    parser.add_argument('-l', '--length', type=int, default=20,
+                        help='length of the base pairing regions (default: 20)')
+    parser.add_argument('-e', '--engines', nargs='+', default=["seed", "scan"],
+                        help='engines of off_target to time (default: seed scan)')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='number of worker processes (default: all cores)')
+    parser.add_argument('-rg', '--regex_guides', type=int, default=20,
+                        help='base pairing regions also searched with process_protospacer '
+                             '(default: 20)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed (default: 1)')
+    parser.add_argument('-o', '--output', default="benchmark_off_target.json",
+                        help='path of the JSON report')
+    return parser.parse_args()
+
+
+def mutate(sequence, rate, rng):
+    """
+    Copy of a sequence with a fraction rate of substituted nucleotides.
+    """
+    sequence = list(sequence)
+    for position in range(len(sequence)):
+        if rng.random() < rate:
+            sequence[position] = rng.choice("ACGT".replace(sequence[position], ""))
+    return "".join(sequence)
+
+
+def make_genome(size, repeat_fraction=0.0, seed=1):
+    """
+    Random genome of the given size. With repeat_fraction > 0, that part of the genome
+    consists of diverged copies (2% substitutions) of a few repeat families and
+    of low complexity stretches, inserted at random positions on both strands.
+    """
+    rng = random.Random(seed)
+    parts = []
+    repeat_length = int(size * repeat_fraction)
+    families = ["".join(rng.choice("ACGT") for _ in range(rng.randint(300, 3000)))
+                for _ in range(20)]
+    while repeat_length > 0:
+        if rng.random() < 0.1:
+            unit = rng.choice(["A", "AT", "CAG", "GATC"])
+            repeat = (unit * (rng.randint(50, 500) // len(unit) + 1))
+        else:
+            repeat = mutate(rng.choice(families), 0.02, rng)
+            if rng.random() < 0.5:
+                repeat = reverse_complement(repeat)
+        repeat = repeat[:repeat_length]
+        parts.append(repeat)
+        repeat_length -= len(repeat)
+    random_length = size - sum(len(part) for part in parts)
+    # split the random sequence into stretches between the repeats
+    cuts = sorted(rng.randint(0, random_length) for _ in range(len(parts)))
+    starts = [0] + cuts
+    ends = cuts + [random_length]
+    genome = []
+    for index, (start, end) in enumerate(zip(starts, ends)):
+        genome.append("".join(rng.choice("ACGT") for _ in range(end - start)))
+        if index < len(parts):
+            genome.append(parts[index])
+    return "".join(genome)
+
+
+def make_guides(genome, number, length=20, seed=1):
+    """
+    Base pairing regions: half taken from the genome (on both strands, some with
+    up to 3 substitutions), half random.
+    """
+    rng = random.Random(seed)
+    guides = []
+    for index in range(number):
+        if index % 2 == 0:
+            start = rng.randrange(len(genome) - length)
+            guide = genome[start:start + length]
+            if rng.random() < 0.5:
+                guide = reverse_complement(guide)
+            if rng.random() < 0.3:
+                guide = mutate(guide, 3 / length, rng)
+        else:
+            guide = "".join(rng.choice("ACGT") for _ in range(length))
+        guides.append(guide)
+    return pd.DataFrame({"reference": [f"{index}_synthetic" for index in range(number)],
+                         "base pairing region": guides})
+
+
+def write_genome(genome, path):
+    """
+    Write the genome as GenBank file, the input format of the off-target finder.
+    """
+    record = SeqRecord(Seq(genome), id="synthetic", name="synthetic",
+                       description="synthetic benchmark genome",
+                       annotations={"molecule_type": "DNA"})
+    SeqIO.write(record, path, "genbank")
+
+
+def table_digest(df):
+    """
+    Checksum of an off-target table, independent of the row order.
+    """
+    rows = sorted(df.astype(str).itertuples(index=False, name=None))
+    return hashlib.sha256(json.dumps(rows).encode("utf-8")).hexdigest()
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """
+    Peak resident memory in MB (ru_maxrss is in kB on Linux).
+    """
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def run_engine(connection, protospacers, genome_file, engine, processes):
+    """
+    Time off_target with one engine, runs in its own process and sends the
+    measurements through connection.
+    """
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        df = off_target(protospacers, genome_file, engine=engine, cache_file=None,
+                        processes=processes).data
+    seconds = time.perf_counter() - start
+    n_guides = protospacers['base pairing region'].nunique()
+    connection.send({"seconds": round(seconds, 3),
+                     "guides_per_second": round(n_guides / seconds, 2),
+                     "hits": int((df['Mismatches'] != "None").sum()),
+                     "digest": table_digest(df),
+                     "peak_rss_mb": round(peak_rss_mb(), 1),
+                     "workers_peak_rss_mb": round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1)})
+    connection.close()
+
+
+def time_engine(protospacers, genome_file, engine, processes):
+    """
+    Run run_engine in a new process, so the peak RSS belongs to this engine only.
+    """
+    receiver, sender = Pipe(duplex=False)
+    process = Process(target=run_engine, args=(sender, protospacers, genome_file, engine,
+                                               processes))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def time_pool_overhead(genome, processes):
+    """
+    Seconds to build the seed index and to start and stop a worker pool with the genome,
+    the fixed costs of every off_target run.
+    """
+    processes = processes or os.cpu_count() or 1
+    start = time.perf_counter()
+    state = worker_state({"genome": genome}, "seed")
+    prepare_seed_indexes(state, [20])
+    index_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    pool = start_workers(processes, state)
+    pool.map(abs, range(processes))
+    pool.terminate()
+    pool.join()
+    return {"seed_index_seconds": round(index_seconds, 3),
+            "pool_start_seconds": round(time.perf_counter() - start, 3),
+            "processes": processes}
+
+
+def time_process_protospacer(protospacers, genome, genome_file, engines):
+    """
+    Time process_protospacer on a few base pairing regions (forward strand) and check
+    that every engine finds the same hits for them.
+    """
+    start = time.perf_counter()
+    expected = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _, row in protospacers.iterrows():
+            reference, protospacer = row['reference'], row['base pairing region']
+            for target in process_protospacer(reference, protospacer, genome)[2]:
+                expected.append((reference, protospacer, *target))
+    seconds = time.perf_counter() - start
+    report = {"guides": len(protospacers), "seconds": round(seconds, 3),
+              "guides_per_second": round(len(protospacers) / seconds, 2) if seconds else None,
+              "agrees": {}}
+    for engine in engines:
+        with contextlib.redirect_stdout(io.StringIO()):
+            df = off_target(protospacers, genome_file, engine=engine, strands="forward",
+                            cache_file=None, processes=1).data
+        df = df[df['Mismatches'] != "None"]
+        found = [tuple(row[:5]) for row in df.itertuples(index=False, name=None)]
+        report["agrees"][engine] = sorted(found) == sorted(expected)
+    return report
+
+
+def main():
+    """
+    Generate the synthetic data, run the benchmark and write the report.
+    """
+    args = get_args()
+    genome = make_genome(args.genome_size, args.repeat_fraction, args.seed)
+    protospacers = make_guides(genome, args.guides, args.length, args.seed)
+    report = {"parameters": vars(args), "engines": {}}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        genome_file = os.path.join(temp_dir, "synthetic.gb")
+        write_genome(genome, genome_file)
+
+        report["overhead"] = time_pool_overhead(genome, args.processes)
+        print(f"Overhead: {report['overhead']}")
+        for engine in args.engines:
+            report["engines"][engine] = time_engine(protospacers, genome_file, engine,
+                                                    args.processes)
+            print(f"{engine}: {report['engines'][engine]}")
+        report["process_protospacer"] = time_process_protospacer(
+            protospacers.head(args.regex_guides), genome, genome_file, args.engines)
+        print(f"process_protospacer: {report['process_protospacer']}")
+
+    digests = {result["digest"] for result in report["engines"].values()}
+    report["engines_agree"] = len(digests) <= 1
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Report has been written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
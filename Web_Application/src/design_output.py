@@ -0,0 +1,214 @@
+"""
+Streaming output of the sgRNA-insert pair design, for genome-wide libraries.
+The oligo tables of the genes (see iter_oligos) are appended to CSV, FASTA and Parquet files
+while the design runs, so the library is never held in memory as a whole. After every batch
+the completed genes and the size of the files are recorded in a progress file, and a run
+that was interrupted continues after the last recorded gene.
+
+Run from the Web_Application folder:
+python -m src.design_output -i mutations.xlsx -g data/BW25113.gb -o library --fasta --parquet
+"""
+import argparse
+import glob
+import json
+import os
+import pandas as pd
+
+from src.oligos import iter_oligos
+from src.generate_reference_files import BPREGION_COLUMNS
+
+# Rows collected before they are written, also the size of the Parquet parts
+BATCH_ROWS = 10000
+
+
+class DesignWriter:
+    """
+    Appends the oligo tables of the designed genes to the output files.
+
+    - csv_file: table of all sgRNA-insert pairs, as generate_oligos.
+    - fasta_file: oligos named by their reference, as create_fasta_and_protospacer_file.
+    - bpregion_file: table of the base pairing regions, as create_fasta_and_protospacer_file.
+    - parquet_dir: folder with one Parquet file per batch, read with pd.read_parquet(parquet_dir).
+    - progress_file: JSON file with the completed and missing genes, the number of rows,
+      the size of the text files and the number of Parquet parts after the last batch.
+
+    With resume, the outputs are cut back to the last batch of the progress file and
+    done_genes and rows tell iter_oligos where to continue. Otherwise existing outputs
+    are replaced. parameters (e.g. the input files and settings) are stored in the
+    progress file, a run with other parameters is not resumed.
+    """
+
+    def __init__(self, csv_file=None, fasta_file=None, bpregion_file=None, parquet_dir=None,
+                 progress_file=None, resume=False, parameters=None, batch_rows=BATCH_ROWS):
+        self.files = {name: path for name, path in [("csv", csv_file), ("fasta", fasta_file),
+                                                    ("bpregion", bpregion_file)] if path}
+        self.parquet_dir = parquet_dir
+        outputs = list(self.files.values()) + ([parquet_dir] if parquet_dir else [])
+        if not outputs:
+            raise ValueError("No output file given")
+        self.progress_file = progress_file or f"{outputs[0]}.progress.json"
+        self.parameters = parameters or {}
+        self.batch_rows = batch_rows
+        self.batch = []
+        self.batch_genes = []
+        self.batch_missing = []
+        self.done_genes = []
+        self.missing_genes = []
+        self.rows = 0
+        self.parts = 0
+        self.sizes = {name: 0 for name in self.files}
+
+        if resume and os.path.exists(self.progress_file):
+            with open(self.progress_file, "r", encoding="utf-8") as file:
+                progress = json.load(file)
+            if progress["parameters"] != self.parameters:
+                raise ValueError(f"{self.progress_file} belongs to a design with other "
+                                 f"parameters: {progress['parameters']}")
+            self.done_genes = progress["genes"]
+            self.missing_genes = progress["missing"]
+            self.rows = progress["rows"]
+            self.parts = progress["parts"]
+            self.sizes = {name: progress["sizes"].get(name, 0) for name in self.files}
+        # remove what was written after the last recorded batch
+        for name, path in self.files.items():
+            with open(path, "ab") as file:
+                file.truncate(self.sizes[name])
+        if parquet_dir:
+            os.makedirs(parquet_dir, exist_ok=True)
+            for path in glob.glob(os.path.join(parquet_dir, "part-*.parquet")):
+                if int(os.path.basename(path)[5:-8]) >= self.parts:
+                    os.remove(path)
+        # record the state now, a progress file of an earlier run must not be resumed
+        self.flush()
+
+    def write(self, gene, oligo_df):
+        """
+        Add the oligo table of a gene, None for a gene which is not in the genome file.
+        """
+        if oligo_df is None:
+            self.batch_missing.append(gene)
+        else:
+            self.batch_genes.append(gene)
+            if len(oligo_df) > 0:
+                self.batch.append(oligo_df)
+        if sum(len(batch_df) for batch_df in self.batch) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the collected tables and record the progress.
+        """
+        if self.batch:
+            batch_df = pd.concat(self.batch, axis=0, ignore_index=True)
+            if "csv" in self.files:
+                batch_df.to_csv(self.files["csv"], mode="a", header=self.sizes["csv"] == 0,
+                                index=False)
+            if "bpregion" in self.files:
+                batch_df[BPREGION_COLUMNS].to_csv(self.files["bpregion"], mode="a",
+                                                  header=self.sizes["bpregion"] == 0,
+                                                  index=False)
+            if "fasta" in self.files:
+                with open(self.files["fasta"], "a", encoding="utf-8") as file:
+                    file.writelines(f">{reference}\n{str(oligo).upper()}\n" for reference, oligo
+                                    in zip(batch_df["reference"], batch_df["oligo"]))
+            if self.parquet_dir:
+                batch_df.to_parquet(os.path.join(self.parquet_dir,
+                                                 f"part-{self.parts:05d}.parquet"), index=False)
+                self.parts += 1
+            self.rows += len(batch_df)
+            self.sizes = {name: os.path.getsize(path) for name, path in self.files.items()}
+        self.done_genes.extend(self.batch_genes)
+        self.missing_genes.extend(self.batch_missing)
+        self.batch, self.batch_genes, self.batch_missing = [], [], []
+
+        progress = {"parameters": self.parameters, "genes": self.done_genes,
+                    "missing": self.missing_genes, "rows": self.rows, "parts": self.parts,
+                    "sizes": self.sizes}
+        # write to a temporary file first, so the progress file is never half written
+        temp_path = f"{self.progress_file}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(progress, file)
+        os.replace(temp_path, self.progress_file)
+
+    def close(self):
+        """
+        Write the remaining tables.
+        """
+        self.flush()
+
+
+def write_oligos(df, input_genome, writer, n_workers=1, check_off_targets=False,
+                 max_off_targets=None, off_target_mismatches=4, progress=None):
+    """
+    Design the sgRNA-insert pairs of a mutation list and stream them to a DesignWriter,
+    skipping the genes it has done already. progress(gene) is called after every gene.
+    Returns the number of written sgRNA-insert pairs and the genes which are not in
+    the genome file.
+    """
+    for gene, oligo_df in iter_oligos(df, input_genome, n_workers, check_off_targets,
+                                      max_off_targets, off_target_mismatches,
+                                      done_genes=writer.done_genes + writer.missing_genes,
+                                      first_reference=writer.rows):
+        writer.write(gene, oligo_df)
+        if progress is not None:
+            progress(gene)
+    writer.close()
+    return writer.rows, writer.missing_genes
+
+
+def get_args():
+    """
+    Parse command-line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Design sgRNA-insert pairs and write them '
+                                                 'gene by gene')
+    parser.add_argument('-i', '--input', required=True,
+                        help='list of mutations (.xlsx or .csv) with the columns gene, '
+                             'mutation and aa position')
+    parser.add_argument('-g', '--genome', required=True, help='genome file (.gb)')
+    parser.add_argument('-o', '--output', default="sgRNA_insert_list",
+                        help='prefix of the output files (default: sgRNA_insert_list)')
+    parser.add_argument('--fasta', action='store_true',
+                        help='also write the oligos and base pairing regions '
+                             '(<output>.fasta, <output>_bpregion.csv)')
+    parser.add_argument('--parquet', action='store_true',
+                        help='also write the table as Parquet files to the folder <output>_parquet')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='number of worker processes (default: 1)')
+    parser.add_argument('-m', '--max_off_targets', type=int, default=None,
+                        help='count the off-targets and drop pairs with more (default: no check)')
+    parser.add_argument('-b', '--batch_rows', type=int, default=BATCH_ROWS,
+                        help=f'rows written at once (default: {BATCH_ROWS})')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='continue an interrupted run after the last written gene')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Design the sgRNA-insert pairs of a mutation list into files.
+    """
+    args = get_args()
+    if args.input.endswith(".csv"):
+        df = pd.read_csv(args.input, sep="[,;]", engine="python")
+    else:
+        df = pd.read_excel(args.input)
+    parameters = {"input": os.path.abspath(args.input), "genome": os.path.abspath(args.genome),
+                  "max_off_targets": args.max_off_targets}
+    writer = DesignWriter(csv_file=f"{args.output}.csv",
+                          fasta_file=f"{args.output}.fasta" if args.fasta else None,
+                          bpregion_file=f"{args.output}_bpregion.csv" if args.fasta else None,
+                          parquet_dir=f"{args.output}_parquet" if args.parquet else None,
+                          resume=args.resume, parameters=parameters,
+                          batch_rows=args.batch_rows)
+    if writer.done_genes:
+        print(f"Resuming after {len(writer.done_genes)} genes and {writer.rows} sgRNA-insert pairs")
+    rows, missing_genes = write_oligos(df, args.genome, writer, args.processes,
+                                       max_off_targets=args.max_off_targets)
+    print(f"{rows} sgRNA-insert pairs have been written to {args.output}.csv")
+    if missing_genes:
+        print(f"These genes could not be found in the genome file: {', '.join(missing_genes)}")
+
+
+if __name__ == "__main__":
+    main()
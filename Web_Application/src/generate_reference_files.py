@@ -3,6 +3,10 @@ This script takes a table containing sgRNA-insert pairs
 and creates a fasta file containing the insert sequences 
 and a csv file containing the protospacer/base pairing regions
 """
+BPREGION_COLUMNS = ['reference','gene', 'aa position', 'mutated aa','child codon',
+                    'nt position', 'dist mut pam', 'mutated pam','base pairing region']
+
+
 def create_fasta_and_protospacer_file(file, fasta_output_file):
     """
     Create a FASTA file and a protospacer file from a table containing sequences.
@@ -10,8 +14,7 @@ def create_fasta_and_protospacer_file(file, fasta_output_file):
 
     # Read Excel file into a pandas DataFrame
     df = file
-    protospacer_df = df[['reference','gene', 'aa position', 'mutated aa','child codon',
-                          'nt position', 'dist mut pam', 'mutated pam','base pairing region']]
+    protospacer_df = df[BPREGION_COLUMNS]
 
     # Write the FASTA file
     with open(fasta_output_file, 'w', encoding="utf-8") as fasta_file:
@@ -0,0 +1,170 @@
+"""
+Genome index shared by the sgRNA-insert design, the off-target finder and the gene listing.
+A GenBank file is parsed only once into an on-disk cache, keyed by the checksum of the file:
+the genome sequence as a raw byte file and a table with the location of every gene.
+Later runs load the cache with mmap and answer gene lookups without parsing the file again.
+"""
+import hashlib
+import io
+import json
+import mmap
+import os
+import tempfile
+from Bio import SeqIO
+
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "linkgenvarphen_genome_index")
+
+COMPLEMENT = str.maketrans("ACGTRYKMBDHVNacgtrykmbdhvn", "TGCAYRMKVHDBNtgcayrmkvhdbn")
+
+# Indexes and checksums already loaded in this process
+_indexes = {}
+_checksums = {}
+
+
+def reverse_complement(sequence):
+    """
+    Reverse complement of a nucleotide string (IUPAC codes, case is kept).
+    """
+    return sequence.translate(COMPLEMENT)[::-1]
+
+
+def read_genome_bytes(genome_file):
+    """
+    Read the content of a genome file given as path or as file object (e.g. a Streamlit upload).
+    """
+    if isinstance(genome_file, (str, os.PathLike)):
+        with open(genome_file, "rb") as file:
+            return file.read()
+    if hasattr(genome_file, "getvalue"):
+        content = genome_file.getvalue()
+    else:
+        genome_file.seek(0)
+        content = genome_file.read()
+        genome_file.seek(0)
+    return content.encode("utf-8") if isinstance(content, str) else content
+
+
+def genome_checksum(genome_file):
+    """
+    SHA-256 checksum of a genome file. Checksums of paths are remembered
+    as long as the size and modification time of the file do not change.
+    """
+    if isinstance(genome_file, (str, os.PathLike)):
+        stat = os.stat(genome_file)
+        key = (os.path.abspath(genome_file), stat.st_size, stat.st_mtime_ns)
+        if key not in _checksums:
+            _checksums[key] = hashlib.sha256(read_genome_bytes(genome_file)).hexdigest()
+        return _checksums[key]
+    return hashlib.sha256(read_genome_bytes(genome_file)).hexdigest()
+
+
+class GenomeIndex:
+    """
+    Sequence and gene table of a parsed GenBank file.
+
+    - records: list of (record id, offset in the sequence blob, length)
+    - genes: gene name -> (record number, start, end, strand). If a gene name
+      occurs more than once, the last occurrence is kept.
+    """
+
+    def __init__(self, checksum, records, genes, sequence):
+        self.checksum = checksum
+        self.records = records
+        self.genes = genes
+        self.sequence = sequence
+
+    def gene_names(self):
+        """
+        Names of all genes in the genome.
+        """
+        return set(self.genes)
+
+    def record_sequence(self, record=0):
+        """
+        Sequence of a record as string.
+        """
+        _, offset, length = self.records[record]
+        return self.sequence[offset:offset + length].decode("ascii")
+
+    def genome_sequence(self):
+        """
+        Sequence of a genome with a single record, like SeqIO.read.
+        """
+        if len(self.records) != 1:
+            raise ValueError(f"Expected one record in the genome file, found {len(self.records)}")
+        return self.record_sequence(0)
+
+    def extract_flanking_region(self, gene_name, positions_to_update, flank_length=60):
+        """
+        Gene sequence with flank_length nucleotides up- and downstream. Genes not starting
+        with ATG are reverse complemented. The amino acid positions are converted to
+        positions in the merged sequence.
+        """
+        record, start, end, _ = self.genes[gene_name]
+        _, offset, length = self.records[record]
+        flank_start = max(0, start - flank_length)
+        flank_end = min(length, end + flank_length)
+        merged_sequence = self.sequence[offset + flank_start:offset + flank_end].decode("ascii")
+        upstream_length = start - flank_start
+        gene_sequence = merged_sequence[upstream_length:upstream_length + end - start]
+        if "ATG" not in gene_sequence[0:3]:
+            merged_sequence = reverse_complement(merged_sequence)
+        updated_positions = [((pos-1)*3) + upstream_length for pos in positions_to_update]
+        return merged_sequence, updated_positions
+
+
+def build_genome_index(content):
+    """
+    Parse GenBank content into the record table, gene table and sequence blob.
+    """
+    records = []
+    genes = {}
+    blob = bytearray()
+    handle = io.StringIO(content.decode("utf-8"))
+    for number, record in enumerate(SeqIO.parse(handle, "genbank")):
+        sequence = str(record.seq).encode("ascii")
+        records.append((record.id, len(blob), len(sequence)))
+        blob.extend(sequence)
+        for feature in record.features:
+            if feature.type == "gene" and "gene" in feature.qualifiers:
+                genes[feature.qualifiers["gene"][0]] = (number, int(feature.location.start),
+                                                        int(feature.location.end),
+                                                        feature.location.strand)
+    return records, genes, bytes(blob)
+
+
+def load_genome_index(genome_file, cache_dir=None):
+    """
+    Load the index of a genome file, building and caching it on first use.
+    """
+    checksum = genome_checksum(genome_file)
+    if checksum in _indexes:
+        return _indexes[checksum]
+
+    cache_dir = cache_dir or CACHE_DIR
+    sequence_path = os.path.join(cache_dir, f"{checksum}.seq")
+    table_path = os.path.join(cache_dir, f"{checksum}.json")
+    if not (os.path.exists(sequence_path) and os.path.exists(table_path)):
+        records, genes, blob = build_genome_index(read_genome_bytes(genome_file))
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to temporary files first, so other processes never see half written files
+        table = json.dumps({"records": records, "genes": genes}).encode("utf-8")
+        for path, data in [(sequence_path, blob), (table_path, table)]:
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "wb") as file:
+                file.write(data)
+            os.replace(temp_path, path)
+
+    with open(table_path, "r", encoding="utf-8") as file:
+        table = json.load(file)
+    records = [tuple(record) for record in table["records"]]
+    genes = {name: tuple(location) for name, location in table["genes"].items()}
+    with open(sequence_path, "rb") as file:
+        if os.path.getsize(sequence_path) > 0:
+            sequence = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            sequence = b""
+
+    index = GenomeIndex(checksum, records, genes, sequence)
+    _indexes[checksum] = index
+    return index
@@ -7,14 +7,26 @@ the off-target sequence,
 the position in the genome, and the number of mismatches.
 The off-target search is performed in parallel using the multiprocessing module to improve 
 performance.
+As a faster alternative with the same results, the seed engine indexes all k-mers of the genome
+once and only compares the base pairing regions to genome positions sharing an exact seed.
+The scan engine compares every base pairing region to all genome windows with NumPy,
+block by block within a configurable memory budget.
+Both strands of the genome are searched by default. Optionally only binding sites next to
+a PAM (e.g. NGG) are reported; the PAM is checked before the mismatches are counted.
 """
 
-from multiprocessing import Pool
+import os
+import threading
+import time
+from multiprocessing import Pool, get_start_method
 from collections import defaultdict
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
-from Bio import SeqIO
 
 import regex as re
+from src.genome_index import load_genome_index, reverse_complement
+from src.off_target_cache import OffTargetCache, CACHE_FILE, CACHE_SIZE
 
 
 def process_protospacer(reference, protospacer, genome_seq, max_mismatches=4):
@@ -36,6 +48,250 @@ def process_protospacer(reference, protospacer, genome_seq, max_mismatches=4):
 
     return (reference, protospacer, off_targets)
 
+
+def get_chunksize(n_tasks, processes):
+    """
+    Number of base pairing regions sent to a worker at once: about four chunks per worker.
+    """
+    return max(1, n_tasks // (processes * 4))
+
+
+# Longest seed used by the seed engine, the index has 4**MAX_SEED_SIZE bins (8 MB of offsets)
+MAX_SEED_SIZE = 10
+# Number of candidate positions compared at once by the seed engine
+CANDIDATE_CHUNK = 500000
+
+# 2-bit codes of the nucleotides, all other characters are 4 and are never used as seed
+NT_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _nt in enumerate(b"ACGT"):
+    NT_CODES[_nt] = _code
+
+
+def kmer_codes(codes, seed_size):
+    """
+    Integer code of every k-mer of a 2-bit encoded sequence and whether it only
+    contains A, C, G and T.
+    """
+    n_kmers = len(codes) - seed_size + 1
+    if n_kmers <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+    kmers = np.zeros(n_kmers, dtype=np.int64)
+    invalid = np.zeros(n_kmers, dtype=bool)
+    for i in range(seed_size):
+        window = codes[i:i + n_kmers]
+        kmers = (kmers << 2) | (window & 3)
+        invalid |= window == 4
+    return kmers, ~invalid
+
+
+def build_seed_index(genome_seq, seed_size):
+    """
+    Index the start positions of all k-mers (k = seed_size) of the genome.
+    The positions are sorted by k-mer, the positions of k-mer c are
+    positions[offsets[c]:offsets[c + 1]].
+    """
+    genome = np.frombuffer(genome_seq.encode("ascii"), dtype=np.uint8)
+    kmers, valid = kmer_codes(NT_CODES[genome], seed_size)
+    starts = np.flatnonzero(valid).astype(np.int64)
+    kmers = kmers[valid]
+    order = np.argsort(kmers, kind="stable")
+    offsets = np.zeros(4 ** seed_size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(kmers, minlength=4 ** seed_size), out=offsets[1:])
+    return {"genome": genome, "seed_size": seed_size,
+            "positions": starts[order], "offsets": offsets}
+
+
+def get_seed_size(protospacer_length, max_mismatches, memory_budget=None):
+    """
+    Seed length for the pigeonhole principle: a base pairing region split into
+    max_mismatches + 1 blocks has at least one block without mismatch.
+    With memory_budget, the seed is shortened until the offsets of the index
+    (8 * 4**seed_size bytes) fit in it.
+    """
+    seed_size = min(protospacer_length // (max_mismatches + 1), MAX_SEED_SIZE)
+    if memory_budget is not None:
+        while seed_size > 1 and 8 * 4 ** seed_size > memory_budget:
+            seed_size -= 1
+    return seed_size
+
+
+def seed_search(protospacer, genome_seq, index, max_mismatches=4, allowed=None):
+    """
+    Find all genome positions with at most max_mismatches substitutions to the
+    base pairing region, using the seed index. Gives the same list of
+    (matched_seq, position, mismatches) as the regex search of process_protospacer.
+    If allowed is given (bool array over the window starts, see pam_windows),
+    only the allowed positions are compared.
+    """
+    length = len(protospacer)
+    block = length // (max_mismatches + 1)
+    seed_size = index["seed_size"]
+    guide = np.frombuffer(protospacer.encode("ascii"), dtype=np.uint8)
+    seed_codes, seed_valid = kmer_codes(NT_CODES[guide], seed_size)
+
+    positions = index["positions"]
+    offsets = index["offsets"]
+    candidates = []
+    for block_start in range(0, (max_mismatches + 1) * block, block):
+        if not seed_valid[block_start]:
+            # seed with other characters than ACGT, it is not in the index
+            return filter_hits(process_protospacer(protospacer, protospacer, genome_seq,
+                                                   max_mismatches)[2], allowed)
+        code = seed_codes[block_start]
+        candidates.append(positions[offsets[code]:offsets[code + 1]] - block_start)
+
+    genome = index["genome"]
+    candidates = np.unique(np.concatenate(candidates))
+    candidates = candidates[(candidates >= 0) & (candidates <= len(genome) - length)]
+    if allowed is not None:
+        candidates = candidates[allowed[candidates]]
+    off_targets = []
+    for chunk_start in range(0, len(candidates), CANDIDATE_CHUNK):
+        chunk = candidates[chunk_start:chunk_start + CANDIDATE_CHUNK]
+        windows = genome[chunk[:, None] + np.arange(length)]
+        mismatches = np.count_nonzero(windows != guide, axis=1)
+        hits = mismatches <= max_mismatches
+        for position, count in zip(chunk[hits], mismatches[hits]):
+            off_targets.append((genome_seq[position:position + length], int(position), int(count)))
+    return off_targets
+
+
+# Bytes of memory the scan engine may use for the windows compared at once
+MEMORY_BUDGET = 256 * 1024 * 1024
+
+
+def scan_search(protospacer, genome, max_mismatches=4, memory_budget=MEMORY_BUDGET,
+                allowed=None):
+    """
+    Find all genome positions with at most max_mismatches substitutions to the
+    base pairing region by comparing it to every window of the genome.
+    genome is the genome as uint8 array (one byte per nucleotide). The mismatch counts
+    of a block of windows are summed column by column over the sliding window view,
+    the blocks are sized so that the counts and the compared column fit in memory_budget bytes.
+    If allowed is given (bool array over the window starts, see pam_windows), only the
+    allowed windows are gathered and compared.
+    Gives the same list of (matched_seq, position, mismatches) as process_protospacer.
+    """
+    length = len(protospacer)
+    n_windows = len(genome) - length + 1
+    if length == 0 or n_windows <= 0:
+        return []
+    guide = np.frombuffer(protospacer.encode("ascii"), dtype=np.uint8)
+    count_type = np.uint8 if length < 256 else np.uint16
+    count_size = np.dtype(count_type).itemsize
+    off_targets = []
+    if allowed is None:
+        # per window: the mismatch count and one bool of the compared column
+        block_size = max(1, memory_budget // (count_size + 1))
+        for block_start in range(0, n_windows, block_size):
+            block_end = min(block_start + block_size, n_windows)
+            windows = sliding_window_view(genome[block_start:block_end + length - 1], length)
+            mismatches = np.zeros(len(windows), dtype=count_type)
+            for column, nucleotide in enumerate(guide):
+                mismatches += windows[:, column] != nucleotide
+            for offset in np.flatnonzero(mismatches <= max_mismatches):
+                position = block_start + int(offset)
+                off_targets.append((genome[position:position + length].tobytes().decode("ascii"),
+                                    position, int(mismatches[offset])))
+        return off_targets
+
+    # per window: the start, the mismatch count, the gathered column and one bool
+    block_size = max(1, memory_budget // (8 + count_size + 2))
+    starts = np.flatnonzero(allowed)
+    for block_start in range(0, len(starts), block_size):
+        block = starts[block_start:block_start + block_size]
+        mismatches = np.zeros(len(block), dtype=count_type)
+        for column, nucleotide in enumerate(guide):
+            mismatches += genome[block + column] != nucleotide
+        for position, count in zip(block[mismatches <= max_mismatches],
+                                   mismatches[mismatches <= max_mismatches]):
+            off_targets.append((genome[position:position + length].tobytes().decode("ascii"),
+                                int(position), int(count)))
+    return off_targets
+
+
+# Nucleotides matched by the IUPAC codes of a PAM
+IUPAC_CODES = {"A": "A", "C": "C", "G": "G", "T": "T", "R": "AG", "Y": "CT", "S": "CG",
+               "W": "AT", "K": "GT", "M": "AC", "B": "CGT", "D": "AGT", "H": "ACT",
+               "V": "ACG", "N": "ACGT"}
+
+
+def pam_sites(genome, pam):
+    """
+    Positions where the PAM starts on the forward strand and where the reverse
+    complement of the PAM starts (PAM on the reverse strand), as bool arrays
+    over genome[:len(genome) - len(pam) + 1].
+    """
+    unknown = set(pam.upper()) - set(IUPAC_CODES)
+    if unknown:
+        raise ValueError(f"Unknown nucleotide codes in the PAM: {', '.join(sorted(unknown))}")
+    sites = []
+    for motif in (pam.upper(), reverse_complement(pam.upper())):
+        n_sites = max(len(genome) - len(motif) + 1, 0)
+        matches = np.ones(n_sites, dtype=bool)
+        for i, code in enumerate(motif):
+            table = np.zeros(256, dtype=bool)
+            for nucleotide in IUPAC_CODES[code]:
+                table[ord(nucleotide)] = table[ord(nucleotide.lower())] = True
+            matches &= table[genome[i:i + n_sites]]
+        sites.append(matches)
+    return sites[0], sites[1]
+
+
+def pam_windows(sites, strand, length, pam_length, genome_length):
+    """
+    Bool array over the window starts of a base pairing region of the given length:
+    True if the window is next to a PAM. On the forward strand the PAM follows the
+    window, on the reverse strand it precedes the window in genome coordinates.
+    """
+    allowed = np.zeros(max(genome_length - length + 1, 0), dtype=bool)
+    if strand == "+":
+        n_allowed = min(len(allowed), max(len(sites) - length, 0))
+        allowed[:n_allowed] = sites[length:length + n_allowed]
+    else:
+        n_allowed = min(len(allowed) - pam_length, len(sites))
+        if n_allowed > 0:
+            allowed[pam_length:pam_length + n_allowed] = sites[:n_allowed]
+    return allowed
+
+
+def filter_hits(off_targets, allowed):
+    """
+    Keep the off-targets at allowed window starts.
+    """
+    if allowed is None:
+        return off_targets
+    return [target for target in off_targets if allowed[target[1]]]
+
+
+def strand_hits(protospacer, genome_seq, hits, pam_length=3, seed_length=12, seed_weight=1):
+    """
+    Combine the hits of both strands of one base pairing region.
+    hits maps the strand ("+" or "-") to the (matched_seq, position, mismatches) of
+    the base pairing region ("+") or of its reverse complement ("-") on the forward
+    sequence. Returns (matched_seq, position, mismatches, strand, pam, weighted_mismatches)
+    sorted by position, with matched_seq and pam read in the direction of the base pairing
+    region. Mismatches in the seed region (the seed_length nucleotides next to the PAM)
+    count seed_weight times in weighted_mismatches.
+    """
+    length = len(protospacer)
+    seed = protospacer[-seed_length:] if seed_length > 0 else ""
+    off_targets = []
+    for strand, strand_targets in hits.items():
+        for matched_seq, position, mismatches in strand_targets:
+            if strand == "+":
+                pam = genome_seq[position + length:position + length + pam_length]
+            else:
+                matched_seq = reverse_complement(matched_seq)
+                pam = reverse_complement(genome_seq[max(position - pam_length, 0):position])
+            target_seed = matched_seq[-seed_length:] if seed_length > 0 else ""
+            seed_mismatches = sum(a != b for a, b in zip(target_seed, seed))
+            weighted = mismatches + (seed_weight - 1) * seed_mismatches
+            off_targets.append((matched_seq, position, mismatches, strand, pam, weighted))
+    off_targets.sort(key=lambda target: (target[1], target[3]))
+    return off_targets
+
+
 def highlight_protospacers(df):
     """
     Highlight base regionss with 4 mismatches or more
@@ -47,10 +303,165 @@ def highlight_protospacers(df):
 
     return df.style.apply(highlight_row, axis=1)
 
-def off_target(protospacers_file, genome_file):
+# Genomes and search settings of a worker process. With the fork start method the workers
+# inherit them from the main process, including the seed indexes, otherwise init_worker sets them.
+_worker = {}
+_fork_lock = threading.Lock()
+
+
+def worker_state(genomes, engine="seed", max_mismatches=4, memory_budget=MEMORY_BUDGET,
+                 pam=None):
+    """
+    Genomes (name -> sequence) and search settings used by search_strand.
+    Seed indexes and PAM windows are added when first needed.
+    """
+    state = {"engine": engine, "max_mismatches": max_mismatches,
+             "memory_budget": memory_budget, "pam": pam, "pam_length": len(pam) if pam else 3,
+             "genomes": {}}
+    for name, genome_seq in genomes.items():
+        genome = np.frombuffer(genome_seq.encode("ascii"), dtype=np.uint8)
+        state["genomes"][name] = {"genome_seq": genome_seq, "genome": genome,
+                                  "sites": pam_sites(genome, pam) if pam else None,
+                                  "windows": {}, "indexes": {}}
+    return state
+
+
+def init_worker(genomes, engine="seed", max_mismatches=4, memory_budget=MEMORY_BUDGET,
+                pam=None):
+    """
+    Pool initializer: keep the genomes and the search settings in the worker, so the
+    genomes are sent once per worker and not with every base pairing region.
+    """
+    _worker.clear()
+    _worker.update(worker_state(genomes, engine, max_mismatches, memory_budget, pam))
+
+
+def get_seed_index(genome_state, seed_size):
+    """
+    Seed index of a genome, built on first use.
+    """
+    if seed_size not in genome_state["indexes"]:
+        genome_state["indexes"][seed_size] = build_seed_index(genome_state["genome_seq"],
+                                                              seed_size)
+    return genome_state["indexes"][seed_size]
+
+
+def prepare_seed_indexes(state, lengths):
+    """
+    Build the seed indexes of all genomes for base pairing regions of the given lengths.
+    """
+    for genome_state in state["genomes"].values():
+        for length in lengths:
+            seed_size = get_seed_size(length, state["max_mismatches"], state["memory_budget"])
+            if seed_size > 0:
+                get_seed_index(genome_state, seed_size)
+
+
+def search_strand(task, state=None):
+    """
+    Search one strand of a base pairing region on one genome, with the genomes and
+    settings of state (default: those of the worker process).
+    task is (genome name, reference, protospacer, strand), returns (genome name,
+    protospacer, strand, hits) with the (matched_seq, position, mismatches) hits on
+    the forward sequence.
+    """
+    state = state or _worker
+    genome_name, reference, protospacer, strand = task
+    genome_state = state["genomes"][genome_name]
+    genome_seq = genome_state["genome_seq"]
+    max_mismatches = state["max_mismatches"]
+    query = protospacer if strand == "+" else reverse_complement(protospacer)
+    allowed = None
+    if genome_state["sites"] is not None:
+        key = (strand, len(query))
+        if key not in genome_state["windows"]:
+            sites = genome_state["sites"][0] if strand == "+" else genome_state["sites"][1]
+            genome_state["windows"][key] = pam_windows(sites, strand, len(query),
+                                                       state["pam_length"], len(genome_seq))
+        allowed = genome_state["windows"][key]
+
+    seed_size = get_seed_size(len(query), max_mismatches, state["memory_budget"])
+    if state["engine"] == "seed" and seed_size > 0:
+        hits = seed_search(query, genome_seq, get_seed_index(genome_state, seed_size),
+                           max_mismatches, allowed)
+    elif state["engine"] == "scan":
+        hits = scan_search(query, genome_state["genome"], max_mismatches,
+                           state["memory_budget"], allowed)
+    else:
+        # regex engine, and base pairing regions too short to be split into seeds
+        hits = filter_hits(process_protospacer(reference, query, genome_seq,
+                                               max_mismatches)[2], allowed)
+    return genome_name, protospacer, strand, hits
+
+
+def start_workers(processes, state):
+    """
+    Start the worker pool. Forked workers inherit state from the main process,
+    other workers build it again with init_worker.
+    """
+    if get_start_method() == "fork":
+        with _fork_lock:
+            _worker.clear()
+            _worker.update(state)
+            pool = Pool(processes)
+            _worker.clear()
+        return pool
+    genomes = {name: genome_state["genome_seq"]
+               for name, genome_state in state["genomes"].items()}
+    return Pool(processes, initializer=init_worker,
+                initargs=(genomes, state["engine"], state["max_mismatches"],
+                          state["memory_budget"], state["pam"]))
+
+
+def specificity_index(genome_file, max_mismatches=4, pam=None, length=20):
+    """
+    Search state with the seed index of a genome for count_off_targets, built once
+    for base pairing regions of the given length.
+    """
+    genome_seq = load_genome_index(genome_file).genome_sequence()
+    state = worker_state({"genome": genome_seq}, "seed", max_mismatches, pam=pam)
+    prepare_seed_indexes(state, [length])
+    return state
+
+
+def count_off_targets(protospacers, state=None):
     """
-    Find potential off-targets in the genome sequence for a given protospacer
+    Number of off-targets of every base pairing region on both strands of the genome
+    of state (default: the state of the worker process, see specificity_index).
+    One perfect match is taken as the target site and is not counted.
     """
+    counts = {}
+    for protospacer in dict.fromkeys(protospacers):
+        hits = []
+        for strand in ("+", "-"):
+            hits.extend(search_strand(("genome", protospacer, protospacer, strand), state)[3])
+        perfect_matches = sum(1 for hit in hits if hit[2] == 0)
+        counts[protospacer] = len(hits) - min(perfect_matches, 1)
+    return counts
+
+
+# Searched strands collected before they are stored in the cache at once
+CACHE_FLUSH_ROWS = 1000
+CACHE_FLUSH_SECONDS = 5
+
+
+def iter_multi_genome_off_targets(protospacers_file, genome_files, engine="seed",
+                                  max_mismatches=4, memory_budget=MEMORY_BUDGET, strands="both",
+                                  pam=None, seed_length=12, seed_weight=1, cache_file=CACHE_FILE,
+                                  cache_size=CACHE_SIZE, processes=None):
+    """
+    Search every unique base pairing region once on every genome of genome_files
+    (name -> genome file) and yield (genome name, protospacer, references, off-targets)
+    as soon as it is done, cached results first. The off-targets are (matched_seq,
+    position, mismatches, strand, pam, weighted_mismatches), see strand_hits.
+    The base pairing regions are read once and all genomes are searched on one pool of
+    processes workers (default: all cores), results arrive in the order they complete.
+    See off_target for the other options.
+    """
+    if engine not in ("seed", "scan", "regex"):
+        raise ValueError(f"Unknown off-target engine: {engine}")
+    if strands not in ("both", "forward"):
+        raise ValueError(f"Unknown strands option: {strands}")
 
     protospacers = protospacers_file['base pairing region'].tolist()
     print(len(protospacers), "protospacers loaded")
@@ -58,31 +469,276 @@ def off_target(protospacers_file, genome_file):
     for _, row in protospacers_file.iterrows():
         protospacer_dict[row['base pairing region']].append(row['reference'])
 
+    genome_indexes = {name: load_genome_index(genome_file)
+                      for name, genome_file in genome_files.items()}
+    genomes = {name: index.genome_sequence() for name, index in genome_indexes.items()}
+    strand_list = ["+", "-"] if strands == "both" else ["+"]
+    pam = pam.upper() if pam else None
+    pam_length = len(pam) if pam else 3
+    if pam:
+        # check the PAM before starting the workers
+        pam_sites(np.zeros(0, dtype=np.uint8), pam)
 
+    def finished(name, protospacer):
+        targets = strand_hits(protospacer, genomes[name],
+                              {strand: found[(name, protospacer)][strand]
+                               for strand in strand_list},
+                              pam_length, seed_length, seed_weight)
+        return name, protospacer, protospacer_dict[protospacer], targets
 
-    genome = SeqIO.read(genome_file, "genbank")
-    genome_seq = str(genome.seq)
-
-    # Run the off-target search in parallel
-    with Pool() as pool:
+    # Only search the base pairing regions that are not in the cache yet
+    cache = OffTargetCache(cache_file, cache_size) if cache_file else None
+    try:
+        found = defaultdict(dict)
         tasks = []
-        for protospacer, refs in protospacer_dict.items():
-            for ref in refs:
-                tasks.append((ref, protospacer, genome_seq))
-        results = pool.starmap(process_protospacer, tasks)
+        keys = [(protospacer, strand) for protospacer in protospacer_dict
+                for strand in strand_list]
+        for name, index in genome_indexes.items():
+            cached = {}
+            if cache is not None:
+                cached = cache.get(index.checksum, keys, max_mismatches, pam)
+                print(f"{name}: {len(cached)} of {len(keys)} searches taken from the cache")
+            for protospacer, strand in keys:
+                if (protospacer, strand) in cached:
+                    found[(name, protospacer)][strand] = cached[(protospacer, strand)]
+                    if len(found[(name, protospacer)]) == len(strand_list):
+                        yield finished(name, protospacer)
+                else:
+                    tasks.append((name, protospacer_dict[protospacer][0], protospacer, strand))
+        if not tasks:
+            return
+
+        processes = processes or os.cpu_count() or 1
+        state = worker_state(genomes, engine, max_mismatches, memory_budget, pam)
+        if engine == "seed":
+            # build the seed indexes once, forked workers share them
+            prepare_seed_indexes(state, {len(task[2]) for task in tasks})
+        pool = None
+        if processes > 1:
+            # the tasks are sent in chunks
+            pool = start_workers(processes, state)
+            results = pool.imap_unordered(search_strand, tasks,
+                                          chunksize=get_chunksize(len(tasks), processes))
+        else:
+            results = (search_strand(task, state) for task in tasks)
+        # new hits are stored in batches, one transaction (and eviction) per flush
+        pending = defaultdict(dict)
+        n_pending = 0
+        last_flush = time.monotonic()
+
+        def flush_cache():
+            for checksum, hits in pending.items():
+                cache.put(checksum, hits, max_mismatches, pam)
+            pending.clear()
+
+        try:
+            for name, protospacer, strand, hits in results:
+                found[(name, protospacer)][strand] = hits
+                if cache is not None:
+                    pending[genome_indexes[name].checksum][(protospacer, strand)] = hits
+                    n_pending += 1
+                    if (n_pending >= CACHE_FLUSH_ROWS
+                            or time.monotonic() - last_flush >= CACHE_FLUSH_SECONDS):
+                        flush_cache()
+                        n_pending = 0
+                        last_flush = time.monotonic()
+                if len(found[(name, protospacer)]) == len(strand_list):
+                    yield finished(name, protospacer)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            if cache is not None:
+                flush_cache()
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+def iter_off_targets(protospacers_file, genome_file, engine="seed", max_mismatches=4,
+                     memory_budget=MEMORY_BUDGET, strands="both", pam=None, seed_length=12,
+                     seed_weight=1, cache_file=CACHE_FILE, cache_size=CACHE_SIZE,
+                     processes=None):
+    """
+    Search every unique base pairing region once and yield (protospacer, references,
+    off-targets) as soon as it is done, see iter_multi_genome_off_targets.
+    """
+    for _, protospacer, references, targets in iter_multi_genome_off_targets(
+            protospacers_file, {"genome": genome_file}, engine, max_mismatches, memory_budget,
+            strands, pam, seed_length, seed_weight, cache_file, cache_size, processes):
+        yield protospacer, references, targets
+
 
-    # Prepare data for Excel
+OFF_TARGET_COLUMNS = ['reference', 'base pairing region', 'Off-Target Sequence', 'Position',
+                      'Mismatches', 'Strand', 'PAM', 'Weighted Mismatches']
+
+
+def off_target_rows(protospacer, references, targets):
+    """
+    Table rows of the off-targets of a base pairing region, one row per reference and
+    off-target, or one row per reference without off-target.
+    """
     data = []
-    for reference, protospacer, targets in results:
+    for reference in references:
         if targets and len(targets) > 0:
             for target in targets:
-                data.append([reference, protospacer, target[0], target[1], target[2]])
+                data.append([reference, protospacer, *target])
         else:
-            data.append([reference, protospacer, "", "", "None"])
+            data.append([reference, protospacer, "", "", "None", "", "", ""])
+    return data
+
+
+# Number of closest off-targets listed per base pairing region in the summary
+SUMMARY_TOP_N = 3
+
+
+def specificity_score(targets):
+    """
+    Specificity of a base pairing region from 0 to 100. One perfect match is taken as
+    the target site, every other hit lowers the score by 1 / 2**weighted_mismatches:
+    score = 100 / (1 + sum of the penalties). Without other hits the score is 100.
+    """
+    penalty = 0.0
+    on_target = False
+    for target in targets:
+        if target[2] == 0 and not on_target:
+            on_target = True
+            continue
+        penalty += 1 / 2 ** target[5]
+    return round(100 / (1 + penalty), 2)
+
+
+def summary_columns(max_mismatches=4):
+    """
+    Columns of the off-target summary.
+    """
+    return (['reference', 'base pairing region']
+            + [f"{count} mismatches" for count in range(max_mismatches + 1)]
+            + ['Specificity score', 'Closest off-targets'])
+
+
+def off_target_summary_rows(protospacer, references, targets, max_mismatches=4,
+                            top_n=SUMMARY_TOP_N):
+    """
+    Summary rows of a base pairing region, one per reference: the number of hits per
+    number of mismatches, the specificity score and the top_n closest off-targets
+    (the target site, see specificity_score, is not listed).
+    """
+    histogram = [0] * (max_mismatches + 1)
+    for target in targets:
+        histogram[target[2]] += 1
+    off_targets = list(targets)
+    for index, target in enumerate(off_targets):
+        if target[2] == 0:
+            del off_targets[index]
+            break
+    off_targets.sort(key=lambda target: (target[5], target[2], target[1]))
+    closest = "; ".join(f"{target[0]} {target[1]} ({target[3]}, {target[2]} mm)"
+                        for target in off_targets[:top_n])
+    score = specificity_score(targets)
+    return [[reference, protospacer, *histogram, score, closest] for reference in references]
+
+
+def write_hits(df, hits_file):
+    """
+    Write the full off-target table to a Parquet (.parquet) or CSV file, with empty
+    cells for base pairing regions without off-targets.
+    """
+    df = df.replace({"": None, "None": None})
+    for column in ['Position', 'Mismatches', 'Weighted Mismatches']:
+        df[column] = pd.to_numeric(df[column]).astype("Int64")
+    if str(hits_file).endswith(".parquet"):
+        df.to_parquet(hits_file, index=False)
+    else:
+        df.to_csv(hits_file, index=False)
+
+
+def off_target(protospacers_file, genome_file, engine="seed", max_mismatches=4,
+               memory_budget=MEMORY_BUDGET, strands="both", pam=None, seed_length=12,
+               seed_weight=1, cache_file=CACHE_FILE, cache_size=CACHE_SIZE, processes=None,
+               summary=False, top_n=SUMMARY_TOP_N, hits_file=None):
+    """
+    Find potential off-targets in the genome sequence for a given protospacer.
+    engine is "seed" (k-mer seed index, see seed_search), "scan" (NumPy comparison
+    to all genome windows within memory_budget bytes per worker, see scan_search) or "regex"
+    (fuzzy regex search), all give the same table. The base pairing regions are searched in
+    parallel on processes workers (default: all cores).
+    strands is "both" or "forward". If pam is given (IUPAC, e.g. "NGG"), only binding
+    sites followed by the PAM are reported. Mismatches in the seed_length nucleotides next
+    to the PAM count seed_weight times in the weighted mismatches.
+    The hits are cached in cache_file (see OffTargetCache, None disables the cache),
+    only base pairing regions without cached hits are searched.
+    With summary, a plain DataFrame with one row per reference is returned instead of the
+    styled hit table (see off_target_summary_rows). The full hit table is only written to
+    hits_file (Parquet or CSV) if it is given.
+    """
+    results = {}
+    summaries = {}
+    for protospacer, references, targets in iter_off_targets(
+            protospacers_file, genome_file, engine, max_mismatches, memory_budget, strands,
+            pam, seed_length, seed_weight, cache_file, cache_size, processes):
+        if not summary or hits_file:
+            results[protospacer] = off_target_rows(protospacer, references, targets)
+        if summary:
+            summaries[protospacer] = off_target_summary_rows(protospacer, references, targets,
+                                                             max_mismatches, top_n)
+
+    # Prepare data for Excel, in the order of the base pairing regions in the input
+    order = dict.fromkeys(protospacers_file['base pairing region'])
+    df = pd.DataFrame([row for protospacer in order for row in results.get(protospacer, [])],
+                      columns=OFF_TARGET_COLUMNS)
+    if hits_file:
+        write_hits(df, hits_file)
+    if summary:
+        summary_df = pd.DataFrame([row for protospacer in order for row in summaries[protospacer]],
+                                  columns=summary_columns(max_mismatches))
+        print(f"Number of unique references processed: {summary_df['reference'].nunique()}")
+        return summary_df
 
     # Create DataFrame
-    df = pd.DataFrame(data, columns=['reference','base pairing region',
-                                     'Off-Target Sequence', 'Position', 'Mismatches'])
     styled_df = highlight_protospacers(df)
     print(f"Number of unique references processed: {df['reference'].nunique()}")
     return styled_df
+
+
+def off_target_genomes(protospacers_file, genome_files, engine="seed", max_mismatches=4,
+                       memory_budget=MEMORY_BUDGET, strands="both", pam=None, seed_length=12,
+                       seed_weight=1, cache_file=CACHE_FILE, cache_size=CACHE_SIZE,
+                       processes=None, top_n=SUMMARY_TOP_N, hits_file=None, progress=None):
+    """
+    Off-target summary of the base pairing regions on several genomes (name -> genome file)
+    in one run. Returns one row per reference with the summary columns (see
+    off_target_summary_rows) of every genome, prefixed with the genome name.
+    The full hit table, with a genome column, is only written to hits_file if it is given.
+    progress is called with the number of finished (genome, base pairing region) searches.
+    See off_target for the other options.
+    """
+    summaries = {}
+    hits = {}
+    references = {}
+    for name, protospacer, refs, targets in iter_multi_genome_off_targets(
+            protospacers_file, genome_files, engine, max_mismatches, memory_budget, strands,
+            pam, seed_length, seed_weight, cache_file, cache_size, processes):
+        references[protospacer] = refs
+        summaries[(name, protospacer)] = off_target_summary_rows(
+            protospacer, [None], targets, max_mismatches, top_n)[0][2:]
+        if hits_file:
+            hits[(name, protospacer)] = [[name, *row] for row in
+                                         off_target_rows(protospacer, refs, targets)]
+        if progress is not None:
+            progress(len(summaries))
+
+    order = dict.fromkeys(protospacers_file['base pairing region'])
+    data = []
+    for protospacer in order:
+        genome_values = [value for name in genome_files for value in summaries[(name, protospacer)]]
+        for reference in references[protospacer]:
+            data.append([reference, protospacer, *genome_values])
+    columns = ['reference', 'base pairing region'] + [
+        f"{name} {column}" for name in genome_files for column in summary_columns(max_mismatches)[2:]]
+    if hits_file:
+        write_hits(pd.DataFrame([row for name in genome_files for protospacer in order
+                                 for row in hits[(name, protospacer)]],
+                                columns=['genome'] + OFF_TARGET_COLUMNS), hits_file)
+    summary_df = pd.DataFrame(data, columns=columns)
+    print(f"Number of unique references processed: {summary_df['reference'].nunique()}")
+    return summary_df
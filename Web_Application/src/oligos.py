@@ -6,90 +6,157 @@ Created on Thursday Jan 25 13:25:43 2024
 """
 import math
 import re
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from multiprocessing import Pool
 import pandas as pd
-from Bio import SeqIO
 from src.write_df import *
 from src.dictionaries import *
+from src.genome_index import load_genome_index
+from src.off_target_finder import specificity_index, count_off_targets, start_workers
 
 def extract_genes(gb_file):
     """
     Extract all gene names from a GenBank file.
     """
-    genes = set()  # Use a set to avoid duplicates
-    with open(gb_file, "r", encoding="utf-8") as file:
-        for record in SeqIO.parse(file, "genbank"):
-            for feature in record.features:
-                if feature.type == "gene":
-                    if "gene" in feature.qualifiers:
-                        # Extract gene name
-                        genes.add(feature.qualifiers["gene"][0])
-    return genes
-
-
-def get_pams(searchspace):
+    return load_genome_index(gb_file).gene_names()
+
+
+def index_pams(sequence):
     """
-    Extracts occurrences of patterns '.GG' and 'CC.' from a given search space.
+    Finds all '.GG' and 'CC.' sites of a sequence, overlapping sites included
+    (e.g. 'CGGG' contains the PAMs 'CGG' and 'GGG').
+    The sites are indexed once per gene and then queried for every mutation window.
 
     Parameters:
-    - searchspace (str): The input string to search for patterns.
+    - sequence (str): The merged gene sequence with its flanking regions.
 
     Returns:
-    - ngg_dict (dict): A dictionary containing positions and matched strings for the pattern '.GG'.
-    - ccn_dict (dict): A dictionary containing positions and matched strings for the pattern 'CC.'.
+    - ngg_sites (list): Sorted start positions of the pattern '.GG'.
+    - ccn_sites (list): Sorted start positions of the pattern 'CC.'.
 
     Example:
-    >>> searchspace = "ACCGGTAAGGCCCTCGG"
-    >>> get_pams(searchspace)
-    ({3: 'CGG', 10: 'CGG'}, {2: 'CCG'})
+    >>> index_pams("ACCGGGTAAGGCCCTCGG")
+    ([2, 3, 8, 15], [1, 11, 12])
     """
-    regex1 = re.compile('.GG')  # Pattern matching for '.GG'
-    regex2 = re.compile('CC.')  # Pattern matching for 'CC.'
-    ngg_dict = {}
-    ccn_dict = {}
-
-    # Iterate over matches for '.GG' and store positions and matched strings in ngg_dict
-    for ngg in regex1.finditer(searchspace):
-        ngg_dict[ngg.start()] = ngg.group()
+    ngg_sites = [site.start() for site in re.finditer('(?=.GG)', sequence)]
+    ccn_sites = [site.start() for site in re.finditer('(?=CC.)', sequence)]
+    return ngg_sites, ccn_sites
 
-    # Iterate over matches for 'CC.' and store positions and matched strings in ccn_dict
-    for ccn in regex2.finditer(searchspace):
-        ccn_dict[ccn.start()] = ccn.group()
 
-    return ngg_dict, ccn_dict
-
-
-def get_dist(position_dict):
+def get_window_pams(sequence, sites, window):
     """
-    Calculates the distance of each position in a dictionary from the reference position 29.
-    Because the searchspace is 30 nt before and after the mutation.
+    Looks up the PAM sites lying completely within a search window by binary search and
+    calculates their distance from the reference position 29 of the window,
+    because the searchspace is 30 nt before and after the mutation.
 
     Parameters:
-    - position_dict (dict): A dictionary containing positions and matched strings.
+    - sequence (str): The sequence the sites were indexed in.
+    - sites (list): Sorted start positions of PAM sites, from index_pams.
+    - window (range): Positions of the searchspace in the sequence.
 
     Returns:
     - pam (list): A list of lists, where each inner list contains the matched string and its distance from position 29.
 
     Example:
-    >>> position_dict = {3: 'CGG', 10: 'CGG'}
-    >>> get_dist(position_dict)
-    [['CGG', -26], ['CGG', -19]]
+    >>> sequence = "ACCGGTAAGGCCCTCGG"
+    >>> get_window_pams(sequence, [2, 7, 14], range(0, 17))
+    [['CGG', -27], ['AGG', -22], ['CGG', -15]]
     """
-    dist = 0
-    pam = []
-
-    # Iterate over the positions and matched strings in the input dictionary
-    for key, value in position_dict.items():
-        # Calculate the distance from the reference position 29, middle of the oligo
-        if key < 29:
-            dist = key - 29  # distance from the first nucleotide of PAM
-        else:
-            dist = key - 29  # distance from the last nucleotide of the mutation
+    first = bisect_left(sites, window.start)
+    last = bisect_right(sites, window.stop - 3)
+    # distance from the first nucleotide of the PAM to position 29 of the searchspace
+    return [[sequence[site:site + 3], site - window.start - 29] for site in sites[first:last]]
 
-        # Append the matched string and its distance to the pam list
-        pam.append([value, dist])
+class Candidate:
+    """
+    A PAM near a mutation and the sgRNA-insert pair designed with it.
+
+    The homology arm is not stored as string but as slice arm_start:arm_stop of the
+    merged gene sequence. The child codon replaces the 3 nt at codon_start of the arm,
+    the parent codon is read at parent_start. The PAM mutation replaces
+    pam_start:pam_stop of the arm with the child codon by changed_codon, with
+    pam_start None if the arm is used unchanged. The strings are only built when
+    needed, from the sequence the candidate was found in.
+
+    - pam (str), distance (int): PAM and its distance to the mutation (see get_window_pams).
+    - strand (str): "+" for NGG PAMs, "-" for CCN PAMs (NGG on the other strand).
+    - child_codon (str): inserted codon, None before insert_target_mutations.
+    - mutated_pam, changed_codon (str): PAM after the mutation and the codon that
+      mutates it, "-" if the PAM is not changed, None before the PAM is mutated.
+    """
+    __slots__ = ("pam", "distance", "strand", "arm_start", "arm_stop", "parent_start",
+                 "codon_start", "child_codon", "pam_start", "pam_stop", "mutated_pam",
+                 "changed_codon")
+
+    def __init__(self, pam, distance, arm_start, arm_stop):
+        self.pam = pam
+        self.distance = distance
+        self.strand = "-" if pam.startswith("CC") else "+"
+        self.arm_start = arm_start
+        self.arm_stop = arm_stop
+        self.parent_start = None
+        self.codon_start = None
+        self.child_codon = None
+        self.pam_start = None
+        self.pam_stop = None
+        self.mutated_pam = None
+        self.changed_codon = None
+
+    def __repr__(self):
+        return (f"Candidate({self.pam!r}, {self.distance}, arm={self.arm_start}:{self.arm_stop}, "
+                f"child_codon={self.child_codon!r}, mutated_pam={self.mutated_pam!r})")
+
+    def insert_codon(self, child_codon, codon_start, parent_start):
+        """
+        Copy of the candidate with child_codon inserted into the homology arm.
+        """
+        candidate = Candidate(self.pam, self.distance, self.arm_start, self.arm_stop)
+        candidate.child_codon = child_codon
+        candidate.codon_start = codon_start
+        candidate.parent_start = parent_start
+        return candidate
+
+    def mutate_pam(self, mutated_pam, changed_codon, pam_start=None, pam_stop=None):
+        """
+        Record the PAM mutation: pam_start:pam_stop of the homology arm is replaced
+        by changed_codon. Without pam_start the arm is used as it is.
+        """
+        self.mutated_pam = mutated_pam
+        self.changed_codon = changed_codon
+        self.pam_start = pam_start
+        self.pam_stop = pam_stop
+
+    def arm(self, sequence):
+        """
+        Homology arm without mutations, in lower case.
+        """
+        return sequence[self.arm_start:self.arm_stop].lower()
+
+    def parent_codon(self, sequence):
+        """
+        Codon of the gene at the mutated position.
+        """
+        return self.arm(sequence)[self.parent_start:self.parent_start + 3].upper()
+
+    def homology_arm(self, sequence):
+        """
+        Homology arm with the child codon in upper case.
+        """
+        arm = self.arm(sequence)
+        if self.child_codon is None:
+            return arm
+        return arm[:self.codon_start] + self.child_codon + arm[self.codon_start + 3:]
+
+    def mutated_homology_arm(self, sequence):
+        """
+        Homology arm with the child codon and the PAM mutation.
+        """
+        arm = self.homology_arm(sequence)
+        if self.pam_start is None:
+            return arm
+        return arm[:self.pam_start] + self.changed_codon + arm[self.pam_stop:]
 
-    return pam
 
 def get_homology_arm(example_gene, final_dict):
     """
@@ -97,24 +164,28 @@ def get_homology_arm(example_gene, final_dict):
 
     Parameters:
     - example_gene (str): The reference gene sequence.
-    - final_dict (dict): A dictionary containing positions, distances, and partial gene sequences.
+    - final_dict (dict): A dictionary containing positions and lists of PAMs and distances.
 
     Returns:
-    - final_dict (dict): An updated dictionary with homology arms added for each position.
+    - final_dict (dict): An updated dictionary with a Candidate for each PAM, the homology arm
+      is the 85 nt around the middle between the PAM and the mutation.
 
     Example:
     >>> example_gene = "ATCGATCGATCGATCGATCGATCGATCGATCGATCGATCGATCGATCG"
-    >>> final_dict = {1: [['CGG', -5]], 4: [['TAA', 8], ['GGC', -6]]}
-    >>> get_homology_arm(example_gene, final_dict)
-    {1: [['CGG', -5, 'GATCGATCGATCGATCGATCGATCGATCGATCGATCGATCGAT'], 4: [['TAA', 8, 'GATCGATCGATCGATCGATCGATCGATCGATCGATCGATCGAT'], ['GGC', -6, 'GATCGATCGATCGATCGATCGATCGATCGATCGATCGATCGAT']]}
+    >>> final_dict = {50: [['CGG', -5]], 53: [['TAA', 8], ['GGC', -6]]}
+    >>> final_dict = get_homology_arm(example_gene, final_dict)
+    >>> final_dict[50][0].arm(example_gene)
+    'tcgatcgatcgatcgatcgatcgatcgatcgatcgatcgatcg'
     """
     for key, value in final_dict.items():
         pos_in_gene = (key)
+        candidates = []
         for pam in value:
             center = math.floor(pos_in_gene + pam[1] / 2) if pam[1] < 0 else math.ceil(pos_in_gene + pam[1] / 2)
-            pam.append(example_gene[center - 42:center + 43].lower())
-            
-           
+            # same positions as example_gene[center - 42:center + 43]
+            arm = range(len(example_gene))[center - 42:center + 43]
+            candidates.append(Candidate(pam[0], pam[1], arm.start, arm.stop))
+        final_dict[key] = candidates
     return final_dict
 
 def filter_pam(final_dict):
@@ -129,10 +200,10 @@ def filter_pam(final_dict):
     
     for key, values in final_dict.items():
         for entry in values:
-            if len(entry) > 5:
-                if entry[7] not in exclusionPAMs:
+            if entry.changed_codon is not None:
+                if entry.changed_codon not in exclusionPAMs:
                     if key in reduced_dict.keys():
-                        reduced_dict[key].extend([entry])
+                        reduced_dict[key].append(entry)
                     else:
                         reduced_dict[key] = [entry]
                     
@@ -140,343 +211,393 @@ def filter_pam(final_dict):
 
 
 def insert_target_mutations(final_dict, mut_dict):
+    """
+    Insert every child codon of a position (except the first one of mut_dict,
+    the given codon) into the homology arms of its candidates.
+    """
     adapted_dict = {}
     for key, value in final_dict.items():
-        #print(mut_dict)
-        #print(final_dict)
         #if (key-1) > 42 and (key-1) < len(example_gene)-42:# take care of the other cases
         for entry in value:
-            harm = entry[2]
             if key in mut_dict.keys():
                 child = mut_dict[key][1:]
-                #print(child)
                 for child_mut in child:
-                    #print(child_mut)
-                    if entry[1] < 0: #negative
-                        parent_nt = harm[42-math.floor(entry[1]/2):42-math.floor(entry[1]/2)+3:].upper()
-                        #print(parent_nt)
+                    codon_start = 42 - math.floor(entry.distance / 2)
+                    parent_start = codon_start
+                    if entry.distance >= 0 and (entry.distance % 2) != 0: #positive, odd
+                        codon_start -= 1
+                        # the parent codon of the first candidate of a position is
+                        # read without the shift
                         if key in adapted_dict.keys():
-                            
-                            adapted_dict[key].extend([[entry[0],entry[1],harm[:42-math.floor(entry[1]/2)].lower()+ child_mut + harm[42-math.floor(entry[1]/2)+3:].lower(),parent_nt, child_mut]])
-                        else: 
-                            adapted_dict[key] = [[entry[0],entry[1],harm[:42-math.floor(entry[1]/2)].lower()+ child_mut + harm[42-math.floor(entry[1]/2)+3:].lower(),parent_nt, child_mut]]
-                           
-                    else: #positive
-                        
-                        if key in adapted_dict.keys():
-                            if (entry[1] % 2) ==0: #positive
-                                parent_nt = harm[42-math.floor(entry[1]/2):42-math.floor(entry[1]/2)+3:].upper()
-                                adapted_dict[key].extend([[entry[0],entry[1],harm[:42-math.floor(entry[1]/2)].lower()+ child_mut +harm[42-math.floor(entry[1]/2)+3:].lower(),parent_nt,child_mut]])
-                            else:
-                                parent_nt = harm[42-math.floor(entry[1]/2)-1:42-math.floor(entry[1]/2)+2:].upper()
-                                adapted_dict[key].extend([[entry[0],entry[1],harm[:42-math.floor(entry[1]/2)-1].lower()+ child_mut +harm[42-math.floor(entry[1]/2)+2:].lower(),parent_nt,child_mut]])
-                           
-                        else:
-                            if (entry[1] % 2) ==0:
-                                parent_nt = harm[42-math.floor(entry[1]/2):42-math.floor(entry[1]/2)+3:].upper()
-                                adapted_dict[key] = [[entry[0],entry[1],harm[:42-math.floor(entry[1]/2)].lower()+ child_mut + harm[42-math.floor(entry[1]/2)+3:].lower(),parent_nt,child_mut]]
-                            else:
-                                parent_nt = harm[42-math.floor(entry[1]/2):42-math.floor(entry[1]/2)+3:].upper()
-                                adapted_dict[key] =[[entry[0],entry[1],harm[:42-math.floor(entry[1]/2)-1].lower()+ child_mut +harm[42-math.floor(entry[1]/2)+2:].lower(),parent_nt,child_mut]]
+                            parent_start -= 1
+                    candidate = entry.insert_codon(child_mut, codon_start, parent_start)
+                    if key in adapted_dict.keys():
+                        adapted_dict[key].append(candidate)
+                    else:
+                        adapted_dict[key] = [candidate]
                         
     return adapted_dict
 
 
 
 def extract_flanking_regions(gene_bank_file, gene_name, positions_to_update, flank_length=60):
-    flanking_sequences = []
+    """
+    Extract the gene sequence with flanking regions from the cached genome index
+    and convert the amino acid positions to positions in the merged sequence.
+    """
+    genome_index = load_genome_index(gene_bank_file)
+    return genome_index.extract_flanking_region(gene_name, positions_to_update, flank_length)
 
-    for record in SeqIO.parse(gene_bank_file, "genbank"):
-        for feature in record.features:
-            
-            
-            if feature.type == "gene" and feature.qualifiers.get('gene')[0] == gene_name:
-                #print(feature.qualifiers.get('gene'))
-                start = feature.location.start
-                end = feature.location.end
-                sequence = record.seq
-                gene_sequence = sequence[start:end]
-               
+
+def extract_all_flanking_regions(gene_bank_file, positions_per_gene, flank_length=60):
+    """
+    Extract the flanked sequences of all requested genes with one genome index.
+    Genes that are not in the genome file are left out.
+
+    Parameters:
+    - gene_bank_file (str): path to the genome file.
+    - positions_per_gene (dict): gene name -> list of amino acid positions.
+
+    Returns:
+    - flanking_regions (dict): gene name -> (merged_sequence, updated_positions)
+    """
+    genome_index = load_genome_index(gene_bank_file)
+    flanking_regions = {}
+    for gene_name, positions in positions_per_gene.items():
+        if gene_name in genome_index.genes:
+            flanking_regions[gene_name] = genome_index.extract_flanking_region(
+                gene_name, positions, flank_length)
+    return flanking_regions
+
+
+def design_gene_oligos(gene, mutations, positions, merged_sequence, updated_positions,
+                       check_off_targets=False, max_off_targets=None, specificity=None):
+    """
+    Design all sgRNA-insert pairs for the mutations of one gene.
+
+    Parameters:
+    - gene (str): gene name.
+    - mutations (list): amino acid mutations of the gene, e.g. "T5S".
+    - positions (list): amino acid positions of the mutations.
+    - merged_sequence (str): gene sequence with flanking regions.
+    - updated_positions (list): positions of the mutations in merged_sequence.
+    - check_off_targets (bool): count the off-targets of the base pairing regions.
+    - max_off_targets (int): drop sgRNA-insert pairs with more off-targets.
+    - specificity (dict): seed index of the genome (see specificity_index),
+      None in worker processes which have it already.
+
+    Returns:
+    - DataFrame with the sgRNA-insert pairs of the gene (see write_df).
+    """
+    parent_mutation = []
+    child_mutation = []
+
+    for mutation in mutations:
+        if mutation[-1] in three_one.keys():
+            parent_mutation.append(three_one[mutation[0]])
+            child_mutation.append(three_one[mutation[-1]])
+    #print(parent_mutation)
+    #print(len(child_mutation))
+    #print(len(positions))
+    # Print the flanking sequences and updated positions
+    #print(updated_positions)
+    pos_dict = {} # triplets to get exact pos in
+    
+    for i in range(0, len(merged_sequence), 3):
+        pos_dict[i] = str(merged_sequence[i]) + str(merged_sequence[i + 1])+ str(merged_sequence[i+2])
+    #print(pos_dict)
+    #pam = {}
+    mut_nt = []
+    final_dict = {}
+
+    ngg_sites, ccn_sites = index_pams(str(merged_sequence))
+    for i in updated_positions:
+        # same positions as the searchspace merged_sequence[i-30:i+33]
+        window = range(len(merged_sequence))[(i)-30:(i)+33]
+        mut_nt.append(pos_dict[(i)])
+        final_dict[i] = get_window_pams(str(merged_sequence), ngg_sites, window)
+        final_dict[i].extend(get_window_pams(str(merged_sequence), ccn_sites, window))
+    
+    final_dict = get_homology_arm(str(merged_sequence), final_dict)
+    mut_dict = {}
+    intended_aas_per_pos = defaultdict(set)
+    for k in range(len(positions)):
+        aa = child_mutation[k].upper()
+        current_key = ((positions[k] - 1) * 3) + 60
+        intended_aas_per_pos[current_key].add(aa)
+
+    # Build mut_dict with strict checks
+    for k in range(len(positions)):
+        current_key = ((positions[k] - 1) * 3) + 60
+        mut_codon = mut_nt[k].upper()
+        aa = child_mutation[k].upper()
+
+        if aa not in aa_nt:
+            print(f"Warning: {aa} not in aa_nt")
+            continue
+
+        if current_key not in mut_dict:
+            mut_dict[current_key] = set()
+        else:
+        # Convert list to set if needed
+            if isinstance(mut_dict[current_key], list):
+                mut_dict[current_key] = set(mut_dict[current_key])
+
+        # Add the explicitly given mutated codon
+        mut_dict[current_key].add(mut_codon)
+
+        # Add only codons corresponding to *intended* amino acids for that position
+        for allowed_aa in intended_aas_per_pos[current_key]:
+            if allowed_aa in aa_nt:
+                for j in aa_nt[allowed_aa]:
+                    if len(j) == 3 and len(mut_codon) == 3:
+                        mismatches = sum(c1 != c2 for c1, c2 in zip(mut_codon, j))
+                        if 1 <= mismatches <= 3:
+                            mut_dict[current_key].add(j)
+
+        # Convert back to a list at the end of processing this key. The given codon
+        # comes first, as insert_target_mutations skips it, the others in a fixed order
+        mut_dict[current_key] = [mut_codon] + sorted(mut_dict[current_key] - {mut_codon})
+    print(mut_dict)
+
+    adapted_dict = insert_target_mutations(final_dict, mut_dict)
+    #print(adapted_dict)
+     # mutate PAM
+    for key1, value2 in adapted_dict.items():
+        for entry in value2:
+            a = entry.homology_arm(merged_sequence)
+        #print(a)
+            pos = 0
+            for char in range(len(a)):
+                if a[char].isupper():
+                    pos = char
+                    break     
+            ha = a
+            if abs(entry.distance) < 56 :
+                if entry.distance == 3:
+                    k = ha[pos + entry.distance:pos + entry.distance+3].upper()                   
+                    if k in substitution_nng.keys(): 
+                        j = ha[pos+entry.distance-3 :pos+entry.distance] + substitution_nng[k]# shift = 1
+                        if not "GG" in j:
+                            if not "CC" in j:
+                                entry.mutate_pam(j[2:5], substitution_nng[k], pos+entry.distance, pos+entry.distance+3)
+                    if k in substitution_ncc.keys():
+                        j = ha[pos+entry.distance-3 :pos+entry.distance] + substitution_ncc[k]# shift = 1
+                        if not "GG" in j:
+                            if not "CC" in j:
+                                entry.mutate_pam(j[2:5], substitution_ncc[k], pos+entry.distance, pos+entry.distance+3)
                 
+                elif entry.distance > 2: #positive distances (2oder3)
+                   
+                    if (entry.distance % 3) == 0: #shift +2 OKAY
+                        if entry.pam.startswith("CC"):
+                            k = ha[pos+entry.distance-3:pos+entry.distance].upper()
+                            if k in substitution_nnc.keys():
+                                #print(ha,entry.pam,k,entry.distance)
+                                #print(ha[:pos-3+entry.distance]+ dictionaries.substitution_nnc[k] +ha[pos+entry.distance:])
+                                entry.mutate_pam(substitution_nnc[k][-1]+entry.pam[1:], substitution_nnc[k], pos-3+entry.distance, pos+entry.distance) #changed pam
+                            # GGN does not work
+                        else:
+                            #print(entry.distance)
+                            if entry.distance in [6,9,12,15,18,21,24,27,30]:
+                                #print(entry.distance)
+                                k = ha[pos + entry.distance:pos + entry.distance+3].upper()
+                                #print(k)
+                                if k in substitution_ncc.keys():
+                                    #print(ha, entry.distance)
+                                    #print(ha[:pos + entry.distance-2]+ dictionaries.substitution_ncc[k] + ha[pos + entry.distance+1:])
+                                    entry.mutate_pam(substitution_ncc[k][1:]+entry.pam[-1], substitution_ncc[k], pos + entry.distance-2, pos + entry.distance+1) #changed pam
+                                
+                                if k in substitution_nng.keys():
+                                    #print(ha, entry.pam,k,entry.distance)
+                                    #print(ha[:pos + entry.distance-2]+ dictionaries.substitution_nng[k] + ha[pos + entry.distance+1:])
+                                    entry.mutate_pam(substitution_nng[k][1:]+entry.pam[-1], substitution_nng[k], pos + entry.distance-2, pos + entry.distance+1)
+                                    #print(dictionaries.substitution_nng[k],entry.pam)
+                                
+                    
+                            else:
+                                if entry.pam in substitution_1.keys(): # shift = 0
+                                    #print(ha, entry.pam,entry.distance)
+                                    #print(ha[:pos+entry.distance-1]+ dictionaries.substitution_1[entry.pam] +ha[pos+entry.distance+2:])
+                                    entry.mutate_pam(substitution_1[entry.pam], substitution_1[entry.pam], pos+entry.distance-1, pos+entry.distance+2)
                 
-                merged_sequence = ""
-                # Extract flanking regions
-                upstream_flank = sequence[max(0, start - flank_length):start]
-                #print(len(upstream_flank))
-                downstream_flank = sequence[end:min(len(sequence), end + flank_length)]
-                #print(len(downstream_flank))
-                # Merge flanking regions with gene sequence
-                merged_sequence = upstream_flank + gene_sequence + downstream_flank
-                if "ATG"  not in gene_sequence[0:3]:
-                    merged_sequence = merged_sequence.reverse_complement()
-                    gene_sequence = gene_sequence.reverse_complement()
-                    #print(gene_sequence.reverse_complement())
-                #else:
-                #    print(gene_sequence)
-                # Update positions
-                updated_positions = [((pos-1)*3) + len(upstream_flank)  for pos in positions_to_update]
-                #print(updated_positions)
-
-                flanking_sequences.append((merged_sequence, updated_positions, gene_sequence))
-    return merged_sequence, updated_positions
-
-def generate_oligos(df, input_genome):
+                elif entry.distance < 0: # negative distances
+                    if (entry.distance % 3) == 0: #shift 2
+                        k = ha[pos+entry.distance:pos+entry.distance+3].upper()
+
+                        if entry.pam.startswith("CC"):
+                            if  k in substitution_cnn.keys():
+                                #print(ha, entry.distance,entry.pam)
+                                #print(len(ha[:pos+entry.distance]+substitution_cnn[k]+ha[pos+entry.distance+3:]))
+                                entry.mutate_pam(entry.pam[0]+substitution_cnn[k][:-1], substitution_cnn[k], pos+entry.distance, pos+entry.distance+3) #changed pam
+                                #ggn not possible
+
+                    else:
+            
+                        if (entry.distance % 2 ) != 0:
+                            frame = entry.distance+2 # shift 1
+                            if (frame % 3) == 0:
+                                if entry.pam in substitution_1.keys():
+                                    #print(ha,entry.distance,entry.pam)
+                                    #print(len(ha[:pos+entry.distance-1]+ dictionaries.substitution_1[entry.pam] +ha[pos+entry.distance+2:]))
+                                    entry.mutate_pam(substitution_1[entry.pam], substitution_1[entry.pam], pos+entry.distance-1, pos+entry.distance+2)
+                            else:    
+                                k = ha[pos + entry.distance-2:pos + entry.distance+1].upper()
+                                if k in substitution_nng.keys(): #shift 1 ungerade
+                                      #print(ha, entry.distance,entry.pam,pos)
+                                    #print(ha[:pos-2+entry.distance]+ dictionaries.substitution_nng[k]+ ha[pos+1+entry.distance:])
+                                    entry.mutate_pam(substitution_nng[k][1:]+entry.pam[-1], substitution_nng[k], pos-2+entry.distance, pos+1+entry.distance) #shift 0
+                                if k in substitution_ncc.keys(): #shift 1 ungerade
+                                    #print(ha, entry.distance,entry.pam,pos)
+                                    #print(len(ha[:pos-2+entry.distance]+ dictionaries.substitution_ncc[k]+ ha[pos+1+entry.distance:]))
+                                    entry.mutate_pam(substitution_ncc[k][1:]+entry.pam[-1], substitution_ncc[k], pos-2+entry.distance, pos+1+entry.distance) #shift 0
+
+                        else:
+                            frame = entry.distance-2 #shift = 1
+                            if (frame % 3) == 0:
+                                #print(k)
+                                k = ha[pos + entry.distance-2:pos + entry.distance+1].upper()
+                                if k in substitution_nng.keys(): #shift 1 ungerade
+                                    #print(ha, entry.distance,entry.pam,pos)
+                                    #print(len(ha[:pos-2+entry.distance]+ dictionaries.substitution_nng[k]+ ha[pos+1+entry.distance:]))
+                                    entry.mutate_pam(substitution_nng[k][1:]+entry.pam[-1], substitution_nng[k], pos-2+entry.distance, pos+1+entry.distance) #shift 0
+                                if k in substitution_ncc.keys(): #shift 1 ungerade
+                                    #print(ha, entry.distance,entry.pam,pos)
+                                    #print(len(ha[:pos-2+entry.distance]+ dictionaries.substitution_ncc[k]+ ha[pos+1+entry.distance:]))
+                                    entry.mutate_pam(substitution_ncc[k][1:]+entry.pam[-1], substitution_ncc[k], pos-2+entry.distance, pos+1+entry.distance) #shift 0
+                            else:
+                                
+                                if entry.pam in substitution_1.keys():
+                                    #print(ha,entry.distance,entry.pam)
+                                    #print(len(ha[:pos+entry.distance-1]+ dictionaries.substitution_1[entry.pam] +ha[pos+entry.distance+2:]))
+                                    entry.mutate_pam(substitution_1[entry.pam], substitution_1[entry.pam], pos+entry.distance-1, pos+entry.distance+2)
+                else:
+                    if not ("gg" or "cc")in ha[pos-2:pos+6]:
+                        if not "Gg" in ha[pos-2:pos+6]:
+                            if not "Cc" in ha[pos-2:pos+6]:
+                                if not "cC" in ha[pos-2:pos+6]:
+                                    if not "gG" in ha[pos-2:pos+6]:
+                                        #print(ha)
+                                        entry.mutate_pam("-", "-")
+
+    reduced_dict = filter_pam(adapted_dict)
+    #print(reduced_dict)
+    oligo_df = write_df(gene,merged_sequence,reduced_dict)
+    if check_off_targets:
+        oligo_df = annotate_off_targets(oligo_df, max_off_targets, specificity)
+    return oligo_df
+
+
+def annotate_off_targets(oligo_df, max_off_targets=None, specificity=None):
+    """
+    Add the number of off-targets of the base pairing regions (see count_off_targets)
+    and drop the sgRNA-insert pairs with more than max_off_targets.
+    """
+    counts = count_off_targets(oligo_df["base pairing region"], specificity)
+    oligo_df["off-targets"] = oligo_df["base pairing region"].map(counts).astype(int)
+    if max_off_targets is not None:
+        oligo_df = oligo_df[oligo_df["off-targets"] <= max_off_targets]
+    return oligo_df
+
+
+def design_gene_task(task):
+    """
+    design_gene_oligos for a task tuple, for Pool.imap.
+    """
+    return design_gene_oligos(*task)
+
+
+def iter_oligos(df, input_genome, n_workers=1, check_off_targets=False,
+                max_off_targets=None, off_target_mismatches=4, done_genes=(),
+                first_reference=0):
+    """
+    Design sgRNA-insert pairs gene by gene (see generate_oligos) and yield
+    (gene, oligo table) in the order of the genes, as soon as a gene is designed.
+    Genes which are not in the genome file are yielded with None as table.
+    The references are numbered across all genes, starting at first_reference.
+    Genes in done_genes are skipped, so a design that was interrupted can be continued
+    with the genes and the number of sgRNA-insert pairs written so far.
+    """
 # load genome and mutation list
     mutation_df =  df
-    oligo_df = []
-
-    nucleotide_sequences = input_genome
-    # Get all genes
-    all_genes = extract_genes(input_genome)
-    missing_genes = []
 
     pos_lists = mutation_df.groupby("gene")["aa position"].apply(list).to_dict()
 
     mutation_lists = mutation_df.groupby("gene")["mutation"].apply(list).to_dict()
 
+    # Get the flanked sequences of all genes in a single pass
+    flanking_regions = extract_all_flanking_regions(input_genome, pos_lists)
+    done_genes = set(done_genes)
+
+    tasks = []
     for key, value in mutation_lists.items(): # gene + list of mutations
-        if key not in all_genes:
-            missing_genes.append(key)
+        if key in done_genes:
+            continue
+        if key not in flanking_regions:
+            yield key, None
             continue
-        parent_mutation = []
-        child_mutation = []
-
-        for mutation in value:
-            if mutation[-1] in three_one.keys():
-                parent_mutation.append(three_one[mutation[0]])
-                child_mutation.append(three_one[mutation[-1]])
-        #print(parent_mutation)
-        #print(len(child_mutation))
-        #print(len(pos_lists[key]))
         print(key)
+        merged_sequence, updated_positions = flanking_regions[key]
+        tasks.append((key, value, pos_lists[key], merged_sequence, updated_positions))
+
+    check_off_targets = check_off_targets or max_off_targets is not None
+    specificity = None
+    if check_off_targets:
+        specificity = specificity_index(input_genome, off_target_mismatches)
+
+    reference = first_reference
+    # imap returns the genes in the order of the tasks, as the serial loop
+    if n_workers > 1:
+        if check_off_targets:
+            # the workers get the seed index once
+            pool = start_workers(n_workers, specificity)
+        else:
+            pool = Pool(n_workers)
+        with pool:
+            oligo_dfs = pool.imap(design_gene_task,
+                                  [task + (check_off_targets, max_off_targets)
+                                   for task in tasks])
+            for task, oligo_df in zip(tasks, oligo_dfs):
+                yield task[0], number_oligos(oligo_df, reference)
+                reference += len(oligo_df)
+    else:
+        for task in tasks:
+            oligo_df = design_gene_oligos(*task, check_off_targets, max_off_targets, specificity)
+            yield task[0], number_oligos(oligo_df, reference)
+            reference += len(oligo_df)
+
+
+def number_oligos(oligo_df, first_reference=0):
+    """
+    Add the reference column, "<number>_<gene>", numbered from first_reference.
+    """
+    oligo_df = oligo_df.reset_index(drop=True)
+    numbers = (oligo_df.index + first_reference).astype(str)
+    oligo_df.insert(0, 'reference', numbers + '_' + oligo_df['gene'].astype(str))
+    return oligo_df
 
-        merged_sequence, updated_positions= extract_flanking_regions(nucleotide_sequences,key,pos_lists[key])
-        # Print the flanking sequences and updated positions
-        #print(updated_positions)
-        pos_dict = {} # triplets to get exact pos in
-        
-        for i in range(0, len(merged_sequence), 3):
-            pos_dict[i] = str(merged_sequence[i]) + str(merged_sequence[i + 1])+ str(merged_sequence[i+2])
-        #print(pos_dict)
-        #pam = {}
-        mut_nt = []
-        final_dict = {}
-
-        for i in updated_positions:
-            searchspace=""
-            searchspace = str(merged_sequence[(i)-30:(i)+33])
-            #print(i)
-            #print(pos_dict[i])
-            #print(len(searchspace))
-            mut_nt.append(pos_dict[(i)])
-            #print((i-1), pos_dict[(i-1)])
-            #mut_pos = (i-1)
-            ngg_dict, ccn_dict = get_pams(searchspace)
-            ngg = get_dist(ngg_dict)
-            ccn = get_dist(ccn_dict)
-            final_dict[i] = ngg
-            final_dict[i].extend(ccn)
-        
-        final_dict = get_homology_arm(str(merged_sequence), final_dict)
-        mut_dict = {}
-        intended_aas_per_pos = defaultdict(set)
-        for k in range(len(pos_lists[key])):
-            aa = child_mutation[k].upper()
-            current_key = ((pos_lists[key][k] - 1) * 3) + 60
-            intended_aas_per_pos[current_key].add(aa)
-
-        # Build mut_dict with strict checks
-        for k in range(len(pos_lists[key])):
-            current_key = ((pos_lists[key][k] - 1) * 3) + 60
-            mut_codon = mut_nt[k].upper()
-            aa = child_mutation[k].upper()
-
-            if aa not in aa_nt:
-                print(f"Warning: {aa} not in aa_nt")
-                continue
-
-            if current_key not in mut_dict:
-                mut_dict[current_key] = set()
-            else:
-            # Convert list to set if needed
-                if isinstance(mut_dict[current_key], list):
-                    mut_dict[current_key] = set(mut_dict[current_key])
-
-            # Add the explicitly given mutated codon
-            mut_dict[current_key].add(mut_codon)
-
-            # Add only codons corresponding to *intended* amino acids for that position
-            for allowed_aa in intended_aas_per_pos[current_key]:
-                if allowed_aa in aa_nt:
-                    for j in aa_nt[allowed_aa]:
-                        if len(j) == 3 and len(mut_codon) == 3:
-                            mismatches = sum(c1 != c2 for c1, c2 in zip(mut_codon, j))
-                            if 1 <= mismatches <= 3:
-                                mut_dict[current_key].add(j)
-
-            # Convert back to a list at the end of processing this key
-            mut_dict[current_key] = list(mut_dict[current_key])
-        print(mut_dict)
-
-        adapted_dict = insert_target_mutations(final_dict, mut_dict)
-        #print(adapted_dict)
-         # mutate PAM
-        for key1, value2 in adapted_dict.items():
-            for entry in value2:
-                a = entry[2]
-            #print(a)
-                pos = 0
-                for char in range(len(a)):
-                    if a[char].isupper():
-                        pos = char
-                        break     
-                ha = entry[2]
-                if abs(entry[1]) < 56 :
-                    if entry[1] == 3:
-                        k = ha[pos + entry[1]:pos + entry[1]+3].upper()                   
-                        if k in substitution_nng.keys(): 
-                            j = ha[pos+entry[1]-3 :pos+entry[1]] + substitution_nng[k]# shift = 1
-                            if not "GG" in j:
-                                if not "CC" in j:
-                                    entry.append((ha[:pos+entry[1]]+ substitution_nng[k] +ha[pos+entry[1]+3:]))
-                                    #print(len(ha[:pos+entry[1]]+ dictionaries.substitution_nng[k] +ha[pos+entry[1]+3:]))
-                                    entry.append(j[2:5])
-                                    entry.append(substitution_nng[k])
-                        if k in substitution_ncc.keys():
-                            j = ha[pos+entry[1]-3 :pos+entry[1]] + substitution_ncc[k]# shift = 1
-                            if not "GG" in j:
-                                if not "CC" in j:
-                                    entry.append((ha[:pos+entry[1]]+ substitution_ncc[k] +ha[pos+entry[1]+3:]))
-                                    entry.append(j[2:5])
-                                    entry.append(substitution_ncc[k])
-                    
-                    elif entry[1] > 2: #positive distances (2oder3)
-                       
-                        if (entry[1] % 3) == 0: #shift +2 OKAY
-                            if entry[0].startswith("CC"):
-                                k = ha[pos+entry[1]-3:pos+entry[1]].upper()
-                                if k in substitution_nnc.keys():
-                                    #print(ha,entry[0],k,entry[1])
-                                    #print(ha[:pos-3+entry[1]]+ dictionaries.substitution_nnc[k] +ha[pos+entry[1]:])
-                                    entry.append(ha[:pos-3+entry[1]]+ substitution_nnc[k] +ha[pos+entry[1]:])
-                                    #print(len(ha))
-                                    #print(len(ha[:pos-3+entry[1]]+ dictionaries.substitution_nnc[k] +ha[pos+entry[1]:]))
-                                    entry.append(substitution_nnc[k][-1]+entry[0][1:])
-                                    entry.append(substitution_nnc[k])#changed pam
-                                # GGN does not work
-                            else:
-                                #print(entry[1])
-                                if entry[1] in [6,9,12,15,18,21,24,27,30]:
-                                    #print(entry[1])
-                                    k = ha[pos + entry[1]:pos + entry[1]+3].upper()
-                                    #print(k)
-                                    if k in substitution_ncc.keys():
-                                        #print(ha, entry[1])
-                                        #print(ha[:pos + entry[1]-2]+ dictionaries.substitution_ncc[k] + ha[pos + entry[1]+1:])
-                                        entry.append(ha[:pos + entry[1]-2]+ substitution_ncc[k] + ha[pos + entry[1]+1:])
-                                        entry.append(substitution_ncc[k][1:]+entry[0][-1]) #changed pam
-                                        entry.append(substitution_ncc[k])
-                                    
-                                    if k in substitution_nng.keys():
-                                        #print(ha, entry[0],k,entry[1])
-                                        #print(ha[:pos + entry[1]-2]+ dictionaries.substitution_nng[k] + ha[pos + entry[1]+1:])
-                                        entry.append(ha[:pos + entry[1]-2]+ substitution_nng[k] + ha[pos + entry[1]+1:])
-                                        entry.append(substitution_nng[k][1:]+entry[0][-1])
-                                        entry.append(substitution_nng[k])
-                                        #print(dictionaries.substitution_nng[k],entry[0])
-                                    
-                        
-                                else:
-                                    if entry[0] in substitution_1.keys(): # shift = 0
-                                        #print(ha, entry[0],entry[1])
-                                        #print(ha[:pos+entry[1]-1]+ dictionaries.substitution_1[entry[0]] +ha[pos+entry[1]+2:])
-                                        entry.append(ha[:pos+entry[1]-1]+ substitution_1[entry[0]] +ha[pos+entry[1]+2:])
-                                        entry.append(substitution_1[entry[0]])
-                                        entry.append(substitution_1[entry[0]])
-                    
-                    elif entry[1] < 0: # negative distances
-                        if (entry[1] % 3) == 0: #shift 2
-                            k = ha[pos+entry[1]:pos+entry[1]+3].upper()
-
-                            if entry[0].startswith("CC"):
-                                if  k in substitution_cnn.keys():
-                                    #print(ha, entry[1],entry[0])
-                                    #print(len(ha[:pos+entry[1]]+substitution_cnn[k]+ha[pos+entry[1]+3:]))
-                                    entry.append(ha[:pos+entry[1]]+substitution_cnn[k]+ha[pos+entry[1]+3:])
-                                    entry.append(entry[0][0]+substitution_cnn[k][:-1]) #changed pam
-                                    entry.append(substitution_cnn[k])
-                                    #ggn not possible
-
-                        else:
-                
-                            if (entry[1] % 2 ) != 0:
-                                frame = entry[1]+2 # shift 1
-                                if (frame % 3) == 0:
-                                    if entry[0] in substitution_1.keys():
-                                        #print(ha,entry[1],entry[0])
-                                        #print(len(ha[:pos+entry[1]-1]+ dictionaries.substitution_1[entry[0]] +ha[pos+entry[1]+2:]))
-                                        entry.append(ha[:pos+entry[1]-1]+ substitution_1[entry[0]] +ha[pos+entry[1]+2:])
-                                        entry.append(substitution_1[entry[0]])
-                                        entry.append(substitution_1[entry[0]])
-                                else:    
-                                    k = ha[pos + entry[1]-2:pos + entry[1]+1].upper()
-                                    if k in substitution_nng.keys(): #shift 1 ungerade
-                                          #print(ha, entry[1],entry[0],pos)
-                                        #print(ha[:pos-2+entry[1]]+ dictionaries.substitution_nng[k]+ ha[pos+1+entry[1]:])
-                                        entry.append(ha[:pos-2+entry[1]]+substitution_nng[k]+ ha[pos+1+entry[1]:]) #shift 0
-                                        entry.append(substitution_nng[k][1:]+entry[0][-1])
-                                        entry.append(substitution_nng[k])
-                                    if k in substitution_ncc.keys(): #shift 1 ungerade
-                                        #print(ha, entry[1],entry[0],pos)
-                                        #print(len(ha[:pos-2+entry[1]]+ dictionaries.substitution_ncc[k]+ ha[pos+1+entry[1]:]))
-                                        entry.append(ha[:pos-2+entry[1]]+ substitution_ncc[k]+ ha[pos+1+entry[1]:]) #shift 0
-                                        entry.append(substitution_ncc[k][1:]+entry[0][-1])
-                                        entry.append(substitution_ncc[k])
 
-                            else:
-                                frame = entry[1]-2 #shift = 1
-                                if (frame % 3) == 0:
-                                    #print(k)
-                                    k = ha[pos + entry[1]-2:pos + entry[1]+1].upper()
-                                    if k in substitution_nng.keys(): #shift 1 ungerade
-                                        #print(ha, entry[1],entry[0],pos)
-                                        #print(len(ha[:pos-2+entry[1]]+ dictionaries.substitution_nng[k]+ ha[pos+1+entry[1]:]))
-                                        entry.append(ha[:pos-2+entry[1]]+substitution_nng[k]+ ha[pos+1+entry[1]:]) #shift 0
-                                        entry.append(substitution_nng[k][1:]+entry[0][-1])
-                                        entry.append(substitution_nng[k])
-                                    if k in substitution_ncc.keys(): #shift 1 ungerade
-                                        #print(ha, entry[1],entry[0],pos)
-                                        #print(len(ha[:pos-2+entry[1]]+ dictionaries.substitution_ncc[k]+ ha[pos+1+entry[1]:]))
-                                        entry.append(ha[:pos-2+entry[1]]+substitution_ncc[k]+ ha[pos+1+entry[1]:]) #shift 0
-                                        entry.append(substitution_ncc[k][1:]+entry[0][-1])
-                                        entry.append(substitution_ncc[k])
-                                else:
-                                    
-                                    if entry[0] in substitution_1.keys():
-                                        #print(ha,entry[1],entry[0])
-                                        #print(len(ha[:pos+entry[1]-1]+ dictionaries.substitution_1[entry[0]] +ha[pos+entry[1]+2:]))
-                                        entry.append(ha[:pos+entry[1]-1]+ substitution_1[entry[0]] +ha[pos+entry[1]+2:])
-                                        entry.append(substitution_1[entry[0]])
-                                        entry.append(substitution_1[entry[0]])                
-                    else:
-                        if not ("gg" or "cc")in ha[pos-2:pos+6]:
-                            if not "Gg" in ha[pos-2:pos+6]:
-                                if not "Cc" in ha[pos-2:pos+6]:
-                                    if not "cC" in ha[pos-2:pos+6]:
-                                        if not "gG" in ha[pos-2:pos+6]:
-                                            #print(ha)
-                                            entry.append(ha)
-                                            entry.append("-")
-                                            entry.append("-")
+def generate_oligos(df, input_genome, n_workers=1, check_off_targets=False,
+                    max_off_targets=None, off_target_mismatches=4):
+    """
+    Design sgRNA-insert pairs for a list of mutations. With n_workers > 1 the genes
+    are designed in parallel by a process pool, the output is the same as serially.
+    With check_off_targets (or max_off_targets), the base pairing regions are compared
+    to a seed index of the genome built once, the number of off-targets with up to
+    off_target_mismatches mismatches is added as column and pairs with more than
+    max_off_targets are dropped.
+    Returns the oligo table and the genes which are not in the genome file.
+    For large libraries, iter_oligos yields the table gene by gene instead.
+    """
+    oligo_df = []
+    missing_genes = []
+    for gene, gene_df in iter_oligos(df, input_genome, n_workers, check_off_targets,
+                                     max_off_targets, off_target_mismatches):
+        if gene_df is None:
+            missing_genes.append(gene)
+        else:
+            oligo_df.append(gene_df)
 
-            
-        reduced_dict = filter_pam(adapted_dict)
-        #print(reduced_dict)
-        oligo_df.append(write_df(key,merged_sequence,reduced_dict))
-    
     df_out = pd.concat(oligo_df, axis = 0)
     df_out.reset_index(drop=True, inplace=True)
-    new_col = df_out.index.astype(str) + '_' + df_out['gene']
-    df_out.insert(0, 'reference', new_col)
-
-    return df_out, missing_genes
\ No newline at end of file
+    return df_out, missing_genes
@@ -4,188 +4,109 @@ Created on Thu Dec  1 12:37:26 2022
 
 @author: Sevvalli Thavapalan
 """
+from operator import attrgetter
+import numpy as np
 import pandas as pd
-import Bio.Seq
-from src.dictionaries import *
+from src.dictionaries import aa_nt
 
+# amino acid of every codon (as "A, B" if a codon belongs to several), the inverse of aa_nt
+codon_aa = {}
+for amino_acid, codons in aa_nt.items():
+    for codon in codons:
+        codon_aa[codon] = amino_acid if codon not in codon_aa else codon_aa[codon] + ", " + amino_acid
 
-def get_keys_by_value(my_dict, search_value):
-    """
-    Get the keys by value
-    """
-    keys_with_value = []
-    for key, values_list in my_dict.items():
-        if search_value in values_list:
-            keys_with_value.append(key)
-    return keys_with_value
+COMPLEMENT = str.maketrans("ACGT", "TGCA")
 
-# Function to clean the values in the specified columns
-def clean_values(cell_value):
-    """
-    Clean the values in the specified columns
-    """
-    if pd.notna(cell_value):
-        return str(cell_value).strip("[]").replace("'", "")
-    return cell_value
+CANDIDATE_FIELDS = ["distance", "strand", "pam", "mutated_pam", "child_codon", "arm_start",
+                    "arm_stop", "parent_start", "codon_start", "pam_start", "pam_stop",
+                    "changed_codon"]
+
+OLIGO_COLUMNS = ["gene", "parent aa", "parent codon", "aa position", "mutated aa", "child codon",
+                 "nt position", "dist mut pam", "pam", "mutated pam", "homology arm",
+                 "target strand of base pairing region", "base pairing region", "oligo"]
 
-def process_gene(gene, dictionary_values):
-    """
-    Process the gene
-    """
-    if gene:
-        return gene[0]
-    print(gene, dictionary_values)
-    for key, values in aa_nt.items():
-        if dictionary_values in values:
-            return key
-    return None
 
 def write_df(name,example_gene, reduced_dict):
     """
-    Write the dataframe to a csv file
+    Write the dataframe to a csv file.
+    reduced_dict holds the Candidates with a mutated PAM of every position (see filter_pam
+    in oligos.py), their homology arms are slices of example_gene. The candidates are read once
+    into typed columns, the base pairing regions and amino acids are derived per column.
     """
-    base_pairs = {"A" : "T",
-                  "G" : "C",
-                  "C" : "G",
-                  "T" : "A"
-        }
     sub_library_spacer = "TCCTCTGGCGGAAAGCCT"
     spacer = "GATC"
     pj23119 = "ttgacagctagctcagtcctaggtataatactagt"
     cas_handle = "gttttagagctagaaatagcaagttaaaataaggctag"
-    oligo_df = pd.DataFrame()
-    position_aa = []
-    position_nt = []
-    homology_arm = []
-    protospacer = []
-    distance = []
-    pam_mutation = []
-    mutated_pam = []
-    parent_codon = []
-    child_codon = []
-    oligo = []
-    mutated_codon = []
-    target_strand = []
-    for key, value in reduced_dict.items():
-        #print(key, value)
-        position = key -60 # from flanking genes
-        for entry in value:
-            if len(entry) > 5:
-                position_aa.append(position/3+1)
-                parent_codon.append(entry[3])
-                child_codon.append(entry[4])
-                position_nt.append(position+1)
-                distance.append(entry[1])
-                homology_arm.append(entry[5])
-                pam_mutation.append(entry[0])
-                mutated_pam.append(entry[6])
-                mutated_codon.append(entry[7])
-                if entry[0].startswith("CC"): #non template coding strand
-                    if entry[1] >=0:  # positive distances
-                        pos = (key-1) + (entry[1])
-                        complement= ""
-                        if (entry[1]%3) ==0: #
-                            complement = example_gene[pos+3:pos+23]
-                        elif (entry[1]%2) ==0:
-                            complement = example_gene[pos+2:pos+22]
-                        else:
-                            complement = example_gene[pos+3:pos+23]
-                        rev_complement = ""
-                        for char in complement:
-                            rev_complement += base_pairs[char]
-                        protospacer.append(rev_complement[::-1])
-                        oligo.append(sub_library_spacer + entry[5]
-                                     + spacer + pj23119 + rev_complement[::-1] + cas_handle)
-                        #print(rev_complement[::-1])
-                        target_strand.append("non template / coding strand")
-                    else: # negative distances
-                        pos = (key) + (entry[1])
-                        complement= ""
-                        if (entry[1]%3) == 0:
-                            complement = example_gene[pos+2:pos+22]
-                            #print(len(entry[5]))
-                        elif(entry[1]%2)==0:
-                            complement = example_gene[pos+2:pos+22]
-                        else:
-                            complement = example_gene[pos+2:pos+22]
-                            #print(entry[1])
-                            #print(entry[5])
-                            #print(complement)
-                        rev_complement = ""
-                        for char in complement:
-                            rev_complement += base_pairs[char]
-                        protospacer.append(rev_complement[::-1])
-                        oligo.append(sub_library_spacer + entry[5] + spacer +
-                                    pj23119 + rev_complement[::-1] + cas_handle)
-                        #print(rev_complement[::-1])
-                        target_strand.append("non template / coding strand")
-                else: #template coding strand
-                    pos = (key-1) + (entry[1])
-                    if entry[1] >=0:  # positive distances
-                        complement=""
-                        if (entry[1]%3) ==0: #
-                            complement = example_gene[pos-20:pos]
-                        elif (entry[1]%2) ==0:
-                            complement = example_gene[pos-20:pos]
-                        else:
-                            complement = example_gene[pos-20:pos]
-                        protospacer.append(complement)
-                        #print(len(complement))
-                        target_strand.append("template / non coding strand")
-                        oligo.append(sub_library_spacer + entry[5] +
-                                    spacer + pj23119 + complement + cas_handle)
-                    else:
-                         # negative distances
-                        pos = (key) + (entry[1])
-                        complement= ""
-                        if (entry[1]%3) == 0:
-                            complement = example_gene[pos-20:pos]
-                        elif(entry[1]%2)==0:
-                            complement = example_gene[pos-21:pos-1]
-                        else:
-                            complement = example_gene[pos-21:pos-1]
-                        protospacer.append(complement)
-                        #print(len(complement))
-                        target_strand.append("template / non coding strand")
-                        oligo.append(sub_library_spacer + entry[5] +
-                                     spacer + pj23119 + complement + cas_handle)
-    mutated_aa = []
-    for i in child_codon:
-        keys_for_codon = get_keys_by_value(aa_nt, i)
-        mutated_aa.append(keys_for_codon)
-    parent_aa = []
-    for j in parent_codon:
-        keys_for_codon = get_keys_by_value(aa_nt, j)
-        parent_aa.append(keys_for_codon)
-    gene_name = []
-    for i in range(len(parent_aa)):
-        gene_name.append(name)
-    oligo_df["gene"] = gene_name
-    oligo_df["parent aa"] = parent_aa
-    oligo_df["parent codon"] = parent_codon
-    oligo_df["aa position"] = position_aa
-    oligo_df["mutated aa"]  = mutated_aa
-    oligo_df["child codon"] = child_codon
-    oligo_df["nt position"] = position_nt
-    oligo_df["dist mut pam"] = distance
-    oligo_df["pam"] = pam_mutation
-    oligo_df["mutated pam"] = mutated_pam
-    oligo_df["homology arm"] = homology_arm
-    oligo_df["target strand of base pairing region"] = target_strand
-    oligo_df["base pairing region"] = protospacer
-    oligo_df["oligo"] = oligo
+    example_gene = str(example_gene)
+    keys = [key for key, value in reduced_dict.items() for _ in value]
+    candidates = [entry for value in reduced_dict.values() for entry in value]
+    if not candidates:
+        # same as a table built from empty lists
+        return pd.DataFrame({column: pd.Series(dtype=float) for column in OLIGO_COLUMNS})
+    (distance, strand, pam_mutation, mutated_pam, child_codon, arm_start, arm_stop,
+     parent_start, codon_start, pam_start, pam_stop, changed_codon) = (
+        list(map(attrgetter(field), candidates)) for field in CANDIDATE_FIELDS)
+
+    # the strings of Candidate.parent_codon and Candidate.mutated_homology_arm,
+    # from one lower case copy of the gene
+    gene_lower = example_gene.lower()
+    arms = [gene_lower[first:last] for first, last in zip(arm_start, arm_stop)]
+    parent_codon = [arm[first:first + 3].upper() for arm, first in zip(arms, parent_start)]
+    homology_arm = [f"{arm[:first]}{codon}{arm[first + 3:]}"
+                    for arm, codon, first in zip(arms, child_codon, codon_start)]
+    homology_arm = [arm if first is None else f"{arm[:first]}{codon}{arm[last:]}"
+                    for arm, codon, first, last in zip(homology_arm, changed_codon,
+                                                       pam_start, pam_stop)]
 
-    oligo_df = oligo_df.drop(oligo_df[oligo_df['base pairing region'].map(len) < 20].index)
-    oligo_df = oligo_df.drop(oligo_df[oligo_df['oligo'].map(len) < 200].index)
-    columns_to_clean = ["parent aa", "mutated aa"]
-    # Check if values in Column_A and Column_B are the same
-    mask = oligo_df['parent aa'] == oligo_df['mutated aa']
+    keys = np.array(keys, dtype=np.int64)
+    distance = np.array(distance, dtype=np.int64)
+    reverse = np.array(strand, dtype=object) == "-"
+    position = keys - 60 # from flanking genes
+    positive = distance >= 0
+    # first nucleotide of the 20 nt base pairing region in example_gene:
+    # CC. PAMs (non template / coding strand) are followed by the reverse complement
+    # of the region, .GG PAMs (template / non coding strand) are preceded by the region
+    pos = np.where(positive, keys - 1 + distance, keys + distance)
+    start = np.select(
+        [reverse & positive & (distance % 3 != 0) & (distance % 2 == 0),
+         reverse & positive,
+         reverse,
+         positive | (distance % 3 == 0)],
+        [pos + 2, pos + 3, pos + 2, pos - 20],
+        pos - 21)
+    protospacer = [example_gene[first:first + 20] for first in start.tolist()]
+    protospacer = [region.translate(COMPLEMENT)[::-1] if minus else region
+                   for region, minus in zip(protospacer, reverse.tolist())]
+    target_strand = np.array(["template / non coding strand",
+                              "non template / coding strand"], dtype=object)[reverse.astype(int)]
+    oligo = [f"{sub_library_spacer}{arm}{spacer}{pj23119}{region}{cas_handle}"
+             for arm, region in zip(homology_arm, protospacer)]
+    parent_aa = [codon_aa.get(codon, "") for codon in parent_codon]
+    mutated_aa = [codon_aa.get(codon, "") for codon in child_codon]
 
-    # Remove rows where values in Column_A and Column_B are the same
-    oligo_df = oligo_df[~mask]
-    oligo_df[columns_to_clean] = oligo_df[columns_to_clean].applymap(clean_values)
-    for col in oligo_df.columns:
-        if oligo_df[col].apply(lambda x: isinstance(x, Bio.Seq.Seq)).any():
-            oligo_df[col] = oligo_df[col].apply(str)
-    oligo_df = oligo_df[~oligo_df['parent codon'].isin(['TAA', 'TAG'])]
-    return oligo_df
+    # complete base pairing regions and oligos only, the mutation must change the
+    # amino acid and must not be at a stop codon
+    keep = np.array([len(region) >= 20 and len(oligo_seq) >= 200 and parent != child
+                     and codon not in ("TAA", "TAG")
+                     for region, oligo_seq, parent, child, codon
+                     in zip(protospacer, oligo, parent_aa, mutated_aa, parent_codon)], dtype=bool)
+    columns = {
+        "gene": np.full(len(keep), name, dtype=object),
+        "parent aa": parent_aa,
+        "parent codon": parent_codon,
+        "aa position": position / 3 + 1,
+        "mutated aa": mutated_aa,
+        "child codon": child_codon,
+        "nt position": position + 1,
+        "dist mut pam": distance,
+        "pam": pam_mutation,
+        "mutated pam": mutated_pam,
+        "homology arm": homology_arm,
+        "target strand of base pairing region": target_strand,
+        "base pairing region": protospacer,
+        "oligo": oligo}
+    columns = {column: (values if isinstance(values, np.ndarray)
+                        else np.array(values, dtype=object))[keep]
+               for column, values in columns.items()}
+    # rows keep their number in the unfiltered table as index
+    return pd.DataFrame(columns, index=np.flatnonzero(keep))
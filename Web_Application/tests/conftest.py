@@ -0,0 +1,7 @@
+"""
+Make the src package of the web application importable in the tests.
+"""
+import os
+import sys
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
@@ -0,0 +1,45 @@
+"""
+Tests of the seed engine of the off-target finder.
+"""
+import random
+
+from src.off_target_finder import (MAX_SEED_SIZE, build_seed_index, get_seed_size,
+                                   process_protospacer, prepare_seed_indexes, search_strand,
+                                   worker_state)
+
+
+def random_genome(size, seed=1):
+    """
+    Random nucleotide sequence.
+    """
+    rng = random.Random(seed)
+    return "".join(rng.choice("ACGT") for _ in range(size))
+
+
+def test_seed_size_is_capped():
+    assert get_seed_size(20, 0) == MAX_SEED_SIZE
+    assert get_seed_size(20, 4) == 4
+    # the offsets of a seed index must fit in the memory budget
+    assert 8 * 4 ** get_seed_size(20, 0, 1024 * 1024) <= 1024 * 1024
+
+
+def test_seed_index_without_mismatches():
+    genome = random_genome(20000)
+    state = worker_state({"genome": genome}, "seed", max_mismatches=0)
+    prepare_seed_indexes(state, [20])
+    indexes = state["genomes"]["genome"]["indexes"]
+    assert list(indexes) == [MAX_SEED_SIZE]
+    assert len(indexes[MAX_SEED_SIZE]["offsets"]) == 4 ** MAX_SEED_SIZE + 1
+    assert len(indexes[MAX_SEED_SIZE]["positions"]) == len(genome) - MAX_SEED_SIZE + 1
+
+    protospacer = genome[5000:5020]
+    hits = search_strand(("genome", "ref", protospacer, "+"), state)[3]
+    assert hits == process_protospacer("ref", protospacer, genome, 0)[2]
+    assert (protospacer, 5000, 0) in hits
+
+
+def test_seed_index_offsets():
+    index = build_seed_index("ACGTACGT", 2)
+    positions, offsets = index["positions"], index["offsets"]
+    # AC = 0b0001 occurs at 0 and 4
+    assert list(positions[offsets[1]:offsets[2]]) == [0, 4]
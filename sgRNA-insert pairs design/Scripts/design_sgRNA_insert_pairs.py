@@ -7,78 +7,65 @@ Created on Thursday Jan 25 13:25:43 2024
 from Bio import SeqIO
 from Bio.Seq import Seq
 import argparse
+import hashlib
+import json
+import os
 import re
 import pandas as pd 
 import math
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from multiprocessing import Pool
 from write_data_frame import write_df
 from write_data_frame import *
 from important_dictionaries import *
 
 
-def get_pams(searchspace):
+def index_pams(sequence):
     """
-    Extracts occurrences of patterns '.GG' and 'CC.' from a given search space.
+    Finds all '.GG' and 'CC.' sites of a sequence, overlapping sites included
+    (e.g. 'CGGG' contains the PAMs 'CGG' and 'GGG').
+    The sites are indexed once per gene and then queried for every mutation window.
 
     Parameters:
-    - searchspace (str): The input string to search for patterns.
+    - sequence (str): The merged gene sequence with its flanking regions.
 
     Returns:
-    - ngg_dict (dict): A dictionary containing positions and matched strings for the pattern '.GG'.
-    - ccn_dict (dict): A dictionary containing positions and matched strings for the pattern 'CC.'.
+    - ngg_sites (list): Sorted start positions of the pattern '.GG'.
+    - ccn_sites (list): Sorted start positions of the pattern 'CC.'.
 
     Example:
-    >>> searchspace = "ACCGGTAAGGCCCTCGG"
-    >>> get_pams(searchspace)
-    ({3: 'CGG', 10: 'CGG'}, {2: 'CCG'})
+    >>> index_pams("ACCGGGTAAGGCCCTCGG")
+    ([2, 3, 8, 15], [1, 11, 12])
     """
-    regex1 = re.compile('.GG')  # Pattern matching for '.GG'
-    regex2 = re.compile('CC.')  # Pattern matching for 'CC.'
-    ngg_dict = {}
-    ccn_dict = {}
+    ngg_sites = [site.start() for site in re.finditer('(?=.GG)', sequence)]
+    ccn_sites = [site.start() for site in re.finditer('(?=CC.)', sequence)]
+    return ngg_sites, ccn_sites
 
-    # Iterate over matches for '.GG' and store positions and matched strings in ngg_dict
-    for ngg in regex1.finditer(searchspace):
-        ngg_dict[ngg.start()] = ngg.group()
 
-    # Iterate over matches for 'CC.' and store positions and matched strings in ccn_dict
-    for ccn in regex2.finditer(searchspace):
-        ccn_dict[ccn.start()] = ccn.group()
-
-    return ngg_dict, ccn_dict
-
-
-def get_dist(position_dict):
+def get_window_pams(sequence, sites, window):
     """
-    Calculates the distance of each position in a dictionary from the reference position 29.
-    Because the searchspace is 30 nt before and after the mutation.
+    Looks up the PAM sites lying completely within a search window by binary search and
+    calculates their distance from the reference position 29 of the window,
+    because the searchspace is 30 nt before and after the mutation.
 
     Parameters:
-    - position_dict (dict): A dictionary containing positions and matched strings.
+    - sequence (str): The sequence the sites were indexed in.
+    - sites (list): Sorted start positions of PAM sites, from index_pams.
+    - window (range): Positions of the searchspace in the sequence.
 
     Returns:
     - pam (list): A list of lists, where each inner list contains the matched string and its distance from position 29.
 
     Example:
-    >>> position_dict = {3: 'CGG', 10: 'CGG'}
-    >>> get_dist(position_dict)
-    [['CGG', -26], ['CGG', -19]]
+    >>> sequence = "ACCGGTAAGGCCCTCGG"
+    >>> get_window_pams(sequence, [2, 7, 14], range(0, 17))
+    [['CGG', -27], ['AGG', -22], ['CGG', -15]]
     """
-    dist = 0
-    pam = []
-
-    # Iterate over the positions and matched strings in the input dictionary
-    for key, value in position_dict.items():
-        # Calculate the distance from the reference position 29, middle of the oligo
-        if key < 29:
-            dist = key - 29  # distance from the first nucleotide of PAM
-        else:
-            dist = key - 29  # distance from the last nucleotide of the mutation
-
-        # Append the matched string and its distance to the pam list
-        pam.append([value, dist])
-
-    return pam
+    first = bisect_left(sites, window.start)
+    last = bisect_right(sites, window.stop - 3)
+    # distance from the first nucleotide of the PAM to position 29 of the searchspace
+    return [[sequence[site:site + 3], site - window.start - 29] for site in sites[first:last]]
 
 def get_homology_arm(example_gene, final_dict):
     """
@@ -174,6 +161,11 @@ def get_files():
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('-i', '--input', help="Excel file with mutations", required=True, nargs="+")
     parser.add_argument('-o', '--output', help='path to outfile', required=True , nargs="+")
+    parser.add_argument('-n', '--n_workers', help='number of worker processes designing genes in parallel',
+                        type=int, default=1)
+    parser.add_argument('-g', '--genome', help='genome file (.gb)', default="../Example_Data/BW25113.gb")
+    parser.add_argument('-c', '--checkpoint', help='directory for the designed genes of an interrupted '
+                        'or earlier run, genes already designed are not designed again', default=None)
 
     args = parser.parse_args()
     arguments = args.__dict__
@@ -218,260 +210,398 @@ def extract_flanking_regions(gene_bank_file, gene_name, positions_to_update, fla
                 flanking_sequences.append((merged_sequence, updated_positions, gene_sequence))
     return merged_sequence, updated_positions
 
+def design_gene_oligos(gene, mutations, positions, merged_sequence, updated_positions):
+    """
+    Design all sgRNA-insert pairs for the mutations of one gene.
+    Returns a DataFrame with the sgRNA-insert pairs of the gene (see write_df).
+    """
+    parent_mutation = []
+    child_mutation = []
+
+    for mutation in mutations:
+        if mutation[-1] in three_one.keys():
+            parent_mutation.append(three_one[mutation[0]])
+            child_mutation.append(three_one[mutation[-1]])
+    #print(parent_mutation)
+    #print(len(child_mutation))
+    #print(len(positions))
+    # Print the flanking sequences and updated positions
+    #print(updated_positions)
+    pos_dict = {} # triplets to get exact pos in
+    
+    for i in range(0, len(merged_sequence), 3):
+        pos_dict[i] = str(merged_sequence[i]) + str(merged_sequence[i + 1])+ str(merged_sequence[i+2])
+    #print(pos_dict)
+    #pam = {}
+    mut_nt = []
+    final_dict = {}
+
+    ngg_sites, ccn_sites = index_pams(str(merged_sequence))
+    for i in updated_positions:
+        # same positions as the searchspace merged_sequence[i-30:i+33]
+        window = range(len(merged_sequence))[(i)-30:(i)+33]
+        mut_nt.append(pos_dict[(i)])
+        final_dict[i] = get_window_pams(str(merged_sequence), ngg_sites, window)
+        final_dict[i].extend(get_window_pams(str(merged_sequence), ccn_sites, window))
+    
+    final_dict = get_homology_arm(str(merged_sequence), final_dict)
+    mut_dict = {}
+    intended_aas_per_pos = defaultdict(set)
+    for k in range(len(positions)):
+        aa = child_mutation[k].upper()
+        current_key = ((positions[k] - 1) * 3) + 60
+        intended_aas_per_pos[current_key].add(aa)
+
+    # Build mut_dict with strict checks
+    for k in range(len(positions)):
+        current_key = ((positions[k] - 1) * 3) + 60
+        mut_codon = mut_nt[k].upper()
+        aa = child_mutation[k].upper()
+
+        if aa not in aa_nt:
+            print(f"Warning: {aa} not in aa_nt")
+            continue
+
+        if current_key not in mut_dict:
+            mut_dict[current_key] = set()
+        else:
+        # Convert list to set if needed
+            if isinstance(mut_dict[current_key], list):
+                mut_dict[current_key] = set(mut_dict[current_key])
+
+        # Add the explicitly given mutated codon
+        mut_dict[current_key].add(mut_codon)
+
+        # Add only codons corresponding to *intended* amino acids for that position
+        for allowed_aa in intended_aas_per_pos[current_key]:
+            if allowed_aa in aa_nt:
+                for j in aa_nt[allowed_aa]:
+                    if len(j) == 3 and len(mut_codon) == 3:
+                        mismatches = sum(c1 != c2 for c1, c2 in zip(mut_codon, j))
+                        if 1 <= mismatches <= 3:
+                            mut_dict[current_key].add(j)
+
+        # Convert back to a list at the end of processing this key. The given codon
+        # comes first, as insert_target_mutations skips it, the others in a fixed order
+        mut_dict[current_key] = [mut_codon] + sorted(mut_dict[current_key] - {mut_codon})
+    print(mut_dict)
+
+    adapted_dict = insert_target_mutations(final_dict, mut_dict)
+    #print(adapted_dict)
+     # mutate PAM
+    for key1, value2 in adapted_dict.items():
+        for entry in value2:
+            a = entry[2]
+        #print(a)
+            pos = 0
+            for char in range(len(a)):
+                if a[char].isupper():
+                    pos = char
+                    break     
+            ha = entry[2]
+            if abs(entry[1]) < 56 :
+                if entry[1] == 3:
+                    k = ha[pos + entry[1]:pos + entry[1]+3].upper()                   
+                    if k in substitution_nng.keys(): 
+                        j = ha[pos+entry[1]-3 :pos+entry[1]] + substitution_nng[k]# shift = 1
+                        if not "GG" in j:
+                            if not "CC" in j:
+                                entry.append((ha[:pos+entry[1]]+ substitution_nng[k] +ha[pos+entry[1]+3:]))
+                                #print(len(ha[:pos+entry[1]]+ dictionaries.substitution_nng[k] +ha[pos+entry[1]+3:]))
+                                entry.append(j[2:5])
+                                entry.append(substitution_nng[k])
+                    if k in substitution_ncc.keys():
+                        j = ha[pos+entry[1]-3 :pos+entry[1]] + substitution_ncc[k]# shift = 1
+                        if not "GG" in j:
+                            if not "CC" in j:
+                                entry.append((ha[:pos+entry[1]]+ substitution_ncc[k] +ha[pos+entry[1]+3:]))
+                                entry.append(j[2:5])
+                                entry.append(substitution_ncc[k])
+                
+                elif entry[1] > 2: #positive distances (2oder3)
+                   
+                    if (entry[1] % 3) == 0: #shift +2 OKAY
+                        if entry[0].startswith("CC"):
+                            k = ha[pos+entry[1]-3:pos+entry[1]].upper()
+                            if k in substitution_nnc.keys():
+                                #print(ha,entry[0],k,entry[1])
+                                #print(ha[:pos-3+entry[1]]+ dictionaries.substitution_nnc[k] +ha[pos+entry[1]:])
+                                entry.append(ha[:pos-3+entry[1]]+ substitution_nnc[k] +ha[pos+entry[1]:])
+                                #print(len(ha))
+                                #print(len(ha[:pos-3+entry[1]]+ dictionaries.substitution_nnc[k] +ha[pos+entry[1]:]))
+                                entry.append(substitution_nnc[k][-1]+entry[0][1:])
+                                entry.append(substitution_nnc[k])#changed pam
+                            # GGN does not work
+                        else:
+                            #print(entry[1])
+                            if entry[1] in [6,9,12,15,18,21,24,27,30]:
+                                #print(entry[1])
+                                k = ha[pos + entry[1]:pos + entry[1]+3].upper()
+                                #print(k)
+                                if k in substitution_ncc.keys():
+                                    #print(ha, entry[1])
+                                    #print(ha[:pos + entry[1]-2]+ dictionaries.substitution_ncc[k] + ha[pos + entry[1]+1:])
+                                    entry.append(ha[:pos + entry[1]-2]+ substitution_ncc[k] + ha[pos + entry[1]+1:])
+                                    entry.append(substitution_ncc[k][1:]+entry[0][-1]) #changed pam
+                                    entry.append(substitution_ncc[k])
+                                
+                                if k in substitution_nng.keys():
+                                    #print(ha, entry[0],k,entry[1])
+                                    #print(ha[:pos + entry[1]-2]+ dictionaries.substitution_nng[k] + ha[pos + entry[1]+1:])
+                                    entry.append(ha[:pos + entry[1]-2]+ substitution_nng[k] + ha[pos + entry[1]+1:])
+                                    entry.append(substitution_nng[k][1:]+entry[0][-1])
+                                    entry.append(substitution_nng[k])
+                                    #print(dictionaries.substitution_nng[k],entry[0])
+                                
+                    
+                            else:
+                                if entry[0] in substitution_1.keys(): # shift = 0
+                                    #print(ha, entry[0],entry[1])
+                                    #print(ha[:pos+entry[1]-1]+ dictionaries.substitution_1[entry[0]] +ha[pos+entry[1]+2:])
+                                    entry.append(ha[:pos+entry[1]-1]+ substitution_1[entry[0]] +ha[pos+entry[1]+2:])
+                                    entry.append(substitution_1[entry[0]])
+                                    entry.append(substitution_1[entry[0]])
+                
+                elif entry[1] < 0: # negative distances
+                    if (entry[1] % 3) == 0: #shift 2
+                        k = ha[pos+entry[1]:pos+entry[1]+3].upper()
+
+                        if entry[0].startswith("CC"):
+                            if  k in substitution_cnn.keys():
+                                #print(ha, entry[1],entry[0])
+                                #print(len(ha[:pos+entry[1]]+substitution_cnn[k]+ha[pos+entry[1]+3:]))
+                                entry.append(ha[:pos+entry[1]]+substitution_cnn[k]+ha[pos+entry[1]+3:])
+                                entry.append(entry[0][0]+substitution_cnn[k][:-1]) #changed pam
+                                entry.append(substitution_cnn[k])
+                                #ggn not possible
+
+                    else:
+            
+                        if (entry[1] % 2 ) != 0:
+                            frame = entry[1]+2 # shift 1
+                            if (frame % 3) == 0:
+                                if entry[0] in substitution_1.keys():
+                                    #print(ha,entry[1],entry[0])
+                                    #print(len(ha[:pos+entry[1]-1]+ dictionaries.substitution_1[entry[0]] +ha[pos+entry[1]+2:]))
+                                    entry.append(ha[:pos+entry[1]-1]+ substitution_1[entry[0]] +ha[pos+entry[1]+2:])
+                                    entry.append(substitution_1[entry[0]])
+                                    entry.append(substitution_1[entry[0]])
+                            else:    
+                                k = ha[pos + entry[1]-2:pos + entry[1]+1].upper()
+                                if k in substitution_nng.keys(): #shift 1 ungerade
+                                      #print(ha, entry[1],entry[0],pos)
+                                    #print(ha[:pos-2+entry[1]]+ dictionaries.substitution_nng[k]+ ha[pos+1+entry[1]:])
+                                    entry.append(ha[:pos-2+entry[1]]+substitution_nng[k]+ ha[pos+1+entry[1]:]) #shift 0
+                                    entry.append(substitution_nng[k][1:]+entry[0][-1])
+                                    entry.append(substitution_nng[k])
+                                if k in substitution_ncc.keys(): #shift 1 ungerade
+                                    #print(ha, entry[1],entry[0],pos)
+                                    #print(len(ha[:pos-2+entry[1]]+ dictionaries.substitution_ncc[k]+ ha[pos+1+entry[1]:]))
+                                    entry.append(ha[:pos-2+entry[1]]+ substitution_ncc[k]+ ha[pos+1+entry[1]:]) #shift 0
+                                    entry.append(substitution_ncc[k][1:]+entry[0][-1])
+                                    entry.append(substitution_ncc[k])
+
+                        else:
+                            frame = entry[1]-2 #shift = 1
+                            if (frame % 3) == 0:
+                                #print(k)
+                                k = ha[pos + entry[1]-2:pos + entry[1]+1].upper()
+                                if k in substitution_nng.keys(): #shift 1 ungerade
+                                    #print(ha, entry[1],entry[0],pos)
+                                    #print(len(ha[:pos-2+entry[1]]+ dictionaries.substitution_nng[k]+ ha[pos+1+entry[1]:]))
+                                    entry.append(ha[:pos-2+entry[1]]+substitution_nng[k]+ ha[pos+1+entry[1]:]) #shift 0
+                                    entry.append(substitution_nng[k][1:]+entry[0][-1])
+                                    entry.append(substitution_nng[k])
+                                if k in substitution_ncc.keys(): #shift 1 ungerade
+                                    #print(ha, entry[1],entry[0],pos)
+                                    #print(len(ha[:pos-2+entry[1]]+ dictionaries.substitution_ncc[k]+ ha[pos+1+entry[1]:]))
+                                    entry.append(ha[:pos-2+entry[1]]+substitution_ncc[k]+ ha[pos+1+entry[1]:]) #shift 0
+                                    entry.append(substitution_ncc[k][1:]+entry[0][-1])
+                                    entry.append(substitution_ncc[k])
+                            else:
+                                
+                                if entry[0] in substitution_1.keys():
+                                    #print(ha,entry[1],entry[0])
+                                    #print(len(ha[:pos+entry[1]-1]+ dictionaries.substitution_1[entry[0]] +ha[pos+entry[1]+2:]))
+                                    entry.append(ha[:pos+entry[1]-1]+ substitution_1[entry[0]] +ha[pos+entry[1]+2:])
+                                    entry.append(substitution_1[entry[0]])
+                                    entry.append(substitution_1[entry[0]])                
+                else:
+                    if not ("gg" or "cc")in ha[pos-2:pos+6]:
+                        if not "Gg" in ha[pos-2:pos+6]:
+                            if not "Cc" in ha[pos-2:pos+6]:
+                                if not "cC" in ha[pos-2:pos+6]:
+                                    if not "gG" in ha[pos-2:pos+6]:
+                                        #print(ha)
+                                        entry.append(ha)
+                                        entry.append("-")
+                                        entry.append("-")
+
+    reduced_dict = filter_pam(adapted_dict)
+    #print(reduced_dict)
+    return write_df(gene,merged_sequence,reduced_dict)
+
+
+# Files in the checkpoint directory
+MANIFEST = "manifest.json"
+# Scripts whose code determines the designed sgRNA-insert pairs
+DESIGN_SCRIPTS = ["design_sgRNA_insert_pairs.py", "write_data_frame.py", "important_dictionaries.py"]
+
+
+def file_checksum(path):
+    """
+    SHA-256 checksum of a file.
+    """
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def design_parameters():
+    """
+    Everything besides the genome and the mutations that changes the design:
+    the flanking length and the code of the design scripts.
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return {"flank_length": 60,
+            "scripts": {script: file_checksum(os.path.join(script_dir, script))
+                        for script in DESIGN_SCRIPTS}}
+
+
+def gene_checksum(gene, mutations, positions):
+    """
+    Checksum of the mutations of a gene, the name of its part file in the checkpoint directory.
+    """
+    key = json.dumps([gene, list(mutations), [int(position) for position in positions]])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+
+def part_path(checkpoint_dir, gene_hash):
+    """
+    Path of the part file with the sgRNA-insert pairs of a gene.
+    """
+    return os.path.join(checkpoint_dir, f"part_{gene_hash}.csv")
+
+
+def write_manifest(checkpoint_dir, manifest):
+    """
+    Write the manifest, first to a temporary file so it is never half written.
+    """
+    path = os.path.join(checkpoint_dir, MANIFEST)
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def open_checkpoint(checkpoint_dir, input_file, genome_file):
+    """
+    Load the manifest of a checkpoint directory: checksums of the input and genome files,
+    the design parameters and the checksum of every designed gene (see gene_checksum).
+    Part files designed with another genome or other parameters are removed.
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    manifest = {"input": file_checksum(input_file), "genome": file_checksum(genome_file),
+                "parameters": design_parameters(), "genes": {}}
+    path = os.path.join(checkpoint_dir, MANIFEST)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as file:
+            previous = json.load(file)
+        if (previous["genome"] == manifest["genome"]
+                and previous["parameters"] == manifest["parameters"]):
+            manifest["genes"] = previous["genes"]
+        else:
+            print("The checkpoint was written with another genome or version of the design, "
+                  "all genes are designed again")
+            for gene_hash in previous["genes"].values():
+                if os.path.exists(part_path(checkpoint_dir, gene_hash)):
+                    os.remove(part_path(checkpoint_dir, gene_hash))
+    write_manifest(checkpoint_dir, manifest)
+    return manifest
+
+
+def save_part(checkpoint_dir, manifest, gene, gene_hash, gene_df):
+    """
+    Write the sgRNA-insert pairs of a designed gene and record it in the manifest.
+    """
+    path = part_path(checkpoint_dir, gene_hash)
+    gene_df.to_csv(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+    previous_hash = manifest["genes"].get(gene)
+    if previous_hash not in (None, gene_hash) and os.path.exists(part_path(checkpoint_dir,
+                                                                           previous_hash)):
+        os.remove(part_path(checkpoint_dir, previous_hash))
+    manifest["genes"][gene] = gene_hash
+    write_manifest(checkpoint_dir, manifest)
+
+
+def load_part(checkpoint_dir, gene_hash):
+    """
+    Read the sgRNA-insert pairs of a gene from its part file. Empty strings are kept and
+    a gene without sgRNA-insert pairs gets the float columns of write_df.
+    """
+    gene_df = pd.read_csv(part_path(checkpoint_dir, gene_hash), keep_default_na=False)
+    if gene_df.empty:
+        gene_df = gene_df.astype(float)
+    return gene_df
+
+
+def design_gene_task(task):
+    """
+    design_gene_oligos for a task tuple, returns the gene name and its sgRNA-insert pairs.
+    """
+    return task[0], design_gene_oligos(*task)
+
+
 def main():
     # load genome and mutation list
     infiles = get_files()
     out_path = infiles["output"][0]
     file_path = infiles["input"][0]
+    n_workers = infiles["n_workers"]
+    checkpoint_dir = infiles["checkpoint"]
     if file_path.endswith(".xlsx"):
         mutation_df = pd.read_excel(file_path)
     elif file_path.endswith(".csv"):
         mutation_df = pd.read_csv(file_path)
     else:
         raise ValueError("Unsupported file format. Please provide an Excel or CSV file.")
-    oligo_df = []
-    nucleotide_sequences = "../Example_Data/BW25113.gb" #gene bank file
+    nucleotide_sequences = infiles["genome"] #gene bank file
 
     pos_lists = mutation_df.groupby("gene")["aa position"].apply(list).to_dict()
 
     mutation_lists = mutation_df.groupby("gene")["mutation"].apply(list).to_dict()
 
+    if checkpoint_dir:
+        manifest = open_checkpoint(checkpoint_dir, file_path, nucleotide_sequences)
+        gene_hashes = {key: gene_checksum(key, value, pos_lists[key])
+                       for key, value in mutation_lists.items()}
+
+    tasks = []
     for key, value in mutation_lists.items(): # gene + list of mutations 
-        parent_mutation = []
-        child_mutation = []
-
-        for mutation in value:
-            if mutation[-1] in three_one.keys():
-                parent_mutation.append(three_one[mutation[0]])
-                child_mutation.append(three_one[mutation[-1]])
-        #print(parent_mutation)
-        #print(len(child_mutation))
-        #print(len(pos_lists[key]))
+        if checkpoint_dir and manifest["genes"].get(key) == gene_hashes[key] \
+                and os.path.exists(part_path(checkpoint_dir, gene_hashes[key])):
+            print(key + " (done)")
+            continue
         print(key)
-
         merged_sequence, updated_positions= extract_flanking_regions(nucleotide_sequences,key,pos_lists[key])
-        # Print the flanking sequences and updated positions
-        #print(updated_positions)
-        pos_dict = {} # triplets to get exact pos in
-        
-        for i in range(0, len(merged_sequence), 3):
-            pos_dict[i] = str(merged_sequence[i]) + str(merged_sequence[i + 1])+ str(merged_sequence[i+2])
-        #print(pos_dict)
-        #pam = {}
-        mut_nt = []
-        final_dict = {}
-
-        for i in updated_positions:
-            searchspace=""
-            searchspace = str(merged_sequence[(i)-30:(i)+33])
-            #print(i)
-            #print(pos_dict[i])
-            #print(len(searchspace))
-            mut_nt.append(pos_dict[(i)])
-            #print((i-1), pos_dict[(i-1)])
-            #mut_pos = (i-1)
-            ngg_dict, ccn_dict = get_pams(searchspace)
-            ngg = get_dist(ngg_dict)
-            ccn = get_dist(ccn_dict)
-            final_dict[i] = ngg
-            final_dict[i].extend(ccn)
-        
-        final_dict = get_homology_arm(str(merged_sequence), final_dict)
-        mut_dict = {}
-        intended_aas_per_pos = defaultdict(set)
-        for k in range(len(pos_lists[key])):
-            aa = child_mutation[k].upper()
-            current_key = ((pos_lists[key][k] - 1) * 3) + 60
-            intended_aas_per_pos[current_key].add(aa)
-
-        # Build mut_dict with strict checks
-        for k in range(len(pos_lists[key])):
-            current_key = ((pos_lists[key][k] - 1) * 3) + 60
-            mut_codon = mut_nt[k].upper()
-            aa = child_mutation[k].upper()
-
-            if aa not in aa_nt:
-                print(f"Warning: {aa} not in aa_nt")
-                continue
-
-            if current_key not in mut_dict:
-                mut_dict[current_key] = set()
-            else:
-            # Convert list to set if needed
-                if isinstance(mut_dict[current_key], list):
-                    mut_dict[current_key] = set(mut_dict[current_key])
-
-            # Add the explicitly given mutated codon
-            mut_dict[current_key].add(mut_codon)
-
-            # Add only codons corresponding to *intended* amino acids for that position
-            for allowed_aa in intended_aas_per_pos[current_key]:
-                if allowed_aa in aa_nt:
-                    for j in aa_nt[allowed_aa]:
-                        if len(j) == 3 and len(mut_codon) == 3:
-                            mismatches = sum(c1 != c2 for c1, c2 in zip(mut_codon, j))
-                            if 1 <= mismatches <= 3:
-                                mut_dict[current_key].add(j)
-
-            # Convert back to a list at the end of processing this key
-            mut_dict[current_key] = list(mut_dict[current_key])
-        print(mut_dict)
-
-        adapted_dict = insert_target_mutations(final_dict, mut_dict)
-        #print(adapted_dict)
-         # mutate PAM
-        for key1, value2 in adapted_dict.items():
-            for entry in value2:
-                a = entry[2]
-            #print(a)
-                pos = 0
-                for char in range(len(a)):
-                    if a[char].isupper():
-                        pos = char
-                        break     
-                ha = entry[2]
-                if abs(entry[1]) < 56 :
-                    if entry[1] == 3:
-                        k = ha[pos + entry[1]:pos + entry[1]+3].upper()                   
-                        if k in substitution_nng.keys(): 
-                            j = ha[pos+entry[1]-3 :pos+entry[1]] + substitution_nng[k]# shift = 1
-                            if not "GG" in j:
-                                if not "CC" in j:
-                                    entry.append((ha[:pos+entry[1]]+ substitution_nng[k] +ha[pos+entry[1]+3:]))
-                                    #print(len(ha[:pos+entry[1]]+ dictionaries.substitution_nng[k] +ha[pos+entry[1]+3:]))
-                                    entry.append(j[2:5])
-                                    entry.append(substitution_nng[k])
-                        if k in substitution_ncc.keys():
-                            j = ha[pos+entry[1]-3 :pos+entry[1]] + substitution_ncc[k]# shift = 1
-                            if not "GG" in j:
-                                if not "CC" in j:
-                                    entry.append((ha[:pos+entry[1]]+ substitution_ncc[k] +ha[pos+entry[1]+3:]))
-                                    entry.append(j[2:5])
-                                    entry.append(substitution_ncc[k])
-                    
-                    elif entry[1] > 2: #positive distances (2oder3)
-                       
-                        if (entry[1] % 3) == 0: #shift +2 OKAY
-                            if entry[0].startswith("CC"):
-                                k = ha[pos+entry[1]-3:pos+entry[1]].upper()
-                                if k in substitution_nnc.keys():
-                                    #print(ha,entry[0],k,entry[1])
-                                    #print(ha[:pos-3+entry[1]]+ dictionaries.substitution_nnc[k] +ha[pos+entry[1]:])
-                                    entry.append(ha[:pos-3+entry[1]]+ substitution_nnc[k] +ha[pos+entry[1]:])
-                                    #print(len(ha))
-                                    #print(len(ha[:pos-3+entry[1]]+ dictionaries.substitution_nnc[k] +ha[pos+entry[1]:]))
-                                    entry.append(substitution_nnc[k][-1]+entry[0][1:])
-                                    entry.append(substitution_nnc[k])#changed pam
-                                # GGN does not work
-                            else:
-                                #print(entry[1])
-                                if entry[1] in [6,9,12,15,18,21,24,27,30]:
-                                    #print(entry[1])
-                                    k = ha[pos + entry[1]:pos + entry[1]+3].upper()
-                                    #print(k)
-                                    if k in substitution_ncc.keys():
-                                        #print(ha, entry[1])
-                                        #print(ha[:pos + entry[1]-2]+ dictionaries.substitution_ncc[k] + ha[pos + entry[1]+1:])
-                                        entry.append(ha[:pos + entry[1]-2]+ substitution_ncc[k] + ha[pos + entry[1]+1:])
-                                        entry.append(substitution_ncc[k][1:]+entry[0][-1]) #changed pam
-                                        entry.append(substitution_ncc[k])
-                                    
-                                    if k in substitution_nng.keys():
-                                        #print(ha, entry[0],k,entry[1])
-                                        #print(ha[:pos + entry[1]-2]+ dictionaries.substitution_nng[k] + ha[pos + entry[1]+1:])
-                                        entry.append(ha[:pos + entry[1]-2]+ substitution_nng[k] + ha[pos + entry[1]+1:])
-                                        entry.append(substitution_nng[k][1:]+entry[0][-1])
-                                        entry.append(substitution_nng[k])
-                                        #print(dictionaries.substitution_nng[k],entry[0])
-                                    
-                        
-                                else:
-                                    if entry[0] in substitution_1.keys(): # shift = 0
-                                        #print(ha, entry[0],entry[1])
-                                        #print(ha[:pos+entry[1]-1]+ dictionaries.substitution_1[entry[0]] +ha[pos+entry[1]+2:])
-                                        entry.append(ha[:pos+entry[1]-1]+ substitution_1[entry[0]] +ha[pos+entry[1]+2:])
-                                        entry.append(substitution_1[entry[0]])
-                                        entry.append(substitution_1[entry[0]])
-                    
-                    elif entry[1] < 0: # negative distances
-                        if (entry[1] % 3) == 0: #shift 2
-                            k = ha[pos+entry[1]:pos+entry[1]+3].upper()
-
-                            if entry[0].startswith("CC"):
-                                if  k in substitution_cnn.keys():
-                                    #print(ha, entry[1],entry[0])
-                                    #print(len(ha[:pos+entry[1]]+substitution_cnn[k]+ha[pos+entry[1]+3:]))
-                                    entry.append(ha[:pos+entry[1]]+substitution_cnn[k]+ha[pos+entry[1]+3:])
-                                    entry.append(entry[0][0]+substitution_cnn[k][:-1]) #changed pam
-                                    entry.append(substitution_cnn[k])
-                                    #ggn not possible
-
-                        else:
-                
-                            if (entry[1] % 2 ) != 0:
-                                frame = entry[1]+2 # shift 1
-                                if (frame % 3) == 0:
-                                    if entry[0] in substitution_1.keys():
-                                        #print(ha,entry[1],entry[0])
-                                        #print(len(ha[:pos+entry[1]-1]+ dictionaries.substitution_1[entry[0]] +ha[pos+entry[1]+2:]))
-                                        entry.append(ha[:pos+entry[1]-1]+ substitution_1[entry[0]] +ha[pos+entry[1]+2:])
-                                        entry.append(substitution_1[entry[0]])
-                                        entry.append(substitution_1[entry[0]])
-                                else:    
-                                    k = ha[pos + entry[1]-2:pos + entry[1]+1].upper()
-                                    if k in substitution_nng.keys(): #shift 1 ungerade
-                                          #print(ha, entry[1],entry[0],pos)
-                                        #print(ha[:pos-2+entry[1]]+ dictionaries.substitution_nng[k]+ ha[pos+1+entry[1]:])
-                                        entry.append(ha[:pos-2+entry[1]]+substitution_nng[k]+ ha[pos+1+entry[1]:]) #shift 0
-                                        entry.append(substitution_nng[k][1:]+entry[0][-1])
-                                        entry.append(substitution_nng[k])
-                                    if k in substitution_ncc.keys(): #shift 1 ungerade
-                                        #print(ha, entry[1],entry[0],pos)
-                                        #print(len(ha[:pos-2+entry[1]]+ dictionaries.substitution_ncc[k]+ ha[pos+1+entry[1]:]))
-                                        entry.append(ha[:pos-2+entry[1]]+ substitution_ncc[k]+ ha[pos+1+entry[1]:]) #shift 0
-                                        entry.append(substitution_ncc[k][1:]+entry[0][-1])
-                                        entry.append(substitution_ncc[k])
-
-                            else:
-                                frame = entry[1]-2 #shift = 1
-                                if (frame % 3) == 0:
-                                    #print(k)
-                                    k = ha[pos + entry[1]-2:pos + entry[1]+1].upper()
-                                    if k in substitution_nng.keys(): #shift 1 ungerade
-                                        #print(ha, entry[1],entry[0],pos)
-                                        #print(len(ha[:pos-2+entry[1]]+ dictionaries.substitution_nng[k]+ ha[pos+1+entry[1]:]))
-                                        entry.append(ha[:pos-2+entry[1]]+substitution_nng[k]+ ha[pos+1+entry[1]:]) #shift 0
-                                        entry.append(substitution_nng[k][1:]+entry[0][-1])
-                                        entry.append(substitution_nng[k])
-                                    if k in substitution_ncc.keys(): #shift 1 ungerade
-                                        #print(ha, entry[1],entry[0],pos)
-                                        #print(len(ha[:pos-2+entry[1]]+ dictionaries.substitution_ncc[k]+ ha[pos+1+entry[1]:]))
-                                        entry.append(ha[:pos-2+entry[1]]+substitution_ncc[k]+ ha[pos+1+entry[1]:]) #shift 0
-                                        entry.append(substitution_ncc[k][1:]+entry[0][-1])
-                                        entry.append(substitution_ncc[k])
-                                else:
-                                    
-                                    if entry[0] in substitution_1.keys():
-                                        #print(ha,entry[1],entry[0])
-                                        #print(len(ha[:pos+entry[1]-1]+ dictionaries.substitution_1[entry[0]] +ha[pos+entry[1]+2:]))
-                                        entry.append(ha[:pos+entry[1]-1]+ substitution_1[entry[0]] +ha[pos+entry[1]+2:])
-                                        entry.append(substitution_1[entry[0]])
-                                        entry.append(substitution_1[entry[0]])                
-                    else:
-                        if not ("gg" or "cc")in ha[pos-2:pos+6]:
-                            if not "Gg" in ha[pos-2:pos+6]:
-                                if not "Cc" in ha[pos-2:pos+6]:
-                                    if not "cC" in ha[pos-2:pos+6]:
-                                        if not "gG" in ha[pos-2:pos+6]:
-                                            #print(ha)
-                                            entry.append(ha)
-                                            entry.append("-")
-                                            entry.append("-")
-
-            
-        reduced_dict = filter_pam(adapted_dict)
-        #print(reduced_dict)
-        oligo_df.append(write_df(key,merged_sequence,reduced_dict))
+        tasks.append((key, value, pos_lists[key], merged_sequence, updated_positions))
+
+    if checkpoint_dir:
+        # every designed gene is saved right away, in the order the workers finish them
+        if n_workers > 1:
+            with Pool(n_workers) as pool:
+                for gene, gene_df in pool.imap_unordered(design_gene_task, tasks):
+                    save_part(checkpoint_dir, manifest, gene, gene_hashes[gene], gene_df)
+        else:
+            for task in tasks:
+                gene, gene_df = design_gene_task(task)
+                save_part(checkpoint_dir, manifest, gene, gene_hashes[gene], gene_df)
+        oligo_df = [load_part(checkpoint_dir, gene_hashes[key]) for key in mutation_lists]
+    # Design the genes in parallel, starmap keeps the order of the genes
+    elif n_workers > 1:
+        with Pool(n_workers) as pool:
+            oligo_df = pool.starmap(design_gene_oligos, tasks)
+    else:
+        oligo_df = [design_gene_oligos(*task) for task in tasks]
     
     df = pd.concat(oligo_df, axis = 0)
     df.reset_index(drop=True, inplace=True)
@@ -482,4 +612,4 @@ def main():
     print("Output saved at: "+ out_str)
 
 if __name__ == "__main__":
-    main()	
+    main()
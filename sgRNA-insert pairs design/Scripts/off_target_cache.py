@@ -0,0 +1,115 @@
+"""
+Persistent cache of off-target search results, shared by all runs of the off-target finder.
+The hits of a base pairing region are stored in an SQLite file, keyed by the checksum of
+the genome, the base pairing region, the strand, the maximum number of mismatches and the PAM.
+When the file grows beyond its size limit, the least recently used entries are removed.
+The size of the stored hit lists is kept as a running total, so the table is only summed up
+again when the limit seems to be reached.
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+CACHE_FILE = os.path.join(tempfile.gettempdir(), "linkgenvarphen_off_targets.sqlite")
+# Maximum size of the stored hit lists in bytes
+CACHE_SIZE = 512 * 1024 * 1024
+
+
+class OffTargetCache:
+    """
+    Hit lists of base pairing regions, (matched_seq, position, mismatches) tuples,
+    stored in an SQLite file with least recently used eviction.
+    """
+
+    def __init__(self, path=CACHE_FILE, max_size=CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS off_targets ("
+            "genome TEXT, protospacer TEXT, strand TEXT, max_mismatches INTEGER, pam TEXT, "
+            "hits TEXT, size INTEGER, last_used INTEGER, "
+            "PRIMARY KEY (genome, protospacer, strand, max_mismatches, pam))")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS off_targets_last_used ON off_targets (last_used)")
+        self.connection.commit()
+        self.total = self.stored_size()
+
+    def stored_size(self):
+        """
+        Size of all stored hit lists in bytes.
+        """
+        return self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM off_targets").fetchone()[0]
+
+    def get(self, genome, keys, max_mismatches, pam=None):
+        """
+        Cached hits of (protospacer, strand) keys, as dict key -> hit list.
+        Keys that are not in the cache are missing from the dict.
+        """
+        found = {}
+        now = time.time_ns()
+        with self.connection:
+            for protospacer, strand in keys:
+                row = self.connection.execute(
+                    "SELECT hits FROM off_targets WHERE genome = ? AND protospacer = ? "
+                    "AND strand = ? AND max_mismatches = ? AND pam = ?",
+                    (genome, protospacer, strand, max_mismatches, pam or "")).fetchone()
+                if row is not None:
+                    found[(protospacer, strand)] = [tuple(hit) for hit in json.loads(row[0])]
+                    self.connection.execute(
+                        "UPDATE off_targets SET last_used = ? WHERE genome = ? "
+                        "AND protospacer = ? AND strand = ? AND max_mismatches = ? AND pam = ?",
+                        (now, genome, protospacer, strand, max_mismatches, pam or ""))
+        return found
+
+    def put(self, genome, hits, max_mismatches, pam=None):
+        """
+        Store the hit lists of (protospacer, strand) keys and evict old entries.
+        Store many keys with one call, every call is a transaction.
+        """
+        now = time.time_ns()
+        with self.connection:
+            for (protospacer, strand), targets in hits.items():
+                text = json.dumps([list(hit) for hit in targets])
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO off_targets VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (genome, protospacer, strand, max_mismatches, pam or "",
+                     text, len(text), now))
+                # replaced entries are counted twice until the next eviction
+                self.total += len(text)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the hit lists fit in max_size bytes.
+        The table is only summed up when the running total is over max_size, other
+        processes writing to the same file are taken into account then.
+        """
+        if self.total <= self.max_size:
+            return
+        with self.connection:
+            total = self.stored_size()
+            if total <= self.max_size:
+                self.total = total
+                return
+            rows = self.connection.execute(
+                "SELECT rowid, size FROM off_targets ORDER BY last_used").fetchall()
+            remove = []
+            for rowid, size in rows:
+                if total <= self.max_size:
+                    break
+                remove.append((rowid,))
+                total -= size
+            self.connection.executemany("DELETE FROM off_targets WHERE rowid = ?", remove)
+        self.total = total
+
+    def close(self):
+        """
+        Close the SQLite connection.
+        """
+        self.connection.close()
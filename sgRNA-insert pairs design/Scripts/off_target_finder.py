@@ -7,14 +7,23 @@ The results are written to an Excel file, which includes the base pairing region
 the off-target sequence,
 the position in the genome, and the number of mismatches.
 The off-target search is performed in parallel using the multiprocessing module to improve 
-performance.
+performance. Every worker receives the genome once, identical base pairing regions are searched
+only once and the results are copied to all of their references.
+Several genomes can be given at once; they are searched on the same pool of workers and the
+Excel file then has one sheet per genome and a summary sheet with the hits per genome.
+With --cache, the off-targets are stored in an SQLite file (see off_target_cache.py, the same
+cache as in the web application) and base pairing regions searched in an earlier run are not
+searched again.
 """
+import os
 from multiprocessing import Pool
 import argparse
+import hashlib
 from collections import defaultdict
 import regex as re
 import pandas as pd
 from Bio import SeqIO
+from off_target_cache import OffTargetCache
 
 
 def get_files():
@@ -24,8 +33,13 @@ def get_files():
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('-i', '--input',
                         help="csv file containig base pairing regions ", required=True)
-    parser.add_argument('-g', '--genome', help='path to genome in gb format', required=True)
+    parser.add_argument('-g', '--genome', nargs='+',
+                        help='path to genome in gb format, or several genomes', required=True)
     parser.add_argument('-o', '--output', help='path to out file in xlsx format', required=True)
+    parser.add_argument('-c', '--cache', default=None,
+                        help='SQLite file to cache off-targets between runs (default: no cache)')
+    parser.add_argument('-cs', '--cache_size', type=int, default=512,
+                        help='maximum size of the cached off-targets in MB (default: 512)')
 
     args = parser.parse_args()
     arguments = args.__dict__
@@ -55,6 +69,53 @@ def process_protospacer(reference,protospacer, genome_seq, max_mismatches=4):
     return (reference, protospacer, off_targets)
 
 
+# Genome sequences (name -> sequence) of a worker process, set once per worker by init_worker
+_worker_genomes = {}
+
+
+def init_worker(genomes):
+    """
+    Pool initializer: keep the genomes in the worker, so they are sent once per worker
+    and not with every base pairing region.
+    """
+    _worker_genomes.clear()
+    _worker_genomes.update(genomes)
+
+
+def process_protospacer_in_worker(genome_name, reference, protospacer, max_mismatches=4):
+    """
+    process_protospacer on a genome of the worker process.
+    Returns (genome_name, protospacer, off-targets).
+    """
+    _, protospacer, off_targets = process_protospacer(reference, protospacer,
+                                                      _worker_genomes[genome_name],
+                                                      max_mismatches)
+    return (genome_name, protospacer, off_targets)
+
+
+def genome_names(genome_paths):
+    """
+    Name every genome file after the file, genomes with the same file name in different
+    folders are named parent folder_file name. Returns the dict name -> genome file.
+    Raises ValueError if the names (or the Excel sheet names, their first 31 characters)
+    are still not unique.
+    """
+    file_names = [os.path.splitext(os.path.basename(path))[0] for path in genome_paths]
+    names = []
+    for path, file_name in zip(genome_paths, file_names):
+        if file_names.count(file_name) > 1:
+            parent = os.path.basename(os.path.dirname(os.path.abspath(path)))
+            file_name = f"{parent}_{file_name}"
+        names.append(file_name)
+    for name in names:
+        if [other[:31] for other in names].count(name[:31]) > 1:
+            duplicates = [path for path, other in zip(genome_paths, names)
+                          if other[:31] == name[:31]]
+            raise ValueError(f"The genome files {', '.join(duplicates)} get the same name "
+                             f"{name[:31]}, rename one of them")
+    return dict(zip(names, genome_paths))
+
+
 def highlight_protospacers(df):
     """
     Highlight base pairing regions with 4 mismatches or less
@@ -82,46 +143,95 @@ def main():
         protospacer_dict[row['base pairing region']].append(row['reference'])
 
 
-    # Load the E. coli genome from a GenBank file
-    ecoli_genome = SeqIO.read(args['genome'], "genbank")
-
-    # Convert genome sequence to a string (for performance)
-    genome_seq = str(ecoli_genome.seq)
+    # Load the genomes from GenBank files, named after the files
+    genome_files = genome_names(args['genome'])
+    genomes = {}
+    for name, genome_file in genome_files.items():
+        # Convert genome sequence to a string (for performance)
+        genomes[name] = str(SeqIO.read(genome_file, "genbank").seq)
 
 # Run the off-target search in parallel
 
-    with Pool() as pool:
-        tasks = []
+    # Off-targets found in earlier runs
+    cached = {}
+    if args['cache']:
+        cache = OffTargetCache(args['cache'], args['cache_size'] * 1024 * 1024)
+        genome_checksums = {}
+        for name, genome_file in genome_files.items():
+            with open(genome_file, "rb") as file:
+                genome_checksums[name] = hashlib.sha256(file.read()).hexdigest()
+            # forward strand searches, stored under the same keys as in the web application
+            cached[name] = {protospacer: targets for (protospacer, _), targets in cache.get(
+                genome_checksums[name], [(protospacer, "+") for protospacer in protospacer_dict],
+                4).items()}
+            print(f"{name}: {len(cached[name])} of {len(protospacer_dict)} base pairing regions "
+                  "taken from the cache")
+
+    tasks = []
+    for name in genomes:
+        for protospacer, refs in protospacer_dict.items():
+            if protospacer not in cached.get(name, {}):
+                tasks.append((name, refs[0], protospacer))
+    processes = os.cpu_count() or 1
+    # about four chunks of base pairing regions per worker
+    chunksize = max(1, len(tasks) // (processes * 4))
+    unique_results = []
+    if tasks:
+        with Pool(processes, initializer=init_worker, initargs=(genomes,)) as pool:
+            unique_results = pool.starmap(process_protospacer_in_worker, tasks,
+                                          chunksize=chunksize)
+    hits = {name: {} for name in genomes}
+    for name, protospacer, targets in unique_results:
+        hits[name][protospacer] = targets
+    if args['cache']:
+        for name in genomes:
+            cache.put(genome_checksums[name], {(protospacer, "+"): targets
+                                               for protospacer, targets in hits[name].items()}, 4)
+            hits[name].update(cached[name])
+        cache.close()
+
+    tables = {}
+    for name in genomes:
+        # Copy the off-targets of every base pairing region to all of its references
+        results = []
         for protospacer, refs in protospacer_dict.items():
             for ref in refs:
-                tasks.append((ref, protospacer, genome_seq))
-        results = pool.starmap(process_protospacer, tasks)
-
-
-
-
-    # Prepare data for Excel
-    data = []
-    for reference, protospacer, targets in results:
-        if targets and len(targets) > 0:
-            for target in targets:
-                data.append([reference, protospacer, target[0], target[1], target[2]])
-        else:
-            data.append([reference, protospacer, "", "", "None"])
-
-
-    # Create DataFrame
-    df = pd.DataFrame(data, columns=['reference','base pairing region',
-                                     'Off-Target Sequence', 'Position', 'Mismatches'])
-    styled_df = highlight_protospacers(df)
-    print(f"Number of unique references processed: {df['reference'].nunique()}")
-    print(f"Number of total rows: {len(df)}")
-    print(df['reference'].value_counts())
-
+                results.append((ref, protospacer, hits[name][protospacer]))
+
+        # Prepare data for Excel
+        data = []
+        for reference, protospacer, targets in results:
+            if targets and len(targets) > 0:
+                for target in targets:
+                    data.append([reference, protospacer, target[0], target[1], target[2]])
+            else:
+                data.append([reference, protospacer, "", "", "None"])
+
+        # Create DataFrame
+        df = pd.DataFrame(data, columns=['reference','base pairing region',
+                                         'Off-Target Sequence', 'Position', 'Mismatches'])
+        print(f"{name}:")
+        print(f"Number of unique references processed: {df['reference'].nunique()}")
+        print(f"Number of total rows: {len(df)}")
+        print(df['reference'].value_counts())
+        tables[name] = df
 
     # Write DataFrame to Excel
     output_file = args['output']
-    styled_df.to_excel(output_file, index=False)
+    if len(tables) == 1:
+        styled_df = highlight_protospacers(next(iter(tables.values())))
+        styled_df.to_excel(output_file, index=False)
+    else:
+        # Summary with the number of hits per genome, followed by one sheet per genome
+        summary = pd.DataFrame([(ref, protospacer) for protospacer, refs in protospacer_dict.items()
+                                for ref in refs], columns=['reference', 'base pairing region'])
+        for name in genomes:
+            summary[f"{name} hits"] = [len(hits[name][protospacer])
+                                       for protospacer in summary['base pairing region']]
+        with pd.ExcelWriter(output_file) as writer:
+            summary.to_excel(writer, sheet_name="Summary", index=False)
+            for name, df in tables.items():
+                highlight_protospacers(df).to_excel(writer, sheet_name=name[:31], index=False)
 
     print(f"Results have been written to {output_file}")
 